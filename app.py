@@ -1,13 +1,10 @@
 # isort:skip_file
 import logging
+import sys
 
 
-import ssm  # noqa
+import ssm
 from chalice import Chalice, Rate
-import terraform
-import loggers
-
-loggers.config()
 
 app_name = "key-rotation"
 
@@ -17,7 +14,76 @@ logger = logging.getLogger()
 
 app = Chalice(app_name=app_name)
 
+_initialized = False
+
+
+def init():
+    """ Load configuration from SSM and configure logging on the first invocation
+        rather than at import. SSM parameters are cached between warm invocations
+        for SSM_CACHE_TTL seconds; in a warm container, settings are read again
+        after each load so changed parameters take effect. """
+    global _initialized
+
+    ssm.load()
+
+    if "config" in sys.modules:  # imported by an earlier invocation
+        import config
+
+        changed = config.reload()
+        if changed:
+            logger.info(f"(SSM) settings changed since the last invocation: {changed}")
+            if "terraform" in sys.modules:
+                # the shared client holds the token and connection settings
+                sys.modules["terraform"].close_client()
+
+    if not _initialized:
+        import loggers
+
+        loggers.config()
+        _initialized = True
+
 
 @app.schedule(Rate(24, unit=Rate.HOURS), name="terraform-cloud")
 def rotate_terraform_keys(event):
-    terraform.rotate_keys()
+    init()
+
+    import config as conf
+    from tracing import tracer
+
+    try:
+        from util.timing import Deadline
+
+        deadline = Deadline.from_context(event.context, margin=conf.DEADLINE_MARGIN)
+        if conf.TF_IAM_USER_MAP:
+            import batch
+
+            batch.rotate_users(batch.user_selectors(), deadline=deadline)
+        else:
+            import terraform
+
+            terraform.rotate_keys(deadline=deadline)
+    finally:
+        import loggers
+        import terraform
+
+        terraform.close_catalog()
+        # latency percentiles of every span recorded during this invocation
+        tracer.report()
+        loggers.flush()
+
+
+@app.lambda_function(name="terraform-cloud-worker")
+def rotate_terraform_shard(event, context):
+    """ Write one shard of a sharded rotation (see chalicelib/shards.py) """
+    init()
+
+    import shards
+    from tracing import tracer
+
+    try:
+        return shards.run_shard(event)
+    finally:
+        import loggers
+
+        tracer.report()
+        loggers.flush()
@@ -0,0 +1,118 @@
+""" Compare opening a client per call, which connects anew every time, with the
+    shared pooled client (terraform.async_client) that keeps connections alive
+    across calls to terraform.run(), as happens between warm invocations.
+
+    Requests go over TCP to a local keep-alive HTTP server, so the measured cost
+    is connection setup only; against the real API each new connection also
+    pays for a TLS handshake.
+
+    Reported per mode:
+        wall_s: time for every invocation
+        connections: TCP connections accepted by the server
+        per_call_ms: mean duration of one invocation
+
+    Usage:
+        python benchmarks/connections.py --invocations 200 --requests 5
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from timeit import default_timer as timer
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "chalicelib"))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    body = b'{"data": []}'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.api+json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+
+server = Server(("127.0.0.1", 0), Handler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+for k, v in {
+    "APP_NAME": "key-rotation",
+    "TF_API_URL": f"http://127.0.0.1:{server.server_port}/api/v2/",
+    "TF_TOKEN": "benchmark",
+    "TF_ORG_NAME": "benchmark",
+    "TF_IAM_USERNAME": "benchmark",
+    "TF_RATE_LIMIT": "100000",
+}.items():
+    os.environ.setdefault(k, v)
+
+import httpx  # noqa
+import terraform  # noqa
+
+
+async def per_call(requests: int):
+    async with httpx.AsyncClient(headers=terraform.headers()) as client:
+        for _ in range(requests):
+            (await client.get(terraform.workspace_url())).raise_for_status()
+
+
+async def shared(requests: int):
+    async with terraform.async_client() as client:
+        for _ in range(requests):
+            (await client.get(terraform.workspace_url())).raise_for_status()
+
+
+def measure(engine, invocations: int, requests: int, run) -> dict:
+    server.connections = 0
+    ts = timer()
+    for _ in range(invocations):
+        run(engine(requests))
+    elapsed = timer() - ts
+    return {
+        "wall_s": round(elapsed, 3),
+        "connections": server.connections,
+        "per_call_ms": round(elapsed / invocations * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--invocations", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=5)
+    args = parser.parse_args()
+
+    results = {
+        # before: a new client and event loop for every call
+        "per_call": measure(per_call, args.invocations, args.requests, asyncio.run),
+        "shared": measure(shared, args.invocations, args.requests, terraform.run),
+    }
+    terraform.close_client()
+
+    columns = ["mode", "wall_s", "connections", "per_call_ms"]
+    print("  ".join(f"{c:>12}" for c in columns))
+    for mode, result in results.items():
+        print("  ".join(f"{x:>12}" for x in [mode, *result.values()]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+""" Measure memory used by variable discovery as the organization grows.
+
+    Variables are fetched from the local TFC stand-in (fake_tfc) and traced with
+    tracemalloc. Reported per size:
+        retained_mb: memory held by the resulting VariableIndex
+        peak_mb: peak traced memory during discovery
+        transient_mb: peak minus retained, i.e. raw pages in flight, which
+                      should stay roughly constant as the variable count grows
+
+    Usage:
+        python benchmarks/discovery.py --workspaces 1000 5000 20000
+"""
+
+import argparse
+import os
+import sys
+import tracemalloc
+from pathlib import Path
+from timeit import default_timer as timer
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "chalicelib"))
+
+for k, v in {
+    "APP_NAME": "key-rotation",
+    "TF_API_URL": "http://tfc.local/api/v2/",
+    "TF_TOKEN": "benchmark",
+    "TF_ORG_NAME": "benchmark",
+    "TF_IAM_USERNAME": "benchmark",
+    "TF_RATE_LIMIT": "100000",
+}.items():
+    os.environ.setdefault(k, v)
+
+import fake_tfc  # noqa
+import terraform  # noqa
+
+
+def measure(workspaces: int) -> dict:
+    org = fake_tfc.FakeOrganization.generate(
+        os.environ["TF_ORG_NAME"], workspaces=workspaces, seeded=1.0
+    )
+    terraform.asgi_app = fake_tfc.create_app(org)
+    org.variable_list()  # the server's own listing is not part of discovery
+
+    tracemalloc.start()
+    ts = timer()
+    variables = terraform.fetch_variables(category=terraform.VarCategory.ENV)
+    elapsed = timer() - ts
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "variables": len(variables),
+        "fetch_s": round(elapsed, 3),
+        "retained_mb": round(retained / 2 ** 20, 1),
+        "peak_mb": round(peak / 2 ** 20, 1),
+        "transient_mb": round((peak - retained) / 2 ** 20, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workspaces", type=int, nargs="+", default=[1000, 5000])
+    args = parser.parse_args()
+
+    columns = ["variables", "fetch_s", "retained_mb", "peak_mb", "transient_mb"]
+    print("  ".join(f"{c:>12}" for c in columns))
+    for workspaces in args.workspaces:
+        result = measure(workspaces)
+        print("  ".join(f"{result[c]:>12}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+""" End-to-end rotation benchmark against local stand-ins for Terraform Cloud and
+    AWS, so performance changes can be measured at scale without touching
+    production.
+
+    Each scenario runs in a fresh interpreter: an organization of the given size
+    is generated (fake_tfc), IAM/STS/SSM are replaced by in-process stubs
+    (fake_aws), and the full rotation runs: SSM load, workspace and variable
+    discovery, key creation and every variable write.
+
+    Reported per scenario:
+        wall_s: duration of the rotation
+        requests: HTTP requests received by the fake TFC API (incl. 429s)
+        throttled: requests rejected with a 429
+        error_rate: fraction of variable writes that failed
+        peak_rss_mb / rss_delta_mb: peak memory, and growth during the rotation
+        write_p95_ms: 95th percentile latency of variable writes
+        stale_workspaces: workspaces whose effective AWS_ACCESS_KEY_ID (their own
+                          variable, or the variable set's) is not the newest key
+
+    Results are appended to benchmarks/e2e-history.jsonl.
+
+    Usage:
+        python benchmarks/e2e.py --workspaces 10 1000 10000 --latency 0.002
+        python benchmarks/e2e.py --workspaces 1000 --server-rate-limit 500 --rate-limit 1000
+        python benchmarks/e2e.py --workspaces 50000 --seeded 0.9
+        python benchmarks/e2e.py --workspaces 10000 --shard-size 1000 --shard-workers 8
+        python benchmarks/e2e.py --workspaces 10000 --catalog
+        python benchmarks/e2e.py --workspaces 10000 --varset --catalog
+
+    With --varset, the credentials are delivered through a variable set
+    (TF_VARSET_NAME): the first rotation migrates the seeded per-workspace
+    variables, later ones only update the set. With --catalog, discovery goes
+    through a fresh catalog (CATALOG_PATH). With either, a second rotation runs
+    once the first has finished; its requests and duration are reported as
+    repeat_requests and repeat_wall_s.
+
+    With --shard-size, writes are fanned out to a local process pool
+    (SHARD_EXECUTOR=process). The fake TFC app is then served over HTTP on
+    localhost, so the coordinator and the workers share one organization and
+    requests counts every process. Spans are recorded per process, so
+    write_p95_ms is not measured (0) when the workers do the writing.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from timeit import default_timer as timer
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+HISTORY = Path(__file__).resolve().parent / "e2e-history.jsonl"
+
+ENV: Dict[str, str] = {
+    "APP_NAME": "key-rotation",
+    "TF_API_URL": "http://tfc.local/api/v2/",
+    "TF_TOKEN": "benchmark",
+    "TF_ORG_NAME": "benchmark",
+    "TF_IAM_USERNAME": "benchmark",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "SSM_CACHE_TTL": "0",
+    "JOURNAL_STORE": "memory",
+    "CATALOG_PATH": "",
+    "LOG_LEVEL": "30",
+}
+
+COLUMNS = [
+    "workspaces",
+    "wall_s",
+    "requests",
+    "throttled",
+    "error_rate",
+    "peak_rss_mb",
+    "rss_delta_mb",
+    "write_p95_ms",
+    "stale_workspaces",
+]
+
+
+def rss_mb() -> float:
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_scenario(args: argparse.Namespace) -> Dict:
+    """ Executed in a child interpreter """
+    sys.path.insert(0, str(ROOT / "chalicelib"))
+    if args.varset:
+        os.environ["TF_VARSET_NAME"] = "aws-credentials"
+    if args.catalog:
+        os.environ["CATALOG_PATH"] = os.path.join(tempfile.mkdtemp(), "catalog.db")
+
+    import logging
+
+    import fake_aws
+    import fake_tfc
+
+    org = fake_tfc.FakeOrganization.generate(
+        os.environ["TF_ORG_NAME"], workspaces=args.workspaces, seeded=args.seeded
+    )
+    variables_before = len(org.variables)
+    app = fake_tfc.create_app(
+        org,
+        latency=args.latency,
+        jitter=args.jitter,
+        throttle=args.throttle,
+        rate_limit=args.server_rate_limit,
+        retry_after=args.retry_after,
+    )
+    if args.shard_size:
+        # workers are separate processes: they reach the fake over HTTP
+        url, stop = fake_tfc.serve(app)
+        os.environ["TF_API_URL"] = f"{url}/api/v2/"
+
+    import config as conf
+    import shards
+    import ssm
+    import terraform
+    from tracing import tracer
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.shard_size:
+        # spawned rather than forked: the server's threads are not fork-safe
+        shards.register_executor(
+            "process",
+            lambda: shards.ProcessExecutor(conf.SHARD_WORKERS, start_method="spawn"),
+        )
+    else:
+        terraform.asgi_app = app
+
+    stubs = fake_aws.install(
+        latency=args.aws_latency,
+        propagation=args.key_propagation,
+        parameters={f"/{os.environ['APP_NAME']}/benchmark": "true"},
+    )
+    stubs["iam"].seed(os.environ["TF_IAM_USERNAME"])
+
+    baseline_rss = rss_mb()
+    ts = timer()
+    ssm.load(force=True)
+    results = terraform.rotate_keys(dry_run=False)
+    wall = timer() - ts
+    requests = app.stats["requests"]
+
+    repeat = {}
+    if args.catalog or args.varset:
+        ts = timer()
+        terraform.rotate_keys(dry_run=False)
+        repeat = {
+            "repeat_wall_s": round(timer() - ts, 3),
+            "repeat_requests": app.stats["requests"] - requests,
+        }
+
+    writes = results.success_count + results.failure_count
+    spans = tracer.summary()
+    write_spans = [
+        v for k, v in spans.items() if k.startswith(("tfc POST", "tfc PATCH"))
+    ]
+    statuses = {k: v for k, v in app.stats.items() if k != "requests"}
+    iam_keys = stubs["iam"].keys[os.environ["TF_IAM_USERNAME"]]
+    newest = max(iam_keys, key=lambda x: x["CreateDate"])["AccessKeyId"]
+    stale = sum(
+        org.effective_variables(x["id"])
+        .get("AWS_ACCESS_KEY_ID", {})
+        .get("attributes", {})
+        .get("value")
+        != newest
+        for x in org.workspaces
+    )
+    if args.shard_size:
+        stop()
+
+    return {
+        "workspaces": args.workspaces,
+        "variables_before": variables_before,
+        "variables_after": len(org.variables),
+        "wall_s": round(wall, 3),
+        "requests": requests,
+        "throttled": sum(v for k, v in statuses.items() if k.endswith(" 429")),
+        "writes": writes,
+        "write_errors": results.failure_count,
+        "error_rate": round(results.failure_count / writes, 4) if writes else 0.0,
+        "peak_rss_mb": rss_mb(),
+        "rss_delta_mb": round(rss_mb() - baseline_rss, 1),
+        "write_p95_ms": max((x["p95_ms"] for x in write_spans), default=0.0),
+        "aws_calls": sum(sum(x.calls.values()) for x in stubs.values()),
+        "access_keys_after": len(iam_keys),
+        "stale_workspaces": stale,
+        "statuses": statuses,
+        **repeat,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workspaces", type=int, nargs="+", default=[10, 1000])
+    parser.add_argument(
+        "--seeded",
+        type=float,
+        default=0.5,
+        help="fraction of workspaces that already hold credentials",
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="TFC latency (s)")
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="extra random TFC latency (s)"
+    )
+    parser.add_argument(
+        "--throttle",
+        type=float,
+        default=0.0,
+        help="fraction of TFC requests rejected with a 429",
+    )
+    parser.add_argument(
+        "--server-rate-limit",
+        type=float,
+        default=0.0,
+        help="requests/s accepted by the fake TFC API before it returns 429s",
+    )
+    parser.add_argument("--retry-after", type=float, default=0.1)
+    parser.add_argument(
+        "--aws-latency", type=float, default=0.0, help="IAM/STS/SSM latency (s)"
+    )
+    parser.add_argument(
+        "--key-propagation",
+        type=float,
+        default=0.0,
+        help="seconds before a new key authenticates",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=100000,
+        help="TF_RATE_LIMIT for the run (default: effectively unlimited)",
+    )
+    parser.add_argument(
+        "--shard-size", type=int, default=0, help="SHARD_SIZE (default: disabled)"
+    )
+    parser.add_argument("--shard-workers", type=int, default=4)
+    parser.add_argument(
+        "--varset",
+        action="store_true",
+        help="deliver the credentials through a variable set",
+    )
+    parser.add_argument(
+        "--catalog",
+        action="store_true",
+        help="discover through a catalog and measure a second rotation",
+    )
+    parser.add_argument("--no-history", action="store_true")
+    parser.add_argument("--scenario", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        args.workspaces = args.workspaces[0]
+        print(json.dumps(run_scenario(args)))
+        return
+
+    env = {
+        **ENV,
+        **os.environ,
+        "TF_RATE_LIMIT": str(args.rate_limit),
+        "SHARD_SIZE": str(args.shard_size),
+        "SHARD_EXECUTOR": "process",
+        "SHARD_WORKERS": str(args.shard_workers),
+        "PYTHONDONTWRITEBYTECODE": "1",
+    }
+    options = [
+        f"--seeded={args.seeded}",
+        f"--latency={args.latency}",
+        f"--jitter={args.jitter}",
+        f"--throttle={args.throttle}",
+        f"--server-rate-limit={args.server_rate_limit}",
+        f"--retry-after={args.retry_after}",
+        f"--aws-latency={args.aws_latency}",
+        f"--key-propagation={args.key_propagation}",
+        f"--shard-size={args.shard_size}",
+        f"--shard-workers={args.shard_workers}",
+    ] + [f"--{x}" for x in ("varset", "catalog") if getattr(args, x)]
+
+    results: List[Dict] = []
+    for workspaces in args.workspaces:
+        output = subprocess.run(
+            [sys.executable, __file__, "--scenario", "--workspaces", str(workspaces)]
+            + options,
+            check=True,
+            capture_output=True,
+            text=True,
+            env=env,
+        )
+        results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+    repeated = args.catalog or args.varset
+    columns = COLUMNS + (["repeat_wall_s", "repeat_requests"] if repeated else [])
+    print("  ".join(f"{c:>12}" for c in columns))
+    for result in results:
+        print("  ".join(f"{result[c]:>12}" for c in columns))
+
+    if not args.no_history:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        with HISTORY.open("a") as f:
+            for result in results:
+                entry = {
+                    "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+                    "commit": commit or None,
+                    "options": options,
+                    **result,
+                }
+                f.write(json.dumps(entry) + "\n")
+
+
+if __name__ == "__main__":
+    main()
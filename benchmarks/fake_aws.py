@@ -0,0 +1,239 @@
+""" In-process stand-ins for the IAM, STS and SSM clients used by the rotation.
+
+    Each stub implements only the calls the rotation makes, returns responses
+    shaped like boto3's, optionally sleeps to simulate API latency and counts
+    its calls.
+
+    Example:
+        stubs = install(latency=0.02)  # replaces key_rotation.client and ssm.client
+"""
+
+import copy
+import itertools
+import secrets
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+OK = {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+
+class Stub:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def call(self, operation: str):
+        with self._lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeIAM(Stub):
+    """ Access keys per user, limited to two per user like IAM """
+
+    class exceptions:
+        class LimitExceededException(Exception):
+            pass
+
+        class NoSuchEntityException(Exception):
+            pass
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.keys: Dict[str, List[Dict]] = {}
+        self._ids = itertools.count()
+
+    def seed(self, user_name: str, age: timedelta = timedelta(days=1)):
+        """ Give a user one existing key of the given age """
+        self.keys[user_name] = [
+            {
+                "UserName": user_name,
+                "AccessKeyId": f"AKIA{next(self._ids):016d}",
+                "Status": "Active",
+                "CreateDate": datetime.now(timezone.utc) - age,
+            }
+        ]
+
+    def list_access_keys(self, UserName: str) -> Dict:
+        self.call("list_access_keys")
+        return {**OK, "AccessKeyMetadata": list(self.keys.get(UserName, []))}
+
+    def get_access_key_last_used(self, AccessKeyId: str) -> Dict:
+        self.call("get_access_key_last_used")
+        return {**OK, "AccessKeyLastUsed": {"ServiceName": "N/A", "Region": "N/A"}}
+
+    def create_access_key(self, UserName: str) -> Dict:
+        self.call("create_access_key")
+        keys = self.keys.setdefault(UserName, [])
+        if len(keys) >= 2:
+            raise self.exceptions.LimitExceededException(
+                "Cannot exceed quota for AccessKeysPerUser: 2"
+            )
+        key = {
+            "UserName": UserName,
+            "AccessKeyId": f"AKIA{next(self._ids):016d}",
+            "Status": "Active",
+            "CreateDate": datetime.now(timezone.utc),
+        }
+        keys.append(key)
+        return {**OK, "AccessKey": {**key, "SecretAccessKey": secrets.token_hex(20)}}
+
+    def update_access_key(self, UserName: str, AccessKeyId: str, Status: str) -> Dict:
+        self.call("update_access_key")
+        for key in self.keys.get(UserName, []):
+            if key["AccessKeyId"] == AccessKeyId:
+                key["Status"] = Status
+                return OK
+        raise self.exceptions.NoSuchEntityException(AccessKeyId)
+
+    def delete_access_key(self, UserName: str, AccessKeyId: str) -> Dict:
+        self.call("delete_access_key")
+        keys = self.keys.get(UserName, [])
+        if not any(x["AccessKeyId"] == AccessKeyId for x in keys):
+            raise self.exceptions.NoSuchEntityException(AccessKeyId)
+        self.keys[UserName] = [x for x in keys if x["AccessKeyId"] != AccessKeyId]
+        return OK
+
+
+class FakeSTS(Stub):
+    """ Callers are the function's own role, or a key of the fake IAM (see
+        signed_with). New keys are rejected until `propagation` seconds after
+        they were created, like IAM's eventual consistency. """
+
+    def __init__(
+        self,
+        account_id: str = "123456789012",
+        latency: float = 0.0,
+        iam: FakeIAM = None,
+        propagation: float = 0.0,
+    ):
+        super().__init__(latency)
+        self.account_id = account_id
+        self.iam = iam
+        self.propagation = propagation
+        self.access_key_id: Optional[str] = None
+
+    def signed_with(self, credentials: Dict[str, str]) -> "FakeSTS":
+        """ View of this stub signing with the given key; calls are counted here """
+        view = copy.copy(self)
+        view.access_key_id = credentials["AWS_ACCESS_KEY_ID"]
+        return view
+
+    def get_caller_identity(self) -> Dict:
+        self.call("get_caller_identity")
+        if self.access_key_id and self.iam is not None:
+            created = [
+                x["CreateDate"]
+                for keys in self.iam.keys.values()
+                for x in keys
+                if x["AccessKeyId"] == self.access_key_id
+            ]
+            age = (datetime.now(timezone.utc) - created[0]) if created else None
+            if age is None or age.total_seconds() < self.propagation:
+                raise ClientError(
+                    {
+                        "Error": {
+                            "Code": "InvalidClientTokenId",
+                            "Message": "The security token included in the request is invalid.",  # noqa
+                        }
+                    },
+                    "GetCallerIdentity",
+                )
+        return {**OK, "Account": self.account_id, "UserId": "AIDA", "Arn": "arn"}
+
+
+class FakeSSM(Stub):
+    """ Parameters by path, served through a get_parameters_by_path paginator,
+        and by name """
+
+    class exceptions:
+        class ParameterNotFound(Exception):
+            pass
+
+    def __init__(self, parameters: Dict[str, str] = None, latency: float = 0.0):
+        super().__init__(latency)
+        self.parameters = dict(parameters or {})
+
+    def get_paginator(self, operation: str) -> "FakeSSM":
+        assert operation == "get_parameters_by_path"
+        return self
+
+    def paginate(
+        self,
+        Path: str,
+        Recursive: bool = False,
+        PaginationConfig: Dict = None,
+        **kwargs,
+    ):
+        size = (PaginationConfig or {}).get("PageSize", 10)
+        names = sorted(
+            x
+            for x in self.parameters
+            if x.startswith(Path + "/") and (Recursive or "/" not in x[len(Path) + 1 :])
+        )
+        for i in range(0, max(len(names), 1), size):
+            self.call("get_parameters_by_path")
+            yield {
+                "Parameters": [
+                    {"Name": x, "Value": self.parameters[x]}
+                    for x in names[i : i + size]
+                ]
+            }
+
+    def get_parameters(self, Names: List[str], WithDecryption: bool = False) -> Dict:
+        self.call("get_parameters")
+        return {
+            **OK,
+            "Parameters": [
+                {"Name": x, "Value": self.parameters[x]}
+                for x in Names
+                if x in self.parameters
+            ],
+            "InvalidParameters": [x for x in Names if x not in self.parameters],
+        }
+
+    def put_parameter(
+        self, Name: str, Value: str, Type: str, Overwrite: bool = False, **kwargs
+    ) -> Dict:
+        self.call("put_parameter")
+        with self._lock:
+            self.parameters[Name] = Value
+        return {**OK, "Version": 1}
+
+    def delete_parameter(self, Name: str) -> Dict:
+        self.call("delete_parameter")
+        with self._lock:
+            if self.parameters.pop(Name, None) is None:
+                raise self.exceptions.ParameterNotFound(Name)
+        return OK
+
+
+def install(
+    latency: float = 0.0, parameters: Dict[str, str] = None, propagation: float = 0.0
+) -> Dict:
+    """ Route the rotation's AWS clients to stubs, with new keys becoming valid
+        `propagation` seconds after creation. Returns the stubs by service. """
+    import key_rotation
+    import ssm
+    from tracing import TracedClient
+
+    iam = FakeIAM(latency=latency)
+    stubs = {
+        "iam": iam,
+        "sts": FakeSTS(latency=latency, iam=iam, propagation=propagation),
+        "ssm": FakeSSM(parameters, latency=latency),
+    }
+    clients = {k: TracedClient(v, prefix=k) for k, v in stubs.items()}
+    key_rotation.client = clients.__getitem__
+    key_rotation.credentials_client = lambda service_name, credentials: TracedClient(
+        stubs[service_name].signed_with(credentials), prefix=f"{service_name}.probe"
+    )
+    ssm.client = lambda: stubs["ssm"]
+    return stubs
@@ -0,0 +1,570 @@
+""" In-memory stand-in for the parts of the Terraform Cloud JSON:API used by the
+    rotation, served as an ASGI app so it can be mounted in-process with
+    terraform.asgi_app.
+
+    Supports JSON:API pagination (page[number]/page[size], meta.pagination and
+    links), workspace search filters and sorting by latest-change-at (bumped by
+    variable writes), variable sets, a configurable per-request latency and
+    injected 429 responses with a Retry-After header. serve() exposes the app
+    over HTTP for clients in other processes.
+
+    Example:
+        org = FakeOrganization.generate("benchmark", workspaces=1000, seeded=0.5)
+        terraform.asgi_app = create_app(org, latency=0.005, throttle=0.01)
+"""
+
+import asyncio
+import itertools
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+MAX_PAGE_SIZE = 100
+PAGE_SIZE = 20
+
+""" Env variables written by the rotation, used to seed pre-existing variables """
+CREDENTIAL_KEYS = (
+    "AWS_ACCOUNT_ID",
+    "AWS_ACCESS_KEY_ID",
+    "AWS_SECRET_ACCESS_KEY",
+    "AWS_IAM_ROLE",
+    "LAST_ROTATED",
+)
+
+
+class FakeOrganization:
+    """ Workspaces and variables of a single organization """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.workspaces: List[Dict] = []
+        self.variables: Dict[str, Dict] = {}
+        self.workspace_variables: Dict[str, List[Dict]] = defaultdict(list)
+        self._variable_list: Optional[List[Dict]] = None
+        self._workspace_index: Dict[str, Dict] = {}
+        self.varsets: Dict[str, Dict] = {}
+        self._ids = itertools.count()
+
+    def __repr__(self):
+        return f"FakeOrganization({self.name}: {len(self.workspaces)} workspaces, {len(self.variables)} variables)"  # noqa
+
+    def next_id(self, prefix: str) -> str:
+        return f"{prefix}-{next(self._ids):016d}"
+
+    @classmethod
+    def generate(
+        cls, name: str, workspaces: int, seeded: float = 0.0, seed: int = 0
+    ) -> "FakeOrganization":
+        """ Create an organization with the given number of workspaces. A
+            `seeded` fraction of them already hold the credential variables,
+            so a rotation updates those and creates the rest. """
+        rng = random.Random(seed)
+        org = cls(name)
+        for i in range(workspaces):
+            workspace_id = org.next_id("ws")
+            org.workspaces.append(
+                {
+                    "id": workspace_id,
+                    "type": "workspaces",
+                    "attributes": {
+                        "name": f"workspace-{i:05d}",
+                        "tag-names": ["even" if i % 2 == 0 else "odd"],
+                        "latest-change-at": "2020-01-01T00:00:00.000Z",
+                    },
+                }
+            )
+            if rng.random() < seeded:
+                for key in CREDENTIAL_KEYS:
+                    org.add_variable(
+                        workspace_id,
+                        {
+                            "key": key,
+                            "value": "seed",
+                            "category": "env",
+                            "hcl": False,
+                            "sensitive": key.startswith("AWS_")
+                            and key != "AWS_IAM_ROLE",
+                            "description": "",
+                        },
+                    )
+        return org
+
+    def add_variable(self, workspace_id: str, attributes: Dict) -> Dict:
+        variable_id = self.next_id("var")
+        self.variables[variable_id] = {
+            "id": variable_id,
+            "type": "vars",
+            "attributes": dict(attributes),
+            "relationships": {
+                "configurable": {"data": {"id": workspace_id, "type": "workspaces"}}
+            },
+        }
+        self.workspace_variables[workspace_id].append(self.variables[variable_id])
+        self._variable_list = None
+        return self.variables[variable_id]
+
+    def delete_variable(self, variable_id: str) -> Optional[Dict]:
+        variable = self.variables.pop(variable_id, None)
+        if variable is not None:
+            workspace_id = variable["relationships"]["configurable"]["data"]["id"]
+            self.workspace_variables[workspace_id].remove(variable)
+            self._variable_list = None
+            self.touch(workspace_id)
+        return variable
+
+    def add_varset(self, attributes: Dict) -> Dict:
+        varset_id = self.next_id("varset")
+        self.varsets[varset_id] = {
+            "id": varset_id,
+            "attributes": dict(attributes),
+            "workspaces": set(),
+            "vars": {},
+        }
+        return self.varsets[varset_id]
+
+    def effective_variables(self, workspace_id: str) -> Dict[str, Dict]:
+        """ Variables a run of the workspace would see, by key: those of the
+            variable sets applied to it, overridden by its own """
+        variables = {}
+        for varset in self.varsets.values():
+            if (
+                varset["attributes"].get("global")
+                or workspace_id in varset["workspaces"]
+            ):
+                variables.update(
+                    {x["attributes"]["key"]: x for x in varset["vars"].values()}
+                )
+        variables.update(
+            {x["attributes"]["key"]: x for x in self.workspace_variables[workspace_id]}
+        )
+        return variables
+
+    def touch(self, workspace_id: str):
+        """ Bump a workspace's latest-change-at, as the API does when its
+            variables change """
+        if len(self._workspace_index) != len(self.workspaces):
+            self._workspace_index = {x["id"]: x for x in self.workspaces}
+        workspace = self._workspace_index.get(workspace_id)
+        if workspace is not None:
+            workspace["attributes"]["latest-change-at"] = time.strftime(
+                "%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()
+            )
+
+    def variable_list(self) -> List[Dict]:
+        """ Every variable, in creation order. Cached between writes, as listing is
+            paginated and each page would otherwise copy the whole collection. """
+        if self._variable_list is None:
+            self._variable_list = list(self.variables.values())
+        return self._variable_list
+
+    def workspace_ids(self) -> set:
+        return {x["id"] for x in self.workspaces}
+
+
+def render(variable: Dict) -> Dict:
+    """ Variable as returned by the API: sensitive values are never returned """
+    attrs = variable["attributes"]
+    if attrs.get("sensitive"):
+        return {**variable, "attributes": {**attrs, "value": None}}
+    return variable
+
+
+def render_varset(varset: Dict) -> Dict:
+    return {
+        "id": varset["id"],
+        "type": "varsets",
+        "attributes": varset["attributes"],
+        "relationships": {
+            "workspaces": {
+                "data": [
+                    {"id": x, "type": "workspaces"}
+                    for x in sorted(varset["workspaces"])
+                ]
+            },
+            "vars": {"data": [{"id": x, "type": "vars"} for x in varset["vars"]]},
+        },
+    }
+
+
+def paginate(
+    request: Request, items: List[Dict], transform: Callable = None
+) -> JSONResponse:
+    try:
+        number = max(int(request.query_params.get("page[number]", 1)), 1)
+        size = int(request.query_params.get("page[size]", PAGE_SIZE))
+    except ValueError:
+        return JSONResponse({"errors": [{"status": "400"}]}, status_code=400)
+
+    size = min(max(size, 1), MAX_PAGE_SIZE)
+    pages = max((len(items) + size - 1) // size, 1)
+    url = request.url
+    data = items[(number - 1) * size : number * size]
+    if transform is not None:
+        data = [transform(x) for x in data]
+
+    def link(n: Optional[int]) -> Optional[str]:
+        if n is None:
+            return None
+        return str(url.include_query_params(**{"page[number]": n, "page[size]": size}))
+
+    return JSONResponse(
+        {
+            "data": data,
+            "links": {
+                "self": link(number),
+                "first": link(1),
+                "prev": link(number - 1 if number > 1 else None),
+                "next": link(number + 1 if number < pages else None),
+                "last": link(pages),
+            },
+            "meta": {
+                "pagination": {
+                    "current-page": number,
+                    "prev-page": number - 1 if number > 1 else None,
+                    "next-page": number + 1 if number < pages else None,
+                    "total-pages": pages,
+                    "total-count": len(items),
+                }
+            },
+        }
+    )
+
+
+def create_app(
+    org: FakeOrganization,
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    throttle: float = 0.0,
+    rate_limit: float = 0.0,
+    retry_after: float = 0.1,
+    seed: int = 0,
+) -> Starlette:
+    """ ASGI app serving the organization.
+
+        Arguments:
+            latency {float} -- seconds added to every response
+            jitter {float} -- random extra latency, up to this many seconds
+            throttle {float} -- fraction of requests rejected with a 429, at random
+            rate_limit {float} -- requests/s allowed over a sliding 1s window,
+                                  like the API's per-token limit (0: unlimited)
+            retry_after {float} -- Retry-After sent with randomly throttled requests
+                                   (rate-limited ones get the time until the
+                                   window admits another request)
+
+        The app's `stats` attribute counts requests by endpoint and status.
+    """
+    rng = random.Random(seed)
+    stats: Counter = Counter()
+
+    async def delay():
+        wait = latency + (rng.random() * jitter if jitter else 0.0)
+        if wait:
+            await asyncio.sleep(wait)
+
+    window: List[float] = []
+
+    def limited() -> Optional[float]:
+        """ Seconds until the sliding window admits another request, if full """
+        if not rate_limit:
+            return None
+        now = time.monotonic()
+        while window and window[0] <= now - 1.0:
+            window.pop(0)
+        if len(window) >= rate_limit:
+            return window[0] + 1.0 - now
+        window.append(now)
+        return None
+
+    def throttled() -> Optional[JSONResponse]:
+        wait = retry_after if throttle and rng.random() < throttle else limited()
+        if wait is not None:
+            return JSONResponse(
+                {"errors": [{"status": "429", "title": "Too Many Requests"}]},
+                status_code=429,
+                headers={"Retry-After": f"{wait:.3f}"},
+            )
+        return None
+
+    def endpoint(name: str, handler):
+        async def wrapper(request: Request) -> JSONResponse:
+            await delay()
+            response = throttled() or await handler(request)
+            stats["requests"] += 1
+            stats[f"{name} {response.status_code}"] += 1
+            return response
+
+        return wrapper
+
+    async def list_workspaces(request: Request) -> JSONResponse:
+        if request.path_params["org"] != org.name:
+            return JSONResponse({"errors": [{"status": "404"}]}, status_code=404)
+
+        workspaces = org.workspaces
+        search = request.query_params.get("search[name]")
+        if search:
+            search = search.lower()
+            workspaces = [
+                x for x in workspaces if search in x["attributes"]["name"].lower()
+            ]
+        tags = request.query_params.get("search[tags]")
+        if tags:
+            wanted = set(tags.split(","))
+            workspaces = [
+                x for x in workspaces if wanted <= set(x["attributes"]["tag-names"])
+            ]
+        exclude_tags = request.query_params.get("search[exclude-tags]")
+        if exclude_tags:
+            unwanted = set(exclude_tags.split(","))
+            workspaces = [
+                x
+                for x in workspaces
+                if not unwanted & set(x["attributes"]["tag-names"])
+            ]
+        sort = request.query_params.get("sort")
+        if sort in ("latest-change-at", "-latest-change-at"):
+            workspaces = sorted(
+                workspaces,
+                key=lambda x: x["attributes"]["latest-change-at"],
+                reverse=sort.startswith("-"),
+            )
+        return paginate(request, workspaces)
+
+    async def list_variables(request: Request) -> JSONResponse:
+        if request.query_params.get("filter[organization][name]", org.name) != org.name:
+            return paginate(request, [])
+        return paginate(request, org.variable_list(), transform=render)
+
+    async def list_workspace_variables(request: Request) -> JSONResponse:
+        variables = org.workspace_variables.get(request.path_params["workspace_id"], [])
+        return JSONResponse({"data": [render(x) for x in variables]})
+
+    async def create_variable(request: Request) -> JSONResponse:
+        data = (await request.json())["data"]
+        workspace_id = data["relationships"]["workspace"]["data"]["id"]
+        if workspace_id not in workspace_ids:
+            return JSONResponse({"errors": [{"status": "404"}]}, status_code=404)
+        variable = org.add_variable(workspace_id, data["attributes"])
+        org.touch(workspace_id)
+        return JSONResponse({"data": render(variable)}, status_code=201)
+
+    async def update_variable(request: Request) -> JSONResponse:
+        variable = org.variables.get(request.path_params["variable_id"])
+        if variable is None:
+            return JSONResponse({"errors": [{"status": "404"}]}, status_code=404)
+        data = (await request.json())["data"]
+        variable["attributes"].update(data["attributes"])
+        org.touch(variable["relationships"]["configurable"]["data"]["id"])
+        return JSONResponse({"data": render(variable)})
+
+    async def delete_variable(request: Request) -> Response:
+        if org.delete_variable(request.path_params["variable_id"]) is None:
+            return JSONResponse({"errors": [{"status": "404"}]}, status_code=404)
+        return Response(status_code=204)
+
+    async def list_varsets(request: Request) -> JSONResponse:
+        if request.path_params["org"] != org.name:
+            return JSONResponse({"errors": [{"status": "404"}]}, status_code=404)
+        return paginate(request, list(org.varsets.values()), transform=render_varset)
+
+    async def create_varset(request: Request) -> JSONResponse:
+        data = (await request.json())["data"]
+        name = data["attributes"]["name"]
+        if any(x["attributes"]["name"] == name for x in org.varsets.values()):
+            return JSONResponse({"errors": [{"status": "422"}]}, status_code=422)
+        varset = org.add_varset(data["attributes"])
+        return JSONResponse({"data": render_varset(varset)}, status_code=201)
+
+    def get_varset(request: Request) -> Optional[Dict]:
+        return org.varsets.get(request.path_params["varset_id"])
+
+    async def list_varset_variables(request: Request) -> JSONResponse:
+        varset = get_varset(request)
+        if varset is None:
+            return JSONResponse({"errors": [{"status": "404"}]}, status_code=404)
+        return paginate(request, list(varset["vars"].values()), transform=render)
+
+    async def create_varset_variable(request: Request) -> JSONResponse:
+        varset = get_varset(request)
+        if varset is None:
+            return JSONResponse({"errors": [{"status": "404"}]}, status_code=404)
+        data = (await request.json())["data"]
+        variable_id = org.next_id("var")
+        varset["vars"][variable_id] = {
+            "id": variable_id,
+            "type": "vars",
+            "attributes": dict(data["attributes"]),
+            "relationships": {
+                "varset": {"data": {"id": varset["id"], "type": "varsets"}}
+            },
+        }
+        return JSONResponse(
+            {"data": render(varset["vars"][variable_id])}, status_code=201
+        )
+
+    async def update_varset_variable(request: Request) -> JSONResponse:
+        varset = get_varset(request)
+        variable = (
+            varset["vars"].get(request.path_params["variable_id"]) if varset else None
+        )
+        if variable is None:
+            return JSONResponse({"errors": [{"status": "404"}]}, status_code=404)
+        data = (await request.json())["data"]
+        variable["attributes"].update(data["attributes"])
+        return JSONResponse({"data": render(variable)})
+
+    async def attach_varset(request: Request) -> Response:
+        varset = get_varset(request)
+        if varset is None:
+            return JSONResponse({"errors": [{"status": "404"}]}, status_code=404)
+        ids = [x["id"] for x in (await request.json())["data"]]
+        if any(x not in workspace_ids for x in ids):
+            return JSONResponse({"errors": [{"status": "404"}]}, status_code=404)
+        varset["workspaces"].update(ids)
+        return Response(status_code=204)
+
+    workspace_ids = org.workspace_ids()
+    app = Starlette(
+        routes=[
+            Route(
+                "/api/v2/organizations/{org}/workspaces",
+                endpoint("list_workspaces", list_workspaces),
+            ),
+            Route("/api/v2/vars/", endpoint("list_variables", list_variables)),
+            Route(
+                "/api/v2/vars/",
+                endpoint("create_variable", create_variable),
+                methods=["POST"],
+            ),
+            Route(
+                "/api/v2/vars/{variable_id}",
+                endpoint("update_variable", update_variable),
+                methods=["PATCH"],
+            ),
+            Route(
+                "/api/v2/workspaces/{workspace_id}/vars",
+                endpoint("list_workspace_variables", list_workspace_variables),
+            ),
+            Route(
+                "/api/v2/vars/{variable_id}",
+                endpoint("delete_variable", delete_variable),
+                methods=["DELETE"],
+            ),
+            Route(
+                "/api/v2/organizations/{org}/varsets",
+                endpoint("list_varsets", list_varsets),
+            ),
+            Route(
+                "/api/v2/organizations/{org}/varsets",
+                endpoint("create_varset", create_varset),
+                methods=["POST"],
+            ),
+            Route(
+                "/api/v2/varsets/{varset_id}/relationships/vars",
+                endpoint("list_varset_variables", list_varset_variables),
+            ),
+            Route(
+                "/api/v2/varsets/{varset_id}/relationships/vars",
+                endpoint("create_varset_variable", create_varset_variable),
+                methods=["POST"],
+            ),
+            Route(
+                "/api/v2/varsets/{varset_id}/relationships/vars/{variable_id}",
+                endpoint("update_varset_variable", update_varset_variable),
+                methods=["PATCH"],
+            ),
+            Route(
+                "/api/v2/varsets/{varset_id}/relationships/workspaces",
+                endpoint("attach_varset", attach_varset),
+                methods=["POST"],
+            ),
+        ]
+    )
+    app.stats = stats
+    return app
+
+
+def serve(app: Starlette) -> Tuple[str, Callable[[], None]]:
+    """ Serve the app over HTTP on localhost, so that other processes (such as
+        shard workers) reach the same organization. Requests are handled by a
+        thread per connection and run on an event loop in a background thread.
+
+        Returns:
+            Tuple[str, Callable] -- the base URL, and a function stopping the server
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    async def call(method: str, target: str, headers: List, body: bytes):
+        path, _, query = target.partition("?")
+        scope = {
+            "type": "http",
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": [(k.lower().encode(), v.encode()) for k, v in headers],
+            "server": server.server_address,
+        }
+        response: Dict = {"body": b""}
+
+        async def receive() -> Dict:
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message: Dict):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = message.get("headers", [])
+            elif message["type"] == "http.response.body":
+                response["body"] += message.get("body", b"")
+
+        await app(scope, receive, send)
+        return response
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def handle_request(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            response = asyncio.run_coroutine_threadsafe(
+                call(self.command, self.path, list(self.headers.items()), body), loop
+            ).result()
+
+            self.send_response(response["status"])
+            for key, value in response["headers"]:
+                if key.lower() != b"content-length":
+                    self.send_header(key.decode(), value.decode())
+            self.send_header("Content-Length", str(len(response["body"])))
+            self.end_headers()
+            self.wfile.write(response["body"])
+
+        do_GET = do_POST = do_PATCH = do_DELETE = handle_request
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+        request_queue_size = 1024  # clients open many connections at once
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+        loop.call_soon_threadsafe(loop.stop)
+
+    host, port = server.server_address
+    return f"http://{host}:{port}", stop
@@ -0,0 +1,85 @@
+""" Compare logging throughput of the synchronous console handler with the
+    queued handler, which formats and writes records on a background thread.
+
+    For each mode, records are logged in a tight loop with the JSON formatter and
+    written to os.devnull. Two rates are reported:
+        emit: records/s as seen by the caller, i.e. time spent on the request path
+        total: records/s until every record has been written (after flush)
+
+    Usage:
+        python benchmarks/log_throughput.py --records 50000 --repeat 3
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+from pathlib import Path
+from timeit import default_timer as timer
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT / "chalicelib"), str(ROOT)]
+
+os.environ.setdefault("APP_NAME", "key-rotation")
+os.environ.setdefault("TF_TOKEN", "benchmark")
+os.environ.setdefault("TF_ORG_NAME", "benchmark")
+os.environ.setdefault("TF_IAM_USERNAME", "benchmark")
+
+import logging  # noqa
+
+import loggers  # noqa
+
+
+def measure(queued: bool, records: int) -> Dict[str, float]:
+    """ Log records through the configured handler, returning records/s """
+    stderr = sys.stderr
+    with open(os.devnull, "w") as devnull:
+        sys.stderr = devnull  # the console handler writes to sys.stderr
+        try:
+            loggers.config(level=20, formatter="json", queued=queued)
+        finally:
+            sys.stderr = stderr
+
+        logger = logging.getLogger("benchmark")
+        ts = timer()
+        for i in range(records):
+            logger.info(
+                f"(benchmark) successfully rotated keys for workspace: ws-{i}",
+                extra={"workspace_name": f"ws-{i}", "succeeded": 1},
+            )
+        emitted = timer() - ts
+        loggers.flush()
+        total = timer() - ts
+        loggers.stop_listener()
+
+    return {"emit": records / emitted, "total": records / total}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results: Dict[str, Dict[str, float]] = {}
+    for mode, queued in [("sync", False), ("queued", True)]:
+        runs: List[Dict[str, float]] = [
+            measure(queued, args.records) for _ in range(args.repeat)
+        ]
+        results[mode] = {
+            k: round(statistics.median(x[k] for x in runs)) for k in ("emit", "total")
+        }
+
+    print(f"{'mode':<8} {'emit rec/s':>12} {'total rec/s':>12}")
+    for mode, rates in results.items():
+        print(f"{mode:<8} {rates['emit']:>12} {rates['total']:>12}")
+
+    speedup = results["queued"]["emit"] / results["sync"]["emit"]
+    print(f"caller-side speedup: {speedup:.2f}x")
+    print(json.dumps({"records": args.records, **results}))
+
+
+if __name__ == "__main__":
+    main()
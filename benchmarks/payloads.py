@@ -0,0 +1,113 @@
+""" Compare building variable write bodies per variable (TFVar.payload() followed
+    by json.dumps, as httpx does for json=) with rendering them from the shared
+    payload templates of a WriteBatch.
+
+    Reported per engine, for the given number of variables:
+        serialize_s: best time to build every request body
+        peak_kb: peak traced memory while building the bodies
+        transient_kb: peak minus the bodies themselves (intermediate objects)
+
+    Usage:
+        python benchmarks/payloads.py --variables 10000 --repeat 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+from pathlib import Path
+from timeit import default_timer as timer
+from typing import Callable, Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "chalicelib"))
+
+for k, v in {
+    "APP_NAME": "key-rotation",
+    "TF_TOKEN": "benchmark",
+    "TF_ORG_NAME": "benchmark",
+    "TF_IAM_USERNAME": "benchmark",
+}.items():
+    os.environ.setdefault(k, v)
+
+import terraform  # noqa
+from key_rotation import CREDENTIAL_DESCRIPTIONS  # noqa
+
+
+def make_tfvars(n: int) -> List:
+    """ n writes over the rotated keys, half updates and half creates """
+    keys = list(CREDENTIAL_DESCRIPTIONS)
+    tfvars = []
+    for i in range(n):
+        key = keys[i % len(keys)]
+        update = (i // len(keys)) % 2 == 0
+        tfvars.append(
+            (
+                f"workspace-{i // len(keys):05d}",
+                terraform.TFVar(
+                    key=key,
+                    value=f"value-{i:08d}",
+                    category=terraform.VarCategory.ENV,
+                    hcl=False,
+                    sensitive=key not in terraform.NON_SENSITIVE_KEYS,
+                    description=CREDENTIAL_DESCRIPTIONS[key],
+                    variable_id=f"var-{i:016d}" if update else None,
+                    workspace_id=None if update else f"ws-{i // len(keys):016d}",
+                ),
+            )
+        )
+    return tfvars
+
+
+def per_variable(tfvars: List) -> List[bytes]:
+    return [json.dumps(var.payload()).encode("utf-8") for _, var in tfvars]
+
+
+def templated(tfvars: List) -> List[bytes]:
+    batch = terraform.WriteBatch(tfvars)
+    return [batch.body(i) for i in range(len(batch))]
+
+
+ENGINES: Dict[str, Callable] = {"payload": per_variable, "template": templated}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--variables", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    tfvars = make_tfvars(args.variables)
+    bodies = {name: engine(tfvars) for name, engine in ENGINES.items()}
+    if [json.loads(x) for x in bodies["payload"]] != [
+        json.loads(x) for x in bodies["template"]
+    ]:
+        raise SystemExit("engines produced different payloads")
+
+    columns = ["engine", "serialize_s", "peak_kb", "transient_kb"]
+    print("  ".join(f"{c:>12}" for c in columns))
+    for name, engine in ENGINES.items():
+        best = float("inf")
+        for _ in range(args.repeat):
+            ts = timer()
+            engine(tfvars)
+            best = min(best, timer() - ts)
+
+        tracemalloc.start()
+        result = engine(tfvars)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+
+        row = {
+            "engine": name,
+            "serialize_s": round(best, 4),
+            "peak_kb": round(peak / 1024),
+            "transient_kb": round((peak - current) / 1024),
+        }
+        print("  ".join(f"{row[c]:>12}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+""" Per-record cost of util.iterables.query over JSON:API variable records.
+
+    Engines:
+        legacy: the previous query(), which re-split the path on every call
+        query: query() on top of the cached compiled accessor
+        compiled: an accessor from compile_query() applied record by record
+        batch: query_many(), one path over every record in a single pass
+
+    Every engine must return the same values; reported per engine:
+        total_s: best time to query every record
+        per_record_ns: total_s / records
+
+    Usage:
+        python benchmarks/query.py --records 100000 --repeat 5
+"""
+
+import argparse
+import sys
+from pathlib import Path
+from timeit import default_timer as timer
+from typing import Callable, Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "chalicelib"))
+
+from util.iterables import compile_query, query, query_many  # noqa
+
+PATH = "relationships.configurable.data.id"
+
+
+def legacy_query(path: str, data: dict, sep: str = "."):
+    """ query() as it was before paths were compiled """
+    elements = path.split(sep)
+    for e in elements:
+        if issubclass(type(data), list) and len(data) > 0:
+            try:
+                data = data[int(e)]
+            except ValueError:
+                data = data[-1]
+        elif issubclass(type(data), dict):
+            data = data.get(e, {})
+
+    return data if data else None
+
+
+def make_records(n: int) -> List[Dict]:
+    """ Variable resources shaped like the TFC API's, a tenth of them without a
+        configurable relationship """
+    return [
+        {
+            "id": f"var-{i:016d}",
+            "type": "vars",
+            "attributes": {"key": "AWS_ACCESS_KEY_ID", "category": "env"},
+            "relationships": {
+                "configurable": {
+                    "data": {"id": f"ws-{i // 5:016d}", "type": "workspaces"}
+                }
+            }
+            if i % 10
+            else {},
+        }
+        for i in range(n)
+    ]
+
+
+def by_legacy(records: List[Dict]) -> List:
+    return [legacy_query(PATH, data=x) for x in records]
+
+
+def by_query(records: List[Dict]) -> List:
+    return [query(PATH, data=x) for x in records]
+
+
+def by_compiled(records: List[Dict]) -> List:
+    accessor = compile_query(PATH)
+    return [accessor(x) for x in records]
+
+
+def by_batch(records: List[Dict]) -> List:
+    return query_many(PATH, records)
+
+
+ENGINES: Dict[str, Callable] = {
+    "legacy": by_legacy,
+    "query": by_query,
+    "compiled": by_compiled,
+    "batch": by_batch,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    expected = by_legacy(records)
+    for name, engine in ENGINES.items():
+        if engine(records) != expected:
+            raise SystemExit(f"{name} returned different values")
+
+    columns = ["engine", "total_s", "per_record_ns"]
+    print("  ".join(f"{c:>14}" for c in columns))
+    for name, engine in ENGINES.items():
+        best = float("inf")
+        for _ in range(args.repeat):
+            ts = timer()
+            engine(records)
+            best = min(best, timer() - ts)
+        row = {
+            "engine": name,
+            "total_s": round(best, 4),
+            "per_record_ns": round(best / args.records * 1e9),
+        }
+        print("  ".join(f"{row[c]:>14}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
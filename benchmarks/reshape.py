@@ -0,0 +1,280 @@
+""" Benchmark building the rotation plan with pandas (the legacy path) versus the
+    dict-backed VariableIndex.
+
+    Each engine runs in a fresh interpreter so import time and peak RSS are not
+    polluted by the other. Both engines must produce the same create/update
+    decisions.
+
+    Usage:
+        python benchmarks/reshape.py --workspaces 2000 --vars-per-workspace 10
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+from pathlib import Path
+from timeit import default_timer as timer
+from typing import Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "chalicelib"))
+
+for k, v in {
+    "APP_NAME": "key-rotation",
+    "TF_TOKEN": "benchmark",
+    "TF_ORG_NAME": "benchmark",
+    "TF_IAM_USERNAME": "benchmark",
+    "AWS_DEFAULT_REGION": "us-east-1",
+}.items():
+    os.environ.setdefault(k, v)
+
+from util.iterables import make_hash  # noqa
+
+CREDENTIALS: Dict[str, str] = {
+    "AWS_ACCOUNT_ID": "123456789012",
+    "AWS_ACCESS_KEY_ID": "AKIAEXAMPLE",
+    "AWS_SECRET_ACCESS_KEY": "secret",
+    "AWS_IAM_ROLE": "benchmark",
+    "LAST_ROTATED": "2020-01-01",
+}
+
+DESCRIPTIONS: Dict[str, str] = {k: f"{k} description" for k in CREDENTIALS}
+
+
+def make_records(n_workspaces: int, vars_per_workspace: int) -> Tuple[List, List]:
+    """ Synthetic JSON:API workspace and variable resources. Roughly half of the
+        workspaces already have the credential variables. """
+    workspaces = []
+    variables = []
+    keys = list(CREDENTIALS)
+    for i in range(n_workspaces):
+        ws_id = f"ws-{i:08d}"
+        workspaces.append(
+            {
+                "id": ws_id,
+                "type": "workspaces",
+                "attributes": {
+                    "name": f"workspace-{i:08d}",
+                    "auto-apply": False,
+                    "vcs-repo-identifier": None,
+                    "working-directory": "",
+                    "allow-destroy-plan": True,
+                    "terraform-version": "0.12.24",
+                    "locked": False,
+                    "latest-change-at": "2020-04-01T00:00:00.000Z",
+                    "created-at": "2020-01-01T00:00:00.000Z",
+                },
+            }
+        )
+        existing = keys if i % 2 == 0 else []
+        other = [f"VAR_{j}" for j in range(max(vars_per_workspace - len(existing), 0))]
+        for j, key in enumerate(existing + other):
+            variables.append(
+                {
+                    "id": f"var-{i:08d}{j:04d}",
+                    "type": "vars",
+                    "attributes": {
+                        "key": key,
+                        "value": None,
+                        "sensitive": True,
+                        "category": "env" if j % 3 else "terraform",
+                        "hcl": False,
+                        "created-at": "2020-01-01T00:00:00.000Z",
+                        "description": "",
+                    },
+                    "relationships": {
+                        "configurable": {"data": {"id": ws_id, "type": "workspaces"}}
+                    },
+                }
+            )
+    return workspaces, variables
+
+
+def pandas_plan(workspace_records: List, variable_records: List) -> List[Tuple]:
+    """ The DataFrame based reshape previously used by get_workspaces(),
+        get_variables() and rotate_keys() """
+    import pandas as pd
+
+    workspaces = pd.DataFrame(workspace_records)
+    attrs = pd.DataFrame(workspaces.attributes.values.tolist())
+    workspaces = (
+        workspaces.loc[:, ["id"]]
+        .join(attrs.loc[:, ["name", "latest-change-at", "created-at"]])
+        .rename(columns={"id": "workspace_id", "name": "workspace_name"})
+        .set_index("workspace_id")
+    )
+
+    variables = pd.DataFrame(variable_records)
+    attrs = pd.DataFrame(variables.attributes.values.tolist())
+    relationships = pd.DataFrame(
+        [x["configurable"]["data"] for x in variables.relationships.values.tolist()]
+    )
+    variables = (
+        variables.loc[:, ["id"]]
+        .join(relationships.id.rename("workspace_id"))
+        .join(attrs)
+    )
+    variables = (
+        variables.set_index("workspace_id")
+        .join(workspaces.loc[:, ["workspace_name"]])
+        .rename(columns={"id": "variable_id"})
+        .reset_index()
+        .set_index(["workspace_name", "key"])
+        .loc[
+            :,
+            [
+                "value",
+                "sensitive",
+                "category",
+                "hcl",
+                "workspace_id",
+                "variable_id",
+                "created-at",
+                "description",
+            ],
+        ]
+    )
+
+    credentials = CREDENTIALS
+    var_levels = DESCRIPTIONS
+    workspaces = (
+        workspaces.reset_index().set_index("workspace_name").loc[:, "workspace_id"]
+    )
+    envs = variables.loc[variables.category == "env"].drop(columns=["created-at"])
+    expanded_index = pd.MultiIndex.from_product(
+        [workspaces.index, list(var_levels.keys())], names=["workspace_name", "key"]
+    )
+    envs = envs.reindex(index=expanded_index)
+    creds = (
+        pd.DataFrame(data=credentials, index=envs.index.levels[0])
+        .reset_index()
+        .melt(id_vars="workspace_name", var_name="key")
+        .set_index(["workspace_name", "key"])
+        .sort_index()
+    )
+    envs = creds.combine_first(envs)
+    df = workspaces.reindex(expanded_index).to_frame().reset_index(level=1)
+    df["workspace_id"] = workspaces
+    df = df.set_index("key", append=True)
+    envs["workspace_id"] = df
+    envs = envs.reset_index(level=1, drop=False).set_index(
+        "key", append=True, drop=False
+    )
+    envs.description = envs.key.replace(var_levels)
+    envs.value = envs.key.replace(credentials)
+    envs = envs.drop(columns=["key"])
+    envs["category"] = "env"
+    envs["hcl"] = False
+    envs["sensitive"] = True
+    envs.loc[pd.IndexSlice[:, "AWS_IAM_ROLE"], "sensitive"] = False
+    envs.loc[pd.IndexSlice[:, "LAST_ROTATED"], "sensitive"] = False
+    envs.loc[envs.variable_id.notnull(), "workspace_id"] = None
+    envs.loc[envs.variable_id.isna(), "variable_id"] = None
+    envs = envs.loc[envs.variable_id.notnull() | envs.workspace_id.notnull(), :]
+
+    plan = []
+    for workspace_name, df in envs.groupby(level=0):
+        for r in df.reset_index(level=1).to_dict(orient="records"):
+            plan.append(
+                (
+                    workspace_name,
+                    r["key"],
+                    r["variable_id"],
+                    r["workspace_id"],
+                    bool(r["sensitive"]),
+                )
+            )
+    return plan
+
+
+def native_plan(workspace_records: List, variable_records: List) -> List[Tuple]:
+    import terraform
+    from models import Variable, VariableIndex, Workspace
+
+    workspaces = [Workspace.from_record(r) for r in workspace_records]
+    variables = VariableIndex(
+        (Variable.from_record(r) for r in variable_records),
+        category=terraform.VarCategory.ENV.value,
+    )
+    tfvars = terraform.plan_writes(workspaces, variables, CREDENTIALS, DESCRIPTIONS)
+    return [
+        (name, v.key, v.variable_id, v.workspace_id, v.sensitive) for name, v in tfvars
+    ]
+
+
+ENGINES = {"pandas": pandas_plan, "native": native_plan}
+IMPORTS = {"pandas": "pandas", "native": "terraform"}
+
+
+def run_engine(engine: str, n_workspaces: int, vars_per_workspace: int) -> Dict:
+    """ Executed in a child interpreter """
+    import importlib
+
+    ts = timer()
+    importlib.import_module(IMPORTS[engine])
+    import_time = timer() - ts
+
+    workspace_records, variable_records = make_records(n_workspaces, vars_per_workspace)
+
+    ts = timer()
+    plan = ENGINES[engine](workspace_records, variable_records)
+    reshape_time = timer() - ts
+
+    return {
+        "engine": engine,
+        "import_s": round(import_time, 4),
+        "reshape_s": round(reshape_time, 4),
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "creates": sum(1 for x in plan if x[2] is None),
+        "updates": sum(1 for x in plan if x[2] is not None),
+        "plan_hash": make_hash(sorted(plan)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workspaces", type=int, default=2000)
+    parser.add_argument("--vars-per-workspace", type=int, default=10)
+    parser.add_argument("--engine", choices=list(ENGINES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.engine:
+        result = run_engine(args.engine, args.workspaces, args.vars_per_workspace)
+        print(json.dumps(result))
+        return
+
+    results = []
+    for engine in ENGINES:
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--engine",
+                engine,
+                "--workspaces",
+                str(args.workspaces),
+                "--vars-per-workspace",
+                str(args.vars_per_workspace),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+    columns = ["engine", "import_s", "reshape_s", "peak_rss_mb", "creates", "updates"]
+    print("  ".join(f"{c:>12}" for c in columns))
+    for result in results:
+        print("  ".join(f"{result[c]:>12}" for c in columns))
+
+    if len({r["plan_hash"] for r in results}) != 1:
+        raise SystemExit("engines produced different plans")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+""" Measure cold-start import cost of the Chalice handler with `python -X importtime`.
+
+    Two stages are measured, each in a fresh interpreter:
+        import: `import app`, i.e. what Lambda pays before the first invocation
+        handler: `import app` plus the modules imported on the first invocation
+                 (loggers, terraform), excluding network calls
+
+    Results are appended to a JSON lines history file so cold-start latency can
+    be tracked across commits.
+
+    Usage:
+        python benchmarks/startup.py --repeat 5 --top 15
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+
+STAGES: Dict[str, List[str]] = {
+    "import": ["app"],
+    "handler": ["app", "loggers", "terraform"],
+}
+
+ENV: Dict[str, str] = {
+    "APP_NAME": "key-rotation",
+    "TF_TOKEN": "benchmark",
+    "TF_ORG_NAME": "benchmark",
+    "TF_IAM_USERNAME": "benchmark",
+    "AWS_DEFAULT_REGION": "us-east-1",
+}
+
+
+def importtime(statement: str) -> List[Tuple[int, int, str]]:
+    """ Run a statement in a fresh interpreter and parse -X importtime output into
+        (self_us, cumulative_us, module) tuples """
+    env = {
+        **ENV,
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join([str(ROOT / "chalicelib"), str(ROOT)]),
+        "PYTHONDONTWRITEBYTECODE": "",
+    }
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=str(ROOT),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return rows
+
+
+def total(rows: List[Tuple[int, int, str]], modules: List[str]) -> int:
+    """ Cumulative time of the given modules, excluding interpreter startup """
+    return sum(cumulative for _, cumulative, name in rows if name.lstrip() in modules)
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "log", "-1", "--pretty=%h"],
+            cwd=str(ROOT),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument(
+        "--history", default=str(ROOT / "benchmarks" / "startup-history.jsonl")
+    )
+    args = parser.parse_args()
+
+    record: Dict = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "commit": commit(),
+        "python": sys.version.split()[0],
+    }
+
+    for stage, modules in STAGES.items():
+        statement = "; ".join(f"import {m}" for m in modules)
+        totals = []
+        rows: List[Tuple[int, int, str]] = []
+        for _ in range(args.repeat):
+            rows = importtime(statement)
+            totals.append(total(rows, modules))
+
+        record[f"{stage}_ms"] = round(statistics.median(totals) / 1000, 1)
+
+        print(f"{stage}: median {record[f'{stage}_ms']}ms over {args.repeat} runs")
+        slowest = sorted(rows, key=lambda x: x[1], reverse=True)[: args.top]
+        for _, cumulative, name in slowest:
+            print(f"  {cumulative / 1000:>9.1f}ms  {name.strip()}")
+
+    with open(args.history, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    print(f"appended results to {args.history}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+""" Rotate the access keys of many IAM users in one pass.
+
+    IAM calls (creating and deleting keys) run concurrently on a thread pool.
+    The resulting variable writes for every user are planned together and sent
+    in a single fan-out, so each user's credentials only reach the workspaces
+    mapped to that user.
+
+    Each user's progress is journaled as in a single-user rotation, so a batch
+    that stops before the deadline is resumed by the next invocation. Batches
+    only write workspace variables: CREDENTIAL_SINKS, TF_VARSET_NAME and
+    SHARD_SIZE are not supported.
+"""
+
+import asyncio
+import json
+import logging
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import IO, Dict, Iterable, List, Optional
+
+import cache
+import config as conf
+import readiness
+import terraform
+from changeset import Changeset
+from journal import JournalStore, RotationJournal, get_store
+from key_rotation import RotationManager
+from models import VariableIndex, Workspace
+from selection import WorkspaceSelector
+from terraform import VarCategory, WriteResults
+from util.timing import Deadline
+
+""" Settings a batch rotation cannot honour """
+UNSUPPORTED = ("CREDENTIAL_SINKS", "TF_VARSET_NAME", "SHARD_SIZE")
+
+logger = logging.getLogger(__name__)
+
+
+class UserRotation:
+    """ Rotation state of a single IAM user within a batch """
+
+    __slots__ = (
+        "iam_username",
+        "selector",
+        "manager",
+        "journal",
+        "resuming",
+        "workspaces",
+        "error",
+    )
+
+    def __init__(
+        self,
+        iam_username: str,
+        selector: WorkspaceSelector,
+        store: Optional[JournalStore] = None,
+    ):
+        self.iam_username = iam_username
+        self.selector = selector
+        self.manager = RotationManager(iam_username)
+        self.journal = RotationJournal(store, iam_username)
+        self.resuming = False
+        self.workspaces: List[Workspace] = []
+        self.error: Optional[Exception] = None
+
+    def __repr__(self):
+        return f"{self.iam_username}: {self.selector}"
+
+    @property
+    def pending(self) -> List[Workspace]:
+        """ Workspaces the journal has not completed """
+        return [
+            x for x in self.workspaces if x.workspace_name not in self.journal.completed
+        ]
+
+    def due(self, max_age: timedelta) -> bool:
+        """ Whether to rotate: an earlier rotation is unfinished (it is resumed
+            with the key it created), or the current key is older than max_age """
+        self.journal = RotationJournal.load(self.journal.store, self.iam_username)
+        if self.journal.started:
+            if self.manager.resume(
+                self.journal.credentials, self.journal.previous_key_id
+            ):
+                logger.info(
+                    f"({self.iam_username}) resuming rotation to {self.journal.key_id}: {len(self.journal.completed)} workspaces already complete"  # noqa
+                )
+                self.resuming = True
+                return True
+
+            logger.warning(
+                f"({self.iam_username}) discarding journal: key {self.journal.key_id} no longer exists"  # noqa
+            )
+            self.journal.finish()
+        return self.manager.needs_rotation(max_age)
+
+
+class BatchJournal:
+    """ Records completed workspaces in the journal of the user they belong to,
+        so write_journaled can write every user's variables in one fan-out """
+
+    iam_username = "batch"
+
+    def __init__(self, rotations: List[UserRotation]):
+        self.journals = {
+            x.workspace_name: rotation.journal
+            for rotation in rotations
+            for x in rotation.workspaces
+        }
+
+    def complete(self, workspace_names: Iterable[str]):
+        by_journal: Dict[RotationJournal, List[str]] = defaultdict(list)
+        for name in workspace_names:
+            by_journal[self.journals[name]].append(name)
+        for journal, names in by_journal.items():
+            journal.complete(names)
+
+
+def check_supported():
+    """ Fail before anything is created if a setting a batch rotation cannot
+        honour is set """
+    unsupported = [x for x in UNSUPPORTED if getattr(conf, x)]
+    if unsupported:
+        raise ValueError(
+            f"batch rotations (TF_IAM_USER_MAP) do not support {', '.join(unsupported)}"
+        )
+
+
+def user_selectors(mapping: Dict = None) -> Dict[str, WorkspaceSelector]:
+    """ Build workspace selectors from a user -> workspaces mapping (default:
+        TF_IAM_USER_MAP). Each value is either a list of workspace name patterns
+        or a dict of WorkspaceSelector arguments.
+
+        Example:
+            {
+                "ci-deployer": ["app-*", "re:^api-"],
+                "data-deployer": {"tags": ["data"], "exclude": ["data-sandbox"]}
+            }
+    """
+    mapping = conf.TF_IAM_USER_MAP if mapping is None else mapping
+    selectors = {}
+    for iam_username, spec in mapping.items():
+        if isinstance(spec, dict):
+            selectors[iam_username] = WorkspaceSelector(**spec)
+        else:
+            selectors[iam_username] = WorkspaceSelector(include=spec)
+    return selectors
+
+
+def assign_workspaces(
+    rotations: List[UserRotation], workspaces: List[Workspace]
+) -> List[Workspace]:
+    """ Assign workspaces to users. A workspace matched by more than one user is
+        left out, since it could only hold one user's credentials. """
+    owners: Dict[str, List[UserRotation]] = {}
+    for rotation in rotations:
+        rotation.workspaces = rotation.selector.select(workspaces)
+        for workspace in rotation.workspaces:
+            owners.setdefault(workspace.workspace_id, []).append(rotation)
+
+    conflicts = {k for k, v in owners.items() if len(v) > 1}
+    for workspace_id in sorted(conflicts):
+        users = ", ".join(x.iam_username for x in owners[workspace_id])
+        logger.error(f"({workspace_id}) skipped: selected by multiple users: {users}")
+
+    for rotation in rotations:
+        rotation.workspaces = [
+            x for x in rotation.workspaces if x.workspace_id not in conflicts
+        ]
+
+    return [x for x in workspaces if x.workspace_id in owners.keys() - conflicts]
+
+
+def _create(rotation: UserRotation):
+    try:
+        rotation.manager.create_new_credentials(replace_active=True)
+        rotation.journal.begin(rotation.manager.new, rotation.manager.previous_key_id)
+    except Exception as e:
+        logger.exception(f"({rotation.iam_username}) failed to create new key -- {e}")
+        rotation.error = e
+
+
+def _delete(rotation: UserRotation):
+    try:
+        rotation.manager.delete_previous_key()
+        rotation.journal.finish()
+        logger.info(f"({rotation.iam_username}) rotated access keys")
+    except Exception as e:
+        logger.exception(f"({rotation.iam_username}) failed to delete old key -- {e}")
+        rotation.error = e
+
+
+def partition(
+    results: WriteResults, rotations: List[UserRotation]
+) -> Dict[str, WriteResults]:
+    """ Split combined write results by the user that owns each workspace """
+    partitioned = {}
+    for rotation in rotations:
+        names = {x.workspace_name for x in rotation.workspaces}
+        user_results = WriteResults()
+        for name in names & results.succeeded.keys():
+            user_results.succeeded[name] = results.succeeded[name]
+        for name in names & results.failed.keys():
+            user_results.failed[name] = results.failed[name]
+        partitioned[rotation.iam_username] = user_results
+    return partitioned
+
+
+def write_plan(
+    rotations: List[UserRotation],
+    variables: VariableIndex,
+    due: Dict[str, bool],
+    output: IO[str],
+):
+    """ Stream each user's planned changes as newline delimited JSON, one line per
+        variable tagged with the user, followed by a summary line """
+    total = Changeset()
+    users = {}
+    for rotation in rotations:
+        changeset = terraform.plan_changes(
+            rotation.workspaces,
+            variables,
+            rotation.manager.preview_credentials(),
+            rotation.manager.descriptions,
+            stable_keys=conf.TF_STABLE_KEYS,
+        )
+        for change in changeset.changes:
+            output.write(
+                json.dumps({"iam_username": rotation.iam_username, **change.to_dict()})
+                + "\n"
+            )
+        total.changes.extend(changeset.changes)
+        users[rotation.iam_username] = {
+            "summary": changeset.counts(),
+            "workspaces": len(rotation.workspaces),
+            "needs_rotation": due[rotation.iam_username],
+        }
+        logger.info(f"({rotation.iam_username}) dry run planned {changeset}")
+
+    summary = {"summary": total.counts(), "users": users}
+    output.write(json.dumps(summary) + "\n")
+    output.flush()
+
+
+def rotate_users(
+    selectors: Dict[str, WorkspaceSelector],
+    max_workers: int = None,
+    dry_run: bool = None,
+    output: IO[str] = None,
+    deadline: Deadline = None,
+) -> Dict[str, WriteResults]:
+    """ Rotate the keys of every user in selectors and deliver each user's new
+        credentials to the workspaces matched by that user's selector.
+
+        A user's previous key is only deleted if every write to that user's
+        workspaces succeeded and the new key authenticates. Writes stop before
+        the deadline (see terraform.write_journaled); the next run resumes every
+        unfinished user with the key it already created.
+
+        In dry run mode (default: DRY_RUN) no key is created, written or deleted:
+        every user's planned changes are streamed to output (default: stdout),
+        as with rotate_keys.
+
+        Returns:
+            Dict[str, WriteResults] -- write results by IAM username
+    """
+    check_supported()
+    dry_run = conf.DRY_RUN if dry_run is None else dry_run
+    terraform.close_catalog()  # left open by an earlier run in this process
+    cache.begin_invocation()
+    max_workers = max_workers or conf.IAM_MAX_WORKERS
+    max_age = timedelta(hours=conf.KEY_MAX_AGE_HOURS)
+    store = None if dry_run else get_store()
+    rotations = [
+        UserRotation(user, selector, store) for user, selector in selectors.items()
+    ]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        due = list(executor.map(lambda x: x.due(max_age), rotations))
+
+    if dry_run:
+        assign_workspaces(rotations, terraform.get_workspaces())
+        variables = terraform.get_variables(category=VarCategory.ENV)
+        write_plan(
+            rotations,
+            variables,
+            {x.iam_username: needed for x, needed in zip(rotations, due)},
+            output or sys.stdout,
+        )
+        return {}
+
+    rotations = [x for x, needed in zip(rotations, due) if needed]
+    if not rotations:
+        logger.info("all keys are still fresh, skipping rotation")
+        return {}
+
+    workspaces = assign_workspaces(rotations, terraform.get_workspaces())
+    variables = terraform.get_variables(category=VarCategory.ENV)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_create, [x for x in rotations if not x.resuming]))
+
+    ready = [x for x in rotations if x.error is None]
+    # check the new keys while the variables are written (on the shared loop)
+    async def probe_all() -> List[bool]:
+        return await asyncio.gather(
+            *[
+                readiness.probe(x.manager.new, x.iam_username, deadline=deadline)
+                for x in ready
+            ]
+        )
+
+    probing = terraform.event_loop().create_task(probe_all())
+    try:
+        pending: List[Workspace] = []
+        tfvars = []
+        for rotation in ready:
+            changeset = terraform.plan_changes(
+                rotation.pending,
+                variables,
+                rotation.manager.new,
+                rotation.manager.descriptions,
+                stable_keys=conf.TF_STABLE_KEYS,
+            )
+            logger.info(f"({rotation.iam_username}) planned {changeset}")
+            pending.extend(rotation.pending)
+            tfvars.extend(changeset.writes())
+
+        results, finished = terraform.write_journaled(
+            pending, tfvars, BatchJournal(ready), deadline
+        )
+        terraform.record_writes(results, tfvars)
+        valid = dict(zip([x.iam_username for x in ready], terraform.run(probing)))
+    finally:
+        if not probing.done():
+            probing.cancel()
+            terraform.run(asyncio.wait([probing]))
+
+    partitioned = partition(results, ready)
+    completed = [
+        x
+        for x in ready
+        if finished
+        and not partitioned[x.iam_username].failure_count
+        and valid[x.iam_username]
+    ]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_delete, completed))
+
+    for rotation in rotations:
+        if rotation.error is not None or rotation not in completed:
+            logger.error(
+                f"({rotation.iam_username}) rotation incomplete, previous key retained until the rotation is resumed"  # noqa
+            )
+
+    logger.info(
+        f"rotated {len(completed)}/{len(rotations)} users across {len(workspaces)} workspaces"  # noqa
+    )
+    return partitioned
@@ -0,0 +1,134 @@
+""" Metadata caches for a single invocation and across warm invocations.
+
+    The invocation cache is cleared at the start of each run, so a value is only
+    fetched once per run. The shared cache keeps values between invocations of a
+    warm container for CACHE_TTL seconds (disabled when CACHE_TTL is 0). If
+    CACHE_DIR is set, shared entries are also pickled to that directory, e.g.
+    /tmp, so they survive a module reload in the same container.
+"""
+
+import logging
+import os
+import pickle
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import config as conf
+from util.iterables import make_hash
+
+logger = logging.getLogger(__name__)
+
+_missing = object()
+
+
+class TTLCache:
+    def __init__(self, ttl: float = None, directory: str = None):
+        self.ttl = ttl
+        self.directory = directory
+        self._data: Dict[str, Tuple[Optional[float], Any]] = {}
+
+    def __repr__(self):
+        return f"TTLCache(ttl={self.ttl}, entries={len(self._data)})"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{make_hash(key)}.pkl")  # type: ignore
+
+    def _read(self, key: str) -> Optional[Tuple[Optional[float], Any]]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.warning(f"(cache) discarding unreadable entry {key} -- {e}")
+            os.remove(path)
+            return None
+
+    def _write(self, key: str, entry: Tuple[Optional[float], Any]):
+        os.makedirs(self.directory, exist_ok=True)  # type: ignore
+        path = self._path(key)
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None and self.directory:
+            entry = self._read(key)
+            if entry is not None:
+                self._data[key] = entry
+
+        if entry is None:
+            return default
+
+        expires, value = entry
+        if expires is not None and time.time() >= expires:
+            self.invalidate(key)
+            return default
+
+        return value
+
+    def set(self, key: str, value: Any, ttl: float = None):
+        """ Store a value. Entries without a ttl never expire. """
+        ttl = self.ttl if ttl is None else ttl
+        entry = (time.time() + ttl if ttl else None, value)
+        self._data[key] = entry
+        if self.directory:
+            self._write(key, entry)
+
+    def invalidate(self, key: str = None):
+        """ Remove a single entry, or every entry if no key is given """
+        keys = [key] if key is not None else list(self._data)
+        for k in keys:
+            self._data.pop(k, None)
+
+        if self.directory and os.path.isdir(self.directory):
+            if key is not None:
+                paths = [self._path(key)]
+            else:
+                paths = [
+                    os.path.join(self.directory, x)
+                    for x in os.listdir(self.directory)
+                    if x.endswith(".pkl")
+                ]
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+invocation = TTLCache()
+shared = TTLCache(ttl=conf.CACHE_TTL, directory=conf.CACHE_DIR)
+
+
+def shared_enabled() -> bool:
+    return bool(shared.ttl and shared.ttl > 0)
+
+
+def begin_invocation():
+    """ Start a new run: values are fetched at most once more, unless they are
+        still fresh in the shared cache """
+    invocation.invalidate()
+
+
+def cached(key: str, factory: Callable[[], Any]) -> Any:
+    """ Return the cached value for key, calling factory to produce it on a miss """
+    value = invocation.get(key, _missing)
+
+    if value is _missing and shared_enabled():
+        value = shared.get(key, _missing)
+        if value is not _missing:
+            logger.debug(f"(cache) warm hit: {key}")
+
+    if value is _missing:
+        value = factory()
+        if shared_enabled():
+            shared.set(key, value)
+
+    invocation.set(key, value)
+    return value
+
+
+def invalidate(key: str = None):
+    invocation.invalidate(key)
+    shared.invalidate(key)
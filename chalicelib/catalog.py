@@ -0,0 +1,332 @@
+""" Persistent catalog of the organization's workspaces and credential variables,
+    so discovery does not have to crawl the whole organization on every run.
+
+    The catalog is a SQLite database (CATALOG_PATH, disabled by default; under
+    /tmp it lives as long as the Lambda container). Its connection is opened
+    once per invocation and closed at the end of it (see
+    terraform.close_catalog). It maps workspace name -> id ->
+    credential variable ids, and records for each workspace when its variables
+    were last read (synced_at).
+
+    Refreshes are incremental (see terraform.refresh_catalog): only workspaces
+    whose latest-change-at is newer than the catalog's watermark are listed, and
+    only those changed since they were synced have their variables fetched
+    again. Workspaces written by the rotation are marked synced as of the write.
+    The catalog is rebuilt from scratch when it is older than
+    CATALOG_MAX_AGE_HOURS, which also picks up renames.
+
+    Only env variables with a credential key are kept, as those are all the
+    rotation reads.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from typing import Collection, Iterable, List, Optional, Set
+
+from models import Variable, VariableIndex, Workspace
+
+logger = logging.getLogger(__name__)
+
+""" Bumped whenever the schema changes; older catalogs are rebuilt """
+VERSION = "1"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS workspaces (
+    workspace_id TEXT PRIMARY KEY,
+    workspace_name TEXT,
+    latest_change_at TEXT,
+    tag_names TEXT,
+    synced_at TEXT
+);
+CREATE TABLE IF NOT EXISTS variables (
+    variable_id TEXT PRIMARY KEY,
+    workspace_id TEXT,
+    key TEXT,
+    value TEXT,
+    category TEXT,
+    hcl INTEGER,
+    sensitive INTEGER,
+    description TEXT
+);
+CREATE INDEX IF NOT EXISTS variables_workspace ON variables (workspace_id);
+"""
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    """ Parse an API timestamp, e.g. 2020-01-01T00:00:00.000Z """
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+def format_timestamp(value: datetime) -> str:
+    return value.astimezone(timezone.utc).isoformat()
+
+
+class Catalog:
+    def __init__(self, path: str, org_name: str, keys: Collection[str]):
+        self.path = path
+        self.org_name = org_name
+        self.keys = set(keys)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        os.chmod(path, 0o600)
+
+    def __repr__(self):
+        return f"Catalog({self.path}: {self.count()} workspaces, watermark={self.get_meta('watermark')})"  # noqa
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, **values: str):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                values.items(),
+            )
+
+    @property
+    def watermark(self) -> Optional[datetime]:
+        """ Workspaces that changed after this have not been seen yet """
+        return parse_timestamp(self.get_meta("watermark"))
+
+    def needs_rebuild(self, max_age: timedelta) -> bool:
+        built_at = parse_timestamp(self.get_meta("built_at"))
+        return (
+            built_at is None
+            or self.watermark is None
+            or self.get_meta("version") != VERSION
+            or self.get_meta("org_name") != self.org_name
+            or self.get_meta("keys") != ",".join(sorted(self.keys))
+            or datetime.now(timezone.utc) - built_at > max_age
+        )
+
+    def count(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM workspaces").fetchone()[0]
+
+    def workspace_ids(self) -> Set[str]:
+        return {x[0] for x in self.db.execute("SELECT workspace_id FROM workspaces")}
+
+    def workspaces(self) -> List[Workspace]:
+        rows = self.db.execute(
+            "SELECT workspace_id, workspace_name, latest_change_at, tag_names FROM workspaces ORDER BY workspace_name"  # noqa
+        )
+        return [
+            Workspace(
+                workspace_id=workspace_id,
+                workspace_name=name,
+                latest_change_at=latest_change_at,
+                tag_names=json.loads(tag_names) if tag_names else [],
+            )
+            for workspace_id, name, latest_change_at, tag_names in rows
+        ]
+
+    def variables(self, workspace_ids: Iterable[str] = None) -> VariableIndex:
+        """ Credential variables, of every workspace or of those given """
+        query = "SELECT variable_id, workspace_id, key, value, category, hcl, sensitive, description FROM variables"  # noqa
+        if workspace_ids is None:
+            rows = self.db.execute(query).fetchall()
+        else:
+            wanted = sorted(set(workspace_ids))
+            rows = []
+            for i in range(0, len(wanted), 500):  # SQLite caps bound parameters
+                chunk = wanted[i : i + 500]
+                rows.extend(
+                    self.db.execute(
+                        f"{query} WHERE workspace_id IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                )
+        return VariableIndex(
+            Variable(
+                variable_id=variable_id,
+                workspace_id=workspace_id,
+                key=key,
+                value=value,
+                category=category,
+                hcl=bool(hcl),
+                sensitive=bool(sensitive),
+                description=description,
+            )
+            for variable_id, workspace_id, key, value, category, hcl, sensitive, description in rows  # noqa
+        )
+
+    def stale(self, workspaces: Iterable[Workspace]) -> List[Workspace]:
+        """ Workspaces whose variables changed since they were synced (or were
+            never synced), among those given """
+        synced = dict(self.db.execute("SELECT workspace_id, synced_at FROM workspaces"))
+        stale = []
+        for workspace in workspaces:
+            synced_at = parse_timestamp(synced.get(workspace.workspace_id))
+            changed_at = parse_timestamp(workspace.latest_change_at)
+            if synced_at is None or changed_at is None or changed_at > synced_at:
+                stale.append(workspace)
+        return stale
+
+    def unsynced(self) -> List[Workspace]:
+        """ Workspaces marked stale, e.g. after a failed write """
+        ids = {
+            x[0]
+            for x in self.db.execute(
+                "SELECT workspace_id FROM workspaces WHERE synced_at IS NULL"
+            )
+        }
+        return [x for x in self.workspaces() if x.workspace_id in ids]
+
+    def rebuild(
+        self,
+        workspaces: List[Workspace],
+        variables: Iterable[Variable],
+        synced_at: datetime,
+    ):
+        """ Replace the catalog's contents with a full crawl """
+        with self.db:
+            self.db.execute("DELETE FROM workspaces")
+            self.db.execute("DELETE FROM variables")
+        self.put_workspaces(workspaces)
+        self.put_variables([x.workspace_id for x in workspaces], variables, synced_at)
+        self.set_meta(
+            version=VERSION,
+            org_name=self.org_name,
+            keys=",".join(sorted(self.keys)),
+            built_at=format_timestamp(datetime.now(timezone.utc)),
+            watermark=format_timestamp(synced_at),
+        )
+
+    def put_workspaces(self, workspaces: Iterable[Workspace]):
+        """ Add or update workspaces, keeping when their variables were synced """
+        rows = [
+            (
+                x.workspace_name,
+                x.latest_change_at,
+                json.dumps(x.tag_names or []),
+                x.workspace_id,
+            )
+            for x in workspaces
+        ]
+        # no UPSERT: the SQLite bundled with older runtimes predates it
+        with self.db:
+            self.db.executemany(
+                "UPDATE workspaces SET workspace_name = ?, latest_change_at = ?, tag_names = ? WHERE workspace_id = ?",  # noqa
+                rows,
+            )
+            self.db.executemany(
+                "INSERT OR IGNORE INTO workspaces (workspace_name, latest_change_at, tag_names, workspace_id) VALUES (?, ?, ?, ?)",  # noqa
+                rows,
+            )
+
+    def remove_workspaces(self, workspace_ids: Iterable[str]):
+        ids = [(x,) for x in workspace_ids]
+        with self.db:
+            self.db.executemany("DELETE FROM variables WHERE workspace_id = ?", ids)
+            self.db.executemany("DELETE FROM workspaces WHERE workspace_id = ?", ids)
+
+    def remove_variables(self, variables: Iterable[Variable], synced_at: datetime):
+        """ Apply variable deletions, marking their workspaces synced """
+        variables = list(variables)
+        workspace_ids = {x.workspace_id for x in variables}
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM variables WHERE variable_id = ?",
+                [(x.variable_id,) for x in variables],
+            )
+            self.db.executemany(
+                "UPDATE workspaces SET synced_at = ? WHERE workspace_id = ?",
+                [(format_timestamp(synced_at), x) for x in workspace_ids],
+            )
+
+    def put_variables(
+        self,
+        workspace_ids: Iterable[str],
+        variables: Iterable[Variable],
+        synced_at: datetime,
+    ):
+        """ Replace the credential variables of the given workspaces with those
+            fetched, and mark them synced """
+        ids = [(x,) for x in workspace_ids]
+        rows = [
+            (
+                x.variable_id,
+                x.workspace_id,
+                x.key,
+                x.value,
+                x.category,
+                int(bool(x.hcl)),
+                int(bool(x.sensitive)),
+                x.description,
+            )
+            for x in variables
+            if x.key in self.keys
+        ]
+        with self.db:
+            self.db.executemany("DELETE FROM variables WHERE workspace_id = ?", ids)
+            self.db.executemany(
+                "INSERT OR REPLACE INTO variables VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self.db.executemany(
+                "UPDATE workspaces SET synced_at = ? WHERE workspace_id = ?",
+                [(format_timestamp(synced_at), x) for (x,) in ids],
+            )
+
+    def record_writes(self, results, synced_at: datetime):
+        """ Apply the outcome of variable writes (terraform.WriteResults).
+
+            Updated variables take their new attributes, and their workspaces are
+            synced as of synced_at. Workspaces in which a variable was created
+            (its id is only known from the API) or a write failed are marked
+            stale, so the next refresh reads them again.
+        """
+        ids = dict(
+            self.db.execute("SELECT workspace_name, workspace_id FROM workspaces")
+        )
+        updates, synced, stale = [], [], set(results.failed_workspaces)
+        for workspace_name, variables in results.succeeded.items():
+            for var in variables:
+                if var.variable_id is None:
+                    stale.add(workspace_name)
+                    continue
+                updates.append(
+                    (
+                        None if var.sensitive else var.value,
+                        int(bool(var.hcl)),
+                        int(bool(var.sensitive)),
+                        var.description,
+                        var.variable_id,
+                    )
+                )
+            if workspace_name not in stale:
+                synced.append(workspace_name)
+
+        with self.db:
+            self.db.executemany(
+                "UPDATE variables SET value = ?, hcl = ?, sensitive = ?, description = ? WHERE variable_id = ?",  # noqa
+                updates,
+            )
+            self.db.executemany(
+                "UPDATE workspaces SET synced_at = ? WHERE workspace_id = ?",
+                [(format_timestamp(synced_at), ids[x]) for x in synced if x in ids],
+            )
+            self.db.executemany(
+                "UPDATE workspaces SET synced_at = NULL WHERE workspace_id = ?",
+                [(ids[x],) for x in stale if x in ids],
+            )
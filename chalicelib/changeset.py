@@ -0,0 +1,114 @@
+""" Compare desired variable state with the state fetched from the API, so only
+    the writes that change something are sent """
+
+import json
+import logging
+from enum import Enum
+from typing import IO, Collection, Dict, List, Optional, Tuple
+
+from models import Variable
+
+logger = logging.getLogger(__name__)
+
+
+class Action(str, Enum):
+    CREATE = "create"
+    UPDATE = "update"
+    NOOP = "noop"
+
+
+def diff(desired, existing: Optional[Variable], stable_keys: Collection[str] = ()):
+    """ Decide which write, if any, brings an existing variable to the desired state.
+
+        Sensitive values can't be read back, so a sensitive variable is always
+        rewritten unless its key is listed in stable_keys: keys whose value is
+        derived from the identity being rotated (e.g. the account id) rather than
+        from the new key.
+
+        Arguments:
+            desired {TFVar} -- variable as it should be
+            existing {Optional[Variable]} -- variable as fetched, if it exists
+
+        Returns:
+            Action
+    """
+    if existing is None:
+        return Action.CREATE
+
+    category = getattr(desired.category, "value", desired.category)
+    if (
+        existing.category != category
+        or bool(existing.hcl) != bool(desired.hcl)
+        or bool(existing.sensitive) != bool(desired.sensitive)
+        or (existing.description or "") != (desired.description or "")
+    ):
+        return Action.UPDATE
+
+    if existing.sensitive:
+        return Action.NOOP if desired.key in stable_keys else Action.UPDATE
+
+    return Action.NOOP if existing.value == desired.value else Action.UPDATE
+
+
+class Change:
+    __slots__ = ("workspace_name", "action", "var")
+
+    def __init__(self, workspace_name: str, action: Action, var):
+        self.workspace_name = workspace_name
+        self.action = action
+        self.var = var
+
+    def __repr__(self):
+        return f"{self.workspace_name}: {self.action.value} {self.var}"
+
+    def to_dict(self) -> Dict:
+        """ Description of the change. Never includes the variable's value. """
+        return {
+            "workspace_name": self.workspace_name,
+            "action": self.action.value,
+            "key": self.var.key,
+            "variable_id": self.var.variable_id,
+            "workspace_id": self.var.workspace_id,
+            "category": getattr(self.var.category, "value", self.var.category),
+            "sensitive": self.var.sensitive,
+        }
+
+
+class Changeset:
+    def __init__(self):
+        self.changes: List[Change] = []
+
+    def __repr__(self):
+        counts = ", ".join(f"{k}={v}" for k, v in self.counts().items())
+        return f"Changeset({counts})"
+
+    def __len__(self) -> int:
+        return len(self.changes)
+
+    def add(self, workspace_name: str, action: Action, var):
+        self.changes.append(Change(workspace_name, action, var))
+
+    def counts(self) -> Dict[str, int]:
+        counts = {action.value: 0 for action in Action}
+        for change in self.changes:
+            counts[change.action.value] += 1
+        return counts
+
+    def write_ndjson(self, stream: IO[str], include_noop: bool = True) -> int:
+        """ Stream the changeset as newline delimited JSON, one change per line
+
+            Returns:
+                int -- number of lines written
+        """
+        count = 0
+        for change in self.changes:
+            if include_noop or change.action != Action.NOOP:
+                stream.write(json.dumps(change.to_dict()) + "\n")
+                count += 1
+        return count
+
+    def writes(self) -> List[Tuple[str, object]]:
+        """ (workspace_name, variable) pairs that need to be sent """
+        return [
+            (x.workspace_name, x.var) for x in self.changes if x.action != Action.NOOP
+        ]
@@ -1,15 +1,8 @@
-from typing import Dict, Optional
+import json
+from typing import Any, Dict, List, Optional, Union
 
-import pandas as pd
 from starlette.config import Config
-from starlette.datastructures import Secret
-from util.toml import project, version
-
-""" Optional Pandas display settings """
-pd.options.display.max_rows = 1000
-pd.set_option("display.float_format", lambda x: "%.2f" % x)
-pd.set_option("large_repr", "truncate")
-pd.set_option("precision", 2)
+from starlette.datastructures import CommaSeparatedStrings, Secret
 
 conf: Config = Config(".env")
 
@@ -24,11 +17,13 @@ ENV: str = conf("ENV", cast=str, default="lambda")
 HOST_NAME: str = conf("HOST_NAME", cast=str, default="lambda")
 TESTING: bool = conf("TESTING", cast=bool, default=False)
 DEBUG: bool = conf("DEBUG", cast=bool, default=False)
+DRY_RUN: bool = conf("DRY_RUN", cast=bool, default=False)
 
 """ Logging """
 LOG_LEVEL: str = conf("LOG_LEVEL", cast=str, default="20")
 LOG_FORMAT: str = conf("LOG_FORMAT", cast=str, default="json")
 LOG_HANDLER: str = conf("LOG_HANDLER", cast=str, default="colorized")
+LOG_QUEUE: bool = conf("LOG_QUEUE", cast=bool, default=False)
 
 
 DATADOG_ENABLED: bool = conf("DATADOG_ENABLED", cast=bool, default=False)
@@ -45,13 +40,168 @@ DATADOG_APP_KEY: Optional[Secret] = conf(
     default=conf("DD_APP_KEY", cast=Secret, default=None),
 )
 
-DATADOG_DEFAULT_TAGS: Dict[str, Optional[str]] = {
-    "environment": ENVIRONMENT_MAP.get(ENV, ENV),
-    "service_name": project,
-    "service_version": version,
-}
-
 
+TF_API_URL: str = conf(
+    "TF_API_URL", cast=str, default="https://app.terraform.io/api/v2/"
+)
 TF_TOKEN: Optional[Secret] = conf("TF_TOKEN", cast=Secret)
 TF_ORG_NAME: str = conf("TF_ORG_NAME", cast=str)
 TF_IAM_USERNAME: str = conf("TF_IAM_USERNAME", cast=str)
+TF_PAGE_SIZE: int = conf("TF_PAGE_SIZE", cast=int, default=100)
+TF_MAX_CONCURRENCY: int = conf("TF_MAX_CONCURRENCY", cast=int, default=8)
+TF_WRITE_CONCURRENCY: int = conf("TF_WRITE_CONCURRENCY", cast=int, default=16)
+TF_RATE_LIMIT: float = conf("TF_RATE_LIMIT", cast=float, default=30)
+TF_MAX_RETRIES: int = conf("TF_MAX_RETRIES", cast=int, default=5)
+
+""" Connections to the TFC API: keep-alive connections kept open between requests
+    (and warm invocations), maximum open connections, and timeouts in seconds """
+TF_HTTP2: bool = conf("TF_HTTP2", cast=bool, default=False)
+TF_KEEPALIVE_CONNECTIONS: int = conf("TF_KEEPALIVE_CONNECTIONS", cast=int, default=20)
+TF_MAX_CONNECTIONS: int = conf("TF_MAX_CONNECTIONS", cast=int, default=100)
+TF_TIMEOUT: float = conf("TF_TIMEOUT", cast=float, default=30)
+TF_CONNECT_TIMEOUT: float = conf("TF_CONNECT_TIMEOUT", cast=float, default=5)
+
+""" Sensitive credential keys whose value does not change between rotations """
+TF_STABLE_KEYS: CommaSeparatedStrings = conf(
+    "TF_STABLE_KEYS", cast=CommaSeparatedStrings, default="AWS_ACCOUNT_ID,AWS_IAM_ROLE",
+)
+
+""" Variable set delivering the credentials to the selected workspaces, e.g.
+    "aws-credentials". Empty writes them into each workspace. See varsets.py """
+TF_VARSET_NAME: str = conf("TF_VARSET_NAME", cast=str, default="")
+
+""" Keys younger than this are not rotated. 0 rotates on every run. """
+KEY_MAX_AGE_HOURS: float = conf("KEY_MAX_AGE_HOURS", cast=float, default=0)
+
+""" Seconds to wait for a new key to authenticate before the previous key may be
+    deleted, and the base and maximum delays between attempts """
+KEY_READY_TIMEOUT: float = conf("KEY_READY_TIMEOUT", cast=float, default=60)
+KEY_READY_BACKOFF: float = conf("KEY_READY_BACKOFF", cast=float, default=0.5)
+KEY_READY_MAX_BACKOFF: float = conf("KEY_READY_MAX_BACKOFF", cast=float, default=8)
+
+""" Workspace selection: name patterns are globs, or regexes when prefixed with 're:'.
+    Both must match the whole workspace name. """
+TF_WORKSPACE_INCLUDE: CommaSeparatedStrings = conf(
+    "TF_WORKSPACE_INCLUDE", cast=CommaSeparatedStrings, default=""
+)
+TF_WORKSPACE_EXCLUDE: CommaSeparatedStrings = conf(
+    "TF_WORKSPACE_EXCLUDE", cast=CommaSeparatedStrings, default=""
+)
+TF_WORKSPACE_TAGS: CommaSeparatedStrings = conf(
+    "TF_WORKSPACE_TAGS", cast=CommaSeparatedStrings, default=""
+)
+TF_WORKSPACE_EXCLUDE_TAGS: CommaSeparatedStrings = conf(
+    "TF_WORKSPACE_EXCLUDE_TAGS", cast=CommaSeparatedStrings, default=""
+)
+TF_WORKSPACE_SEARCH: Optional[str] = conf("TF_WORKSPACE_SEARCH", cast=str, default=None)
+
+""" Batch rotation: JSON mapping of IAM username -> workspace patterns or selector.
+    Not supported with CREDENTIAL_SINKS, TF_VARSET_NAME or SHARD_SIZE """
+TF_IAM_USER_MAP: Dict[str, Union[List[str], Dict]] = conf(
+    "TF_IAM_USER_MAP", cast=json.loads, default="{}"
+)
+IAM_MAX_WORKERS: int = conf("IAM_MAX_WORKERS", cast=int, default=8)
+
+""" Rotation journal: "ssm", "file", "memory" or "none" to disable. Only "ssm"
+    outlives the Lambda container, so a rotation can be resumed. See journal.py """
+JOURNAL_STORE: str = conf("JOURNAL_STORE", cast=str, default="ssm")
+JOURNAL_SSM_PATH: str = conf(
+    "JOURNAL_SSM_PATH", cast=str, default=f"/{APP_NAME}/journal"
+)
+JOURNAL_SSM_KMS_KEY_ID: Optional[str] = conf(
+    "JOURNAL_SSM_KMS_KEY_ID", cast=str, default=None
+)
+JOURNAL_DIR: str = conf("JOURNAL_DIR", cast=str, default="/tmp/key-rotation/journal")
+
+""" Workspaces written between journal updates and deadline checks """
+ROTATION_CHUNK_SIZE: int = conf("ROTATION_CHUNK_SIZE", cast=int, default=100)
+
+""" Seconds before the Lambda timeout at which no further writes are started """
+DEADLINE_MARGIN: float = conf("DEADLINE_MARGIN", cast=float, default=15)
+
+""" Destinations receiving the rotated key besides Terraform Cloud, e.g. "ssm,dotenv".
+    See sinks.py """
+CREDENTIAL_SINKS: CommaSeparatedStrings = conf(
+    "CREDENTIAL_SINKS", cast=CommaSeparatedStrings, default=""
+)
+SINK_SSM_PATH: str = conf(
+    "SINK_SSM_PATH", cast=str, default=f"/{APP_NAME}/credentials/{TF_IAM_USERNAME}"
+)
+SINK_SSM_KMS_KEY_ID: Optional[str] = conf("SINK_SSM_KMS_KEY_ID", cast=str, default=None)
+SINK_SSM_CONCURRENCY: int = conf("SINK_SSM_CONCURRENCY", cast=int, default=4)
+SINK_DOTENV_PATH: str = conf(
+    "SINK_DOTENV_PATH", cast=str, default="/tmp/key-rotation/credentials.env"
+)
+
+""" Workspaces per shard when writes are fanned out to workers (0: disabled) """
+SHARD_SIZE: int = conf("SHARD_SIZE", cast=int, default=0)
+
+""" Where shards are run: process (local pool) or lambda """
+SHARD_EXECUTOR: str = conf("SHARD_EXECUTOR", cast=str, default="lambda")
+
+""" Shards run concurrently """
+SHARD_WORKERS: int = conf("SHARD_WORKERS", cast=int, default=4)
+
+""" Worker Lambda function invoked by the lambda executor """
+SHARD_FUNCTION_NAME: str = conf(
+    "SHARD_FUNCTION_NAME", cast=str, default=f"{APP_NAME}-{ENV}-terraform-cloud-worker"
+)
+
+""" Persistent workspace/variable catalog (see catalog.py), e.g.
+    /tmp/key-rotation/catalog.sqlite3. Empty (the default) disables it. """
+CATALOG_PATH: str = conf("CATALOG_PATH", cast=str, default="")
+CATALOG_MAX_AGE_HOURS: float = conf("CATALOG_MAX_AGE_HOURS", cast=float, default=24)
+
+""" Allowance for differences between the local clock and the API's """
+CATALOG_CLOCK_SKEW: float = conf("CATALOG_CLOCK_SKEW", cast=float, default=60)
+
+""" Metadata cache """
+CACHE_TTL: float = conf("CACHE_TTL", cast=float, default=0)
+CACHE_DIR: Optional[str] = conf("CACHE_DIR", cast=str, default=None)
+
+
+def __getattr__(name: str) -> Any:
+    """ Settings that require reading pyproject.toml are resolved on first access """
+    if name == "DATADOG_DEFAULT_TAGS":
+        from util import toml
+
+        value: Dict[str, Optional[str]] = {
+            "environment": ENVIRONMENT_MAP.get(ENV, ENV),
+            "service_name": toml.project,
+            "service_version": toml.version,
+        }
+        globals()[name] = value
+        return value
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _comparable(value: Any) -> Any:
+    if isinstance(value, Secret):
+        return str(value)
+    if isinstance(value, CommaSeparatedStrings):
+        return list(value)
+    return value
+
+
+def reload() -> List[str]:
+    """ Read every setting from the environment again, e.g. once ssm.load() has
+        exported parameters that changed since this module was imported.
+        Values other modules derived from settings at import (such as
+        terraform.BASE_URL from TF_API_URL, or the shared cache's CACHE_TTL)
+        keep the value they were imported with.
+
+        Returns:
+            List[str] -- names of the settings whose value changed
+    """
+    import importlib
+    import sys
+
+    module = sys.modules[__name__]
+    before = {k: _comparable(v) for k, v in vars(module).items() if k.isupper()}
+    importlib.reload(module)
+    return sorted(
+        k
+        for k, v in vars(module).items()
+        if k.isupper() and (k not in before or before[k] != _comparable(v))
+    )
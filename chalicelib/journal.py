@@ -0,0 +1,331 @@
+""" Persisted progress of a rotation, so a run that stops partway (a timeout, a
+    failed write) can be resumed by the next invocation with the key it already
+    created, instead of creating another one.
+
+    A journal is started as soon as the new key exists and records each
+    workspace once all of its variables have been written. It is removed when
+    the rotation completes and the previous key has been deleted.
+
+    The journal must outlive the invocation for a rotation to be resumed, so
+    the default store keeps it in SSM (split across several parameters when
+    it outgrows one). The file store (by default under /tmp)
+    and the memory store only last as long as the Lambda container, and are
+    meant for local runs and tests.
+
+    Journals hold the new credentials, so stores must keep them private: the
+    SSM store writes SecureString parameters and the file store owner-only
+    files. Other backends are added with register_store().
+"""
+
+import json
+import logging
+import os
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import config as conf
+from util.iterables import chunks
+
+logger = logging.getLogger(__name__)
+
+
+class JournalStore(ABC):
+    """ Backend holding journal documents by key """
+
+    @abstractmethod
+    def load(self, key: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def save(self, key: str, document: Dict):
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+
+class MemoryStore(JournalStore):
+    def __init__(self):
+        self.documents: Dict[str, Dict] = {}
+
+    def __repr__(self):
+        return f"MemoryStore({len(self.documents)} journals)"
+
+    def load(self, key: str) -> Optional[Dict]:
+        document = self.documents.get(key)
+        return json.loads(json.dumps(document)) if document is not None else None
+
+    def save(self, key: str, document: Dict):
+        self.documents[key] = json.loads(json.dumps(document))
+
+    def delete(self, key: str):
+        self.documents.pop(key, None)
+
+
+class FileStore(JournalStore):
+    """ One JSON file per journal, replaced atomically and readable only by the
+        owner """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def __repr__(self):
+        return f"FileStore({self.directory})"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def load(self, key: str) -> Optional[Dict]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"(journal) ignoring unreadable journal {path} -- {e}")
+            return None
+
+    def save(self, key: str, document: Dict):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        path = self._path(key)
+        fd = os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(document, f)
+        os.replace(f"{path}.tmp", path)
+
+    def delete(self, key: str):
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class SSMStore(JournalStore):
+    """ One SecureString parameter per journal, under `path`.
+
+        Parameters hold at most 8 KB (advanced tier), which a few hundred
+        workspace names outgrow. The completed workspaces are therefore kept
+        in numbered parameters next to the journal's (`<name>.1`, `<name>.2`,
+        ...), whose count the journal records. Parts are written before the
+        journal that refers to them, and only when they changed.
+    """
+
+    MAX_SIZE = 8192
+
+    def __init__(self, path: str, kms_key_id: str = None):
+        self.path = path.rstrip("/")
+        self.kms_key_id = kms_key_id
+        # values last written, by parameter name, to skip unchanged parts
+        self.saved: Dict[str, str] = {}
+
+    def __repr__(self):
+        return f"SSMStore({self.path})"
+
+    def parameter_name(self, key: str) -> str:
+        return f"{self.path}/{key}"
+
+    def part_names(self, key: str, count: int) -> List[str]:
+        return [f"{self.parameter_name(key)}.{i}" for i in range(1, count + 1)]
+
+    def split(self, names: Iterable[str]) -> List[str]:
+        """ Serialize names as JSON arrays of at most MAX_SIZE bytes each """
+        parts: List[List[str]] = [[]]
+        size = 2
+        for name in sorted(names):
+            length = len(json.dumps(name).encode("utf-8")) + 1
+            if parts[-1] and size + length > self.MAX_SIZE:
+                parts.append([])
+                size = 2
+            parts[-1].append(name)
+            size += length
+        return [json.dumps(x, separators=(",", ":")) for x in parts if x]
+
+    def get(self, names: List[str]) -> Dict[str, str]:
+        from key_rotation import client
+
+        values = {}
+        for chunk in chunks(names, 10):  # GetParameters takes 10 names at most
+            response = client("ssm").get_parameters(Names=chunk, WithDecryption=True)
+            values.update({x["Name"]: x["Value"] for x in response["Parameters"]})
+        return values
+
+    def put(self, name: str, value: str):
+        from key_rotation import client
+
+        if self.saved.get(name) == value:
+            return
+        params = {
+            "Name": name,
+            "Value": value,
+            "Type": "SecureString",
+            "Overwrite": True,
+            "Tier": "Intelligent-Tiering",
+        }
+        if self.kms_key_id:
+            params["KeyId"] = self.kms_key_id
+        client("ssm").put_parameter(**params)
+        self.saved[name] = value
+
+    def remove(self, names: Iterable[str]):
+        from key_rotation import client
+
+        ssm = client("ssm")
+        for name in names:
+            self.saved.pop(name, None)
+            try:
+                ssm.delete_parameter(Name=name)
+            except ssm.exceptions.ParameterNotFound:
+                pass
+
+    def load(self, key: str) -> Optional[Dict]:
+        name = self.parameter_name(key)
+        value = self.get([name]).get(name)
+        if value is None:
+            return None
+        try:
+            document = json.loads(value)
+            part_names = self.part_names(key, document.pop("parts", 0))
+            parts = self.get(part_names)
+            missing = [x for x in part_names if x not in parts]
+            if missing:
+                raise ValueError(f"missing parts: {', '.join(missing)}")
+            document["completed"] = [
+                x for part in part_names for x in json.loads(parts[part])
+            ]
+        except ValueError as e:
+            logger.warning(f"(journal) ignoring unreadable journal {key} -- {e}")
+            return None
+        self.saved.update({name: value, **parts})
+        return document
+
+    def save(self, key: str, document: Dict):
+        name = self.parameter_name(key)
+        previous = self.saved.get(name)
+        previous_count = json.loads(previous).get("parts", 0) if previous else 0
+
+        parts = self.split(document.get("completed") or [])
+        for part_name, value in zip(self.part_names(key, len(parts)), parts):
+            self.put(part_name, value)
+        self.put(
+            name,
+            json.dumps(
+                {
+                    **{k: v for k, v in document.items() if k != "completed"},
+                    "parts": len(parts),
+                },
+                separators=(",", ":"),
+            ),
+        )
+        self.remove(self.part_names(key, previous_count)[len(parts) :])
+
+    def delete(self, key: str):
+        name = self.parameter_name(key)
+        previous = self.saved.get(name) or self.get([name]).get(name)
+        count = json.loads(previous).get("parts", 0) if previous else 0
+        self.remove([name] + self.part_names(key, count))
+
+
+""" Journals kept in memory only last as long as the (warm) container """
+memory = MemoryStore()
+
+STORES: Dict[str, Callable[[], JournalStore]] = {
+    "ssm": lambda: SSMStore(conf.JOURNAL_SSM_PATH, conf.JOURNAL_SSM_KMS_KEY_ID),
+    "file": lambda: FileStore(conf.JOURNAL_DIR),
+    "memory": lambda: memory,
+}
+
+
+def register_store(name: str, factory: Callable[[], JournalStore]):
+    """ Make a backend available as JOURNAL_STORE=<name> """
+    STORES[name] = factory
+
+
+def get_store(name: str = None) -> Optional[JournalStore]:
+    """ The configured store (default: JOURNAL_STORE), or None if journaling is
+        disabled ("none") """
+    name = name or conf.JOURNAL_STORE
+    if not name or name == "none":
+        return None
+    try:
+        return STORES[name]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown journal store: {name}. Available options: {', '.join(STORES)}"
+        )
+
+
+class RotationJournal:
+    """ Progress of one user's rotation """
+
+    def __init__(self, store: Optional[JournalStore], iam_username: str):
+        self.store = store
+        self.iam_username = iam_username
+        self.credentials: Dict[str, str] = {}
+        self.previous_key_id: Optional[str] = None
+        self.started_at: Optional[str] = None
+        self.completed: Set[str] = set()
+
+    def __repr__(self):
+        return f"RotationJournal({self.iam_username}: {self.key_id or 'not started'}, {len(self.completed)} workspaces completed)"  # noqa
+
+    @property
+    def key(self) -> str:
+        return f"rotation-{self.iam_username}"
+
+    @property
+    def key_id(self) -> Optional[str]:
+        """ Access key id of the key being rolled out """
+        return self.credentials.get("AWS_ACCESS_KEY_ID")
+
+    @property
+    def started(self) -> bool:
+        return bool(self.credentials)
+
+    @classmethod
+    def load(
+        cls, store: Optional[JournalStore], iam_username: str
+    ) -> "RotationJournal":
+        """ The user's unfinished journal, or an empty one """
+        journal = cls(store, iam_username)
+        document = store.load(journal.key) if store else None
+        if document:
+            journal.credentials = document.get("credentials") or {}
+            journal.previous_key_id = document.get("previous_key_id")
+            journal.started_at = document.get("started_at")
+            journal.completed = set(document.get("completed") or [])
+        return journal
+
+    def to_dict(self) -> Dict:
+        return {
+            "iam_username": self.iam_username,
+            "credentials": self.credentials,
+            "previous_key_id": self.previous_key_id,
+            "started_at": self.started_at,
+            "completed": sorted(self.completed),
+        }
+
+    def begin(self, credentials: Dict[str, str], previous_key_id: Optional[str]):
+        """ Record a newly created key before anything is written with it """
+        self.credentials = dict(credentials)
+        self.previous_key_id = previous_key_id
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.completed = set()
+        self.save()
+
+    def complete(self, workspace_names: Iterable[str]):
+        self.completed.update(workspace_names)
+        self.save()
+
+    def save(self):
+        if self.store:
+            self.store.save(self.key, self.to_dict())
+
+    def finish(self):
+        """ Remove the journal once the rotation is complete """
+        if self.store:
+            self.store.delete(self.key)
+        self.credentials = {}
+        self.previous_key_id = None
+        self.completed = set()
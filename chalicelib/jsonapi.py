@@ -0,0 +1,142 @@
+""" Helpers for consuming paginated JSON:API collections """
+
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import httpx
+from util.iterables import query
+
+logger = logging.getLogger(__name__)
+
+MAX_PAGE_SIZE: int = 100
+
+
+def page_params(number: int, size: int = MAX_PAGE_SIZE, params: Dict = None) -> Dict:
+    """ Merge JSON:API page parameters into an existing set of query parameters """
+    return {**(params or {}), "page[number]": number, "page[size]": size}
+
+
+def total_pages(document: Dict) -> Optional[int]:
+    """ Total number of pages advertised in a document's pagination metadata """
+    return query("meta.pagination.total-pages", data=document)
+
+
+def total_count(document: Dict) -> Optional[int]:
+    """ Total number of records advertised in a document's pagination metadata """
+    return query("meta.pagination.total-count", data=document)
+
+
+def next_link(document: Dict) -> Optional[str]:
+    return query("links.next", data=document)
+
+
+async def get_document(client, url: httpx.URL, params: Dict = None) -> Dict:
+    response = await client.get(url, params=params)
+    response.raise_for_status()
+    return response.json()
+
+
+async def iter_pages(
+    client,
+    url: httpx.URL,
+    params: Dict = None,
+    page_size: int = MAX_PAGE_SIZE,
+    concurrency: int = 8,
+) -> AsyncIterator[Tuple[int, List[Dict]]]:
+    """ Yield (page number, records) for each page of a paginated JSON:API
+        collection as soon as it arrives, so a caller can reduce each page before
+        the next one is read and never holds every raw document at once.
+
+        The first page is requested serially to discover the page count. If the
+        server reports meta.pagination.total-pages, the remaining pages are fetched
+        concurrently (at most `concurrency` in flight) and yielded in completion
+        order; a failed page raises when the consumer reaches it. Otherwise,
+        links.next is followed one page at a time until there is no next page.
+    """
+    page_size = min(page_size, MAX_PAGE_SIZE)
+    first = await get_document(client, url, params=page_params(1, page_size, params))
+    pages = total_pages(first)
+    link = next_link(first)
+    yield 1, first.get("data") or []
+    del first
+
+    if pages and pages > 1:
+        # a fixed set of workers shares the page numbers; the bounded queue stops
+        # them from running ahead of the consumer, and no reference to a page is
+        # kept once it has been yielded
+        numbers = iter(range(2, pages + 1))
+        results: asyncio.Queue = asyncio.Queue(maxsize=max(concurrency, 1))
+
+        async def worker():
+            for number in numbers:
+                try:
+                    document = await get_document(
+                        client, url, params=page_params(number, page_size, params)
+                    )
+                    await results.put((number, document.get("data") or []))
+                except Exception as e:
+                    await results.put((number, e))
+                    return
+
+        logger.debug(f"fetching {pages - 1} additional pages: {url}")
+        workers = [
+            asyncio.ensure_future(worker())
+            for _ in range(min(max(concurrency, 1), pages - 1))
+        ]
+        try:
+            for _ in range(pages - 1):
+                number, result = await results.get()
+                if isinstance(result, Exception):
+                    raise result
+                yield number, result
+        finally:
+            for task in workers:
+                task.cancel()
+
+    else:
+        number = 1
+        while link:
+            document = await get_document(client, httpx.URL(link))
+            link = next_link(document)
+            number += 1
+            yield number, document.get("data") or []
+
+
+async def fetch_all(
+    client,
+    url: httpx.URL,
+    params: Dict = None,
+    page_size: int = MAX_PAGE_SIZE,
+    concurrency: int = 8,
+    parse: Callable[[Dict], Any] = None,
+) -> List[Any]:
+    """ Fetch every record in a paginated JSON:API collection.
+
+        If parse is given, each record is passed through it as its page arrives
+        and only the results are kept; records it maps to None are dropped. This
+        keeps memory bounded by the parsed records rather than the raw documents.
+
+        Arguments:
+            client {httpx.AsyncClient} -- client used to issue the requests
+            url {httpx.URL} -- collection endpoint
+
+        Keyword Arguments:
+            params {Dict} -- additional query parameters (default: {None})
+            page_size {int} -- records per page, capped at MAX_PAGE_SIZE (default: {100})
+            concurrency {int} -- max number of concurrent page requests (default: {8})
+            parse {Callable} -- converts a record, or returns None to drop it
+
+        Returns:
+            List -- all (parsed) records from the "data" member of each page, in
+                    page order
+    """
+    pages: Dict[int, List[Any]] = {}
+    async for number, records in iter_pages(
+        client, url, params=params, page_size=page_size, concurrency=concurrency
+    ):
+        if parse is not None:
+            records = [x for x in map(parse, records) if x is not None]
+        pages[number] = records
+
+    return [record for number in sorted(pages) for record in pages[number]]
@@ -1,15 +1,63 @@
+import functools
 import logging
-from datetime import date
-from typing import Dict, Optional
+import threading
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional
 
-import boto3
+import cache
+from tracing import TracedClient
 from util.iterables import query
 
 logger = logging.getLogger(__name__)
 
+_client_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def client(service_name: str):
+    """ boto3 client for the given service, created on first use. Clients are
+        thread-safe once created, but creating them is not. Throttled calls are
+        retried with client-side rate limiting (adaptive retry mode). Each API
+        call is recorded as a tracing span. """
+    import boto3
+    from botocore.config import Config
+
+    with _client_lock:
+        return TracedClient(
+            boto3.client(
+                service_name,
+                config=Config(retries={"mode": "adaptive", "max_attempts": 10}),
+            ),
+            prefix=service_name,
+        )
+
+
+def credentials_client(service_name: str, credentials: Dict[str, str]):
+    """ boto3 client signing with the given credentials instead of the function's
+        own, e.g. to check that a new key works. Not cached, and calls are not
+        retried. """
+    import boto3
+    from botocore.config import Config
+
+    with _client_lock:
+        return TracedClient(
+            boto3.client(
+                service_name,
+                aws_access_key_id=credentials["AWS_ACCESS_KEY_ID"],
+                aws_secret_access_key=credentials["AWS_SECRET_ACCESS_KEY"],
+                config=Config(retries={"max_attempts": 0}),
+            ),
+            prefix=f"{service_name}.probe",
+        )
+
+
+def iam():
+    return client("iam")
+
+
+def sts():
+    return client("sts")
 
-iam = boto3.client("iam")
-sts = boto3.client("sts")
 
 CREDENTIAL_DESCRIPTIONS: Dict[str, str] = {
     "AWS_ACCOUNT_ID": "AWS account in which resources will be created",
@@ -19,24 +67,75 @@ CREDENTIAL_DESCRIPTIONS: Dict[str, str] = {
     "LAST_ROTATED": "Date of last AWS key rotation",
 }
 
+""" Stands in for values that are only known once a new key has been created """
+PLACEHOLDER = "(known after rotation)"
+
+
+class AccessKey:
+    __slots__ = ("access_key_id", "status", "create_date", "_last_used")
+
+    def __init__(self, access_key_id: str, status: str, create_date: datetime):
+        self.access_key_id = access_key_id
+        self.status = status
+        self.create_date = create_date
+        self._last_used: Optional[Dict] = None
+
+    def __repr__(self):
+        return f"{self.access_key_id} ({self.status}, age={self.age})"
+
+    @property
+    def age(self) -> timedelta:
+        return datetime.now(timezone.utc) - self.create_date
+
+    @property
+    def last_used(self) -> Dict:
+        """ Fetched on first access, as it costs one IAM call per key """
+        if self._last_used is None:
+            payload = iam().get_access_key_last_used(AccessKeyId=self.access_key_id)
+            self._last_used = payload.get("AccessKeyLastUsed") or {}
+        return self._last_used
+
+    @property
+    def last_used_date(self) -> Optional[datetime]:
+        return self.last_used.get("LastUsedDate")
+
+    @property
+    def last_used_service(self) -> Optional[str]:
+        return self.last_used.get("ServiceName")
+
+
+def key_inventory(iam_username: str) -> List[AccessKey]:
+    """ Access keys of an IAM user, oldest first. Last-used details are only
+        fetched when read (see AccessKey.last_used). """
+    payload = iam().list_access_keys(UserName=iam_username)
+    keys = [
+        AccessKey(
+            access_key_id=metadata["AccessKeyId"],
+            status=metadata.get("Status"),
+            create_date=metadata["CreateDate"],
+        )
+        for metadata in payload.get("AccessKeyMetadata", [])
+    ]
+    return sorted(keys, key=lambda x: x.create_date)
 
-class RotationManager:
-    _account_id: Optional[str] = None
-    _previous_key_id: Optional[str] = None
-    _next_key_id: Optional[str] = None
 
+class RotationManager:
     def __init__(self, iam_username: str):
         self.iam_username = iam_username
         self.new: Dict[str, str] = {}
+        self._account_id: Optional[str] = None
+        self._previous_key_id: Optional[str] = None
+        self._next_key_id: Optional[str] = None
+        self._inventory: Optional[List[AccessKey]] = None
 
     def __enter__(self):
         self.create_new_credentials()
         return self
 
-    def __exit__(self, *exc):
-        if not exc:
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None and self.wait_until_ready():
             self.delete_previous_key()
-        logger.info(f"({self.iam_username}) rotated access keys")
+            logger.info(f"({self.iam_username}) rotated access keys")
 
     @property
     def descriptions(self) -> Dict[str, str]:
@@ -55,39 +154,131 @@ class RotationManager:
     @property
     def account_id(self) -> str:
         if self._account_id is None:
-            payload = sts.get_caller_identity()
-            sts_response_code = query("ResponseMetadata.HTTPStatusCode", data=payload)
+            self._account_id = cache.cached("account_id", self._fetch_account_id)
+        return self._account_id
 
-            if sts_response_code != 200:
-                raise ValueError(f"({self.iam_username}) failed to fetch account id")
+    def _fetch_account_id(self) -> str:
+        payload = sts().get_caller_identity()
+        sts_response_code = query("ResponseMetadata.HTTPStatusCode", data=payload)
 
-            self._account_id = payload["Account"]
+        if sts_response_code != 200:
+            raise ValueError(f"({self.iam_username}) failed to fetch account id")
 
-        return self._account_id
+        return payload["Account"]
+
+    @property
+    def inventory(self) -> List[AccessKey]:
+        """ The user's access keys, oldest first. Refreshed after keys are
+            created or deleted. """
+        if self._inventory is None:
+            self._inventory = key_inventory(self.iam_username)
+        return self._inventory
+
+    @property
+    def current_key(self) -> Optional[AccessKey]:
+        """ Newest active access key """
+        active = [x for x in self.inventory if x.status != "Inactive"]
+        return active[-1] if active else None
 
     @property
     def oldest_key(self) -> Optional[str]:
         return self._fetch_access_key(oldest=True)
 
-    def _fetch_access_key(self, oldest: bool = False):
-        payload = iam.list_access_keys(UserName=self.iam_username)
-        index = -1 if oldest else 0
-        return query(f"AccessKeyMetadata.{index}.AccessKeyId", data=payload)
+    def is_inactive(self, access_key_id: str) -> bool:
+        return any(
+            x.access_key_id == access_key_id and x.status == "Inactive"
+            for x in self.inventory
+        )
 
-    def create_new_credentials(self, is_retry: bool = False) -> Dict[str, str]:
+    def _fetch_access_key(self, oldest: bool = False) -> Optional[str]:
+        if oldest:  # never the key currently in use
+            current_id = getattr(self.current_key, "access_key_id", None)
+            others = [x for x in self.inventory if x.access_key_id != current_id]
+            return others[0].access_key_id if others else None
+        current = self.current_key
+        return current.access_key_id if current else None
+
+    def needs_rotation(self, max_age: timedelta = None) -> bool:
+        """ Whether the current key is older than max_age. Always true if the
+            user has no active key or no max_age is given. """
+        current = self.current_key
+        if not max_age or current is None:
+            return True
+
+        if current.age < max_age:
+            logger.info(
+                f"({self.iam_username}) current key is {current.age} old, below the maximum age of {max_age}: {current}"  # noqa
+            )
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    f"({self.iam_username}) {current.access_key_id} last used {current.last_used_date or 'never'} ({current.last_used_service})"  # noqa
+                )
+            return False
+
+        return True
+
+    def preview_credentials(self) -> Dict[str, str]:
+        """ Credentials as they would look after rotation, without creating a key.
+            Values that only exist once a key is created are placeholders. """
+        return {
+            "AWS_ACCOUNT_ID": self.account_id,
+            "AWS_ACCESS_KEY_ID": PLACEHOLDER,
+            "AWS_SECRET_ACCESS_KEY": PLACEHOLDER,
+            "AWS_IAM_ROLE": self.iam_username,
+            "LAST_ROTATED": str(date.today()),
+        }
+
+    def resume(
+        self, credentials: Dict[str, str], previous_key_id: Optional[str]
+    ) -> bool:
+        """ Continue a rotation with a key created by an earlier run instead of
+            creating a new one. Fails if that key no longer exists. """
+        key_id = credentials.get("AWS_ACCESS_KEY_ID")
+        if not any(x.access_key_id == key_id for x in self.inventory):
+            return False
+
+        self.new = dict(credentials)
+        self._next_key_id = key_id
+        self._previous_key_id = previous_key_id
+        return True
+
+    def create_new_credentials(
+        self, is_retry: bool = False, replace_active: bool = False
+    ) -> Dict[str, str]:
+        """ Create a new access key. If the user already has two, the one that is
+            not current is deleted to make room, but only if it is inactive,
+            unless replace_active is set: callers that hold no journal of an
+            unfinished rotation set it, as the older key is then left over from
+            an earlier rotation (e.g. one that never deleted its previous key),
+            and it is deactivated before it is deleted. """
         if not self.new:
+            if self._previous_key_id is None:  # remember the key being replaced
+                self._previous_key_id = self._fetch_access_key()
             try:
-                payload = iam.create_access_key(UserName=self.iam_username)
-            except iam.exceptions.LimitExceededException as e:
+                payload = iam().create_access_key(UserName=self.iam_username)
+                self._inventory = None
+            except iam().exceptions.LimitExceededException as e:
                 logger.warning(f"({self.iam_username}) -- {e}")
                 oldest = self.oldest_key
-                if oldest:
-                    self.delete_key(oldest)
+                if is_retry or oldest is None:  # only retry once
+                    raise
+                if not self.is_inactive(oldest):
+                    if not replace_active:
+                        raise ValueError(
+                            f"({self.iam_username}) cannot create a new access key: {oldest} may still be in use. Resume the rotation that created it, or deactivate {oldest} to have it deleted"  # noqa
+                        ) from e
                     logger.warning(
-                        f"({self.iam_username}) retrying creating new credentials"
+                        f"({self.iam_username}) no rotation to resume: replacing {oldest}, which is not the current key"  # noqa
                     )
-                    if not is_retry:  # only retry once
-                        return self.create_new_credentials(is_retry=True)
+                    self.deactivate_key(oldest)
+
+                self.delete_key(oldest)
+                logger.warning(
+                    f"({self.iam_username}) retrying creating new credentials"
+                )
+                return self.create_new_credentials(
+                    is_retry=True, replace_active=replace_active
+                )
 
             response_code = query("ResponseMetadata.HTTPStatusCode", data=payload)
 
@@ -113,11 +304,35 @@ class RotationManager:
         else:
             raise ValueError(f"credentials have already been generated")
 
+    def wait_until_ready(self, timeout: float = None) -> bool:
+        """ Block until the new key authenticates (see readiness.probe) """
+        import asyncio
+
+        import readiness
+
+        return asyncio.run(readiness.probe(self.new, self.iam_username, timeout))
+
+    def deactivate_key(self, access_key_id: str):
+        payload = iam().update_access_key(
+            UserName=self.iam_username, AccessKeyId=access_key_id, Status="Inactive"
+        )
+
+        self._inventory = None
+        response_code = query("ResponseMetadata.HTTPStatusCode", data=payload)
+
+        if response_code == 200:
+            logger.info(f"({self.iam_username}) deactivated access key {access_key_id}")
+        else:
+            raise ValueError(
+                f"({self.iam_username}) failed to deactivate access key {access_key_id}"
+            )
+
     def delete_key(self, access_key_id: str):
-        payload = iam.delete_access_key(
+        payload = iam().delete_access_key(
             UserName=self.iam_username, AccessKeyId=access_key_id
         )
 
+        self._inventory = None
         response_code = query("ResponseMetadata.HTTPStatusCode", data=payload)
 
         if response_code == 200:
@@ -126,7 +341,7 @@ class RotationManager:
             raise ValueError(f"({self.iam_username}) failed to delete old access key")
 
     def delete_previous_key(self):
-        if self.previous_key_id:
+        if self.previous_key_id and self.previous_key_id != self.next_key_id:
             result = self.delete_key(access_key_id=self.previous_key_id)
             self._previous_key_id = None
             return result
@@ -1,9 +1,12 @@
 """ Logger definitions """
 
+import atexit
 import logging
 import logging.config
 import os
+import queue
 from logging import LogRecord
+from logging.handlers import QueueHandler, QueueListener
 from typing import Any, Dict, Mapping, Optional, Union
 
 import config as conf
@@ -103,19 +106,17 @@ class DatadogJSONFormatter(json_log_formatter.JSONFormatter):
 
     def json_record(self, message: str, record: LogRecord) -> Dict:
         """Convert the record to JSON and inject Datadog attributes."""
-        record_dict = dict(record.__dict__)
-
-        record_dict["message"] = message
-
-        additional = {
+        # built in one pass: record attributes take precedence over the defaults
+        record_dict: Dict = {
             "timestamp": int(record.created * 1000),
             "severity": record.levelname,
             "logger.name": record.name,
             "logger.method_name": record.funcName,
             "logger.thread_name": record.threadName,
+            **conf.DATADOG_DEFAULT_TAGS,
+            **record.__dict__,
+            "message": message,
         }
-
-        record_dict = {**additional, **conf.DATADOG_DEFAULT_TAGS, **record_dict}
         exc_info = record.exc_info
 
         # Handle exceptions, including those in our formatter
@@ -130,6 +131,54 @@ class DatadogJSONFormatter(json_log_formatter.JSONFormatter):
         return record_dict
 
 
+class DeferredQueueHandler(QueueHandler):
+    """ Queue handler that leaves formatting to the listener thread. Only the
+        message is resolved on the calling thread, since its arguments may
+        change after the logging call returns. """
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+""" Background thread writing queued records, when logging is queued """
+_listener: Optional[QueueListener] = None
+
+
+def start_listener(handler: logging.Handler) -> QueueHandler:
+    """ Route records through a queue to handler, which formats and writes them
+        on a background thread """
+    global _listener
+
+    stop_listener()
+    records: queue.Queue = queue.Queue()
+    _listener = QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    return DeferredQueueHandler(records)
+
+
+def stop_listener():
+    """ Write any queued records and stop the background thread """
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def flush():
+    """ Block until every queued record has been written. Must be called before
+        the Lambda handler returns, as the process may be frozen afterwards. """
+    if _listener is not None:
+        _listener.queue.join()
+        for handler in _listener.handlers:
+            handler.flush()
+
+
+atexit.register(stop_listener)
+
+
 def get_formatter(name: Union[str, None]) -> logging.Formatter:
     formatters = {
         "verbose": logging.Formatter(
@@ -169,7 +218,13 @@ def config(
     level: Union[int, str] = None,
     formatter: str = None,
     logger: Union[str, logging.Logger] = None,
+    queued: bool = None,
 ):
+    """ Configure the root logger (or the given logger) to write to the console.
+
+        If queued (default: LOG_QUEUE), records are formatted and written on a
+        background thread; call flush() before the process may be frozen.
+    """
 
     if isinstance(logger, str):
         logger = get_existing_logger_by_name(logger)
@@ -183,9 +238,14 @@ def config(
         root_logger = logging.getLogger()
         root_logger.setLevel(mlevel(level or conf.LOG_LEVEL or 20))
 
-    console_handler = ColorizingStreamHandler()
+    console_handler: logging.Handler = ColorizingStreamHandler()
     console_handler.setFormatter(get_formatter(formatter or conf.LOG_FORMAT))
 
+    if conf.LOG_QUEUE if queued is None else queued:
+        console_handler = start_listener(console_handler)
+    else:
+        stop_listener()
+
     while len(root_logger.handlers) > 0:
         root_logger.removeHandler(root_logger.handlers[0])
 
@@ -0,0 +1,167 @@
+""" Lightweight records for Terraform Cloud entities """
+
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from util.iterables import compile_query
+
+_configurable_id = compile_query("relationships.configurable.data.id")
+_workspace_id = compile_query("relationships.workspace.data.id")
+
+
+class Workspace:
+    __slots__ = ("workspace_id", "workspace_name", "latest_change_at", "tag_names")
+
+    def __init__(
+        self,
+        workspace_id: str,
+        workspace_name: str,
+        latest_change_at: str = None,
+        tag_names: List[str] = None,
+    ):
+        self.workspace_id = workspace_id
+        self.workspace_name = workspace_name
+        self.latest_change_at = latest_change_at
+        self.tag_names = tag_names or []
+
+    def __repr__(self):
+        return f"{self.workspace_id}/{self.workspace_name}"
+
+    @classmethod
+    def from_record(cls, record: Dict) -> "Workspace":
+        """ Create from a JSON:API workspace resource """
+        attrs = record.get("attributes") or {}
+        return cls(
+            workspace_id=record["id"],
+            workspace_name=attrs.get("name"),
+            latest_change_at=attrs.get("latest-change-at"),
+            tag_names=attrs.get("tag-names"),
+        )
+
+
+class Variable:
+    __slots__ = (
+        "variable_id",
+        "workspace_id",
+        "key",
+        "value",
+        "category",
+        "hcl",
+        "sensitive",
+        "description",
+    )
+
+    def __init__(
+        self,
+        variable_id: str,
+        workspace_id: Optional[str],
+        key: str,
+        value: Optional[str],
+        category: str,
+        hcl: bool = False,
+        sensitive: bool = False,
+        description: Optional[str] = None,
+    ):
+        self.variable_id = variable_id
+        self.workspace_id = workspace_id
+        self.key = key
+        self.value = value
+        self.category = category
+        self.hcl = hcl
+        self.sensitive = sensitive
+        self.description = description
+
+    def __repr__(self):
+        return f"{self.workspace_id}/{self.key}: {self.variable_id}"
+
+    @classmethod
+    def from_record(cls, record: Dict) -> "Variable":
+        """ Create from a JSON:API variable resource, keeping only the fields that
+            rotation compares. Repeated strings (keys, categories, workspace ids)
+            are interned, so each distinct value is stored once. """
+        attrs = record.get("attributes") or {}
+        workspace_id = _configurable_id(record)
+        if workspace_id is None:
+            workspace_id = _workspace_id(record)
+
+        key = attrs.get("key")
+        category = attrs.get("category")
+        return cls(
+            variable_id=record["id"],
+            workspace_id=sys.intern(workspace_id) if workspace_id else workspace_id,
+            key=sys.intern(key) if key else key,
+            value=attrs.get("value"),
+            category=sys.intern(category) if category else category,
+            hcl=bool(attrs.get("hcl")),
+            sensitive=bool(attrs.get("sensitive")),
+            description=attrs.get("description"),
+        )
+
+
+class VariableIndex:
+    """ Variables keyed by (workspace_id, key).
+
+        If category is given, variables in any other category are not indexed.
+    """
+
+    def __init__(self, variables: Iterable[Variable] = (), category: str = None):
+        self.category = category
+        self._index: Dict[Tuple[Optional[str], str], Variable] = {}
+        for variable in variables:
+            self.add(variable)
+
+    def __repr__(self):
+        return f"VariableIndex({len(self)} variables)"
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __iter__(self) -> Iterator[Variable]:
+        return iter(self._index.values())
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        return key in self._index
+
+    def add(self, variable: Variable):
+        if self.category is None or variable.category == self.category:
+            self._index[(variable.workspace_id, variable.key)] = variable
+
+    def get(self, workspace_id: str, key: str) -> Optional[Variable]:
+        return self._index.get((workspace_id, key))
+
+    def workspace_ids(self) -> List[str]:
+        return sorted({workspace_id for workspace_id, _ in self._index})
+
+
+class VariableSet:
+    __slots__ = ("varset_id", "name", "is_global", "workspace_ids", "variables")
+
+    def __init__(
+        self,
+        varset_id: str,
+        name: str,
+        is_global: bool = False,
+        workspace_ids: Iterable[str] = (),
+        variables: Iterable[Variable] = (),
+    ):
+        self.varset_id = varset_id
+        self.name = name
+        self.is_global = is_global
+        self.workspace_ids = set(workspace_ids)
+        self.variables = {x.key: x for x in variables}
+
+    def __repr__(self):
+        return f"{self.varset_id}/{self.name}"
+
+    @classmethod
+    def from_record(cls, record: Dict) -> "VariableSet":
+        """ Create from a JSON:API varset resource. Its variables are only
+            referenced by id there, so they are fetched separately. """
+        attrs = record.get("attributes") or {}
+        workspaces = (record.get("relationships") or {}).get("workspaces") or {}
+        return cls(
+            varset_id=record["id"],
+            name=attrs.get("name"),
+            is_global=bool(attrs.get("global")),
+            workspace_ids=[x["id"] for x in workspaces.get("data") or []],
+        )
@@ -0,0 +1,233 @@
+""" Client-side rate limiting for HTTP APIs that throttle per token """
+
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Deque, Optional
+
+import httpx
+from tracing import endpoint_name, span
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """ Async token bucket whose refill rate is tuned with AIMD: the rate grows
+        additively (by roughly `increase` requests/s per second of successful
+        traffic; default: a tenth of the rate after the last cut, so a halved
+        rate recovers in about ten seconds) and is cut multiplicatively by
+        `decrease` when the server throttles a request.
+
+        The rate is cut at most once per throttling episode: only a request sent
+        after the last cut, and throttled at least `episode` seconds after it,
+        can cut it again, as 429s for requests sent earlier say nothing about
+        the new rate. It is never cut below `decrease` times the rate the
+        server accepted over the last second.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: float = None,
+        min_rate: float = 1.0,
+        max_rate: float = None,
+        increase: float = None,
+        decrease: float = 0.5,
+        episode: float = 1.0,
+    ):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate or rate)
+        self.increase = increase
+        self.step = float(increase or max(1.0, self.rate / 10))
+        self.decrease = decrease
+        self.episode = episode
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until: float = 0.0
+        self.decreased_at: float = float("-inf")
+        self.accepted: Deque[float] = deque()
+        self._lock: Optional[asyncio.Lock] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def __repr__(self):
+        return f"TokenBucket(rate={self.rate:.2f}/s, tokens={self.tokens:.2f})"
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        """ Lock bound to the running event loop. Recreated if the bucket outlives
+            the loop it was first used on (e.g. across asyncio.run() calls) """
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._loop is not loop:
+            self._lock = asyncio.Lock()
+            self._loop = loop
+        return self._lock
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> float:
+        """ Wait until a token is available, then consume it
+
+            Returns:
+                float -- when the token was taken (time.monotonic()), to be
+                         passed to on_throttle if the request is throttled
+        """
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return now
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        now = time.monotonic()
+        self.accepted.append(now)
+        while self.accepted[0] < now - 1.0:
+            self.accepted.popleft()
+        self.rate = min(self.max_rate, self.rate + self.step / self.rate)
+
+    def on_throttle(self, delay: float, sent_at: float = None) -> bool:
+        """ Back off after the server rejected a request (sent at `sent_at`, as
+            returned by acquire) for exceeding its limit.
+
+            Returns:
+                bool -- whether this started a new episode: the rate was cut and
+                        every request paused for `delay`. Otherwise only the
+                        throttled request should wait before it is retried.
+        """
+        now = time.monotonic()
+        if (sent_at is not None and sent_at < self.decreased_at) or (
+            now < self.decreased_at + self.episode
+        ):
+            return False
+
+        # never below a `decrease` share of what the server accepted lately:
+        # requests still in flight can be rejected long after it stopped
+        # taking more than that
+        while self.accepted and self.accepted[0] < now - 1.0:
+            self.accepted.popleft()
+        floor = len(self.accepted) * self.decrease
+        self.rate = max(
+            self.min_rate, min(self.rate * self.decrease, self.max_rate), floor
+        )
+        self.step = float(self.increase or max(1.0, self.rate / 10))
+        self.decreased_at = now
+        self.tokens = 0.0
+        self.updated = now
+        self.blocked_until = max(self.blocked_until, now + delay)
+        logger.warning(
+            f"rate limited: pausing {delay:.2f}s, new rate {self.rate:.2f}/s"
+        )
+        return True
+
+
+def retry_after(response: httpx.Response, default: float = 1.0) -> float:
+    """ Seconds to wait before retrying a throttled response, read from the
+        Retry-After header (delta-seconds or HTTP-date) or X-RateLimit-Reset """
+    value = response.headers.get("Retry-After")
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+
+    value = response.headers.get("X-RateLimit-Reset")
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+
+    return default
+
+
+class RateLimitedClient:
+    """ Wraps an httpx.AsyncClient so that every request draws from a shared
+        TokenBucket and throttled (429) requests are retried after the delay
+        requested by the server, or `backoff` * 2 ** attempt seconds if longer.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        bucket: TokenBucket,
+        max_retries: int = 5,
+        backoff: float = 0.05,
+        shared: bool = False,
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.shared = shared
+
+    async def __aenter__(self):
+        await self.client.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc):
+        # a shared client keeps its connection pool open until aclose()
+        if not self.shared:
+            await self.client.__aexit__(*exc)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def request(self, method: str, url, **kwargs) -> httpx.Response:
+        attempt = 0
+        name = f"tfc {endpoint_name(method, httpx.URL(url).path)}"
+        while True:
+            sent_at = await self.bucket.acquire()
+            with span(name):
+                response = await self.client.request(method, url, **kwargs)
+
+            limit = response.headers.get("X-RateLimit-Limit")
+            if limit:
+                try:
+                    self.bucket.max_rate = float(limit)
+                except ValueError:
+                    pass
+
+            if response.status_code != 429:
+                self.bucket.on_success()
+                return response
+
+            if attempt >= self.max_retries:
+                logger.error(f"{method} {url} still throttled after {attempt} retries")
+                return response
+
+            attempt += 1
+            delay = retry_after(response, default=float(2 ** attempt))
+            if not self.bucket.on_throttle(delay, sent_at=sent_at):
+                # back off exponentially (with jitter, so requests rejected
+                # together do not collide again) while the rate settles
+                wait = max(delay, self.backoff * 2 ** attempt)
+                await asyncio.sleep(wait * random.uniform(1, 1.5))
+
+    async def get(self, url, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def patch(self, url, **kwargs) -> httpx.Response:
+        return await self.request("PATCH", url, **kwargs)
+
+    async def delete(self, url, **kwargs) -> httpx.Response:
+        return await self.request("DELETE", url, **kwargs)
@@ -0,0 +1,88 @@
+""" Wait for a newly created access key to become usable before the key it
+    replaces is deleted.
+
+    IAM is eventually consistent: a new key can be rejected for a while after
+    it is created. The probe signs STS GetCallerIdentity with the new key until
+    it succeeds, backing off exponentially with full jitter, and gives up once
+    KEY_READY_TIMEOUT (or the invocation's deadline) is reached.
+
+    Example:
+        task = terraform.event_loop().create_task(probe(rm.new, username))
+        ...  # the probe runs while variables are written
+        if terraform.run(task):
+            rm.delete_previous_key()
+"""
+
+import asyncio
+import logging
+import random
+from timeit import default_timer as timer
+from typing import Dict, Iterator, Optional
+
+import config as conf
+from util.timing import Deadline
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delays(base: float, maximum: float) -> Iterator[float]:
+    """ Exponential backoff with full jitter: attempt n waits a random time of up
+        to min(maximum, base * 2^n) seconds """
+    attempt = 0
+    while True:
+        yield random.uniform(0, min(maximum, base * 2 ** attempt))
+        attempt += 1
+
+
+def error_code(e: Exception) -> str:
+    return getattr(e, "response", {}).get("Error", {}).get("Code") or type(e).__name__
+
+
+async def probe(
+    credentials: Dict[str, str],
+    iam_username: str,
+    timeout: float = None,
+    deadline: Optional[Deadline] = None,
+) -> bool:
+    """ Whether the credentials authenticate within timeout (default:
+        KEY_READY_TIMEOUT) seconds, or before the deadline if sooner """
+    from key_rotation import credentials_client
+
+    key_id = credentials.get("AWS_ACCESS_KEY_ID")
+    timeout = conf.KEY_READY_TIMEOUT if timeout is None else timeout
+    remaining = deadline.remaining() if deadline else None
+    if remaining is not None:
+        timeout = min(timeout, max(remaining, 0.0))
+
+    loop = asyncio.get_running_loop()
+    ts = timer()
+    sts = None
+    delays = backoff_delays(conf.KEY_READY_BACKOFF, conf.KEY_READY_MAX_BACKOFF)
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            if sts is None:
+                sts = await loop.run_in_executor(
+                    None, credentials_client, "sts", credentials
+                )
+            await loop.run_in_executor(None, sts.get_caller_identity)
+            logger.info(
+                f"({iam_username}) new key {key_id} is valid after {attempt} attempts ({timer() - ts:.1f}s)"  # noqa
+            )
+            return True
+        except Exception as e:
+            code = error_code(e)
+
+        delay = next(delays)
+        elapsed = timer() - ts
+        if elapsed + delay > timeout:
+            logger.error(
+                f"({iam_username}) new key {key_id} still rejected after {attempt} attempts ({elapsed:.1f}s): {code}"  # noqa
+            )
+            return False
+
+        logger.debug(
+            f"({iam_username}) new key {key_id} not valid yet ({code}), retrying in {delay:.2f}s"  # noqa
+        )
+        await asyncio.sleep(delay)
@@ -0,0 +1,102 @@
+""" Select the workspaces that credentials are rotated in """
+
+import fnmatch
+import re
+from typing import Dict, Iterable, List, Pattern
+
+import config as conf
+from models import Workspace
+
+
+def compile_pattern(pattern: str) -> Pattern:
+    """ Compile a workspace name pattern. Patterns prefixed with "re:" are treated
+        as regular expressions, anything else as a glob (or an exact name).
+        Either kind must match the whole name: "re:prod" selects "prod" but not
+        "production-old" (use "re:prod.*" for that). """
+    if pattern.startswith("re:"):
+        return re.compile(pattern[3:])
+    return re.compile(fnmatch.translate(pattern))
+
+
+class WorkspaceSelector:
+    """ Filters workspaces by name (globs or regexes) and tags.
+
+        Tags and the name search term are also sent to the API as search
+        filters, so fewer workspaces are transferred in the first place. Every
+        condition is re-checked locally.
+    """
+
+    def __init__(
+        self,
+        include: Iterable[str] = (),
+        exclude: Iterable[str] = (),
+        tags: Iterable[str] = (),
+        exclude_tags: Iterable[str] = (),
+        search: str = None,
+    ):
+        self.include = [x for x in include if x]
+        self.exclude = [x for x in exclude if x]
+        self.tags = [x for x in tags if x]
+        self.exclude_tags = [x for x in exclude_tags if x]
+        self.search = search or None
+        self._include = [compile_pattern(x) for x in self.include]
+        self._exclude = [compile_pattern(x) for x in self.exclude]
+
+    def __repr__(self):
+        return f"WorkspaceSelector({self.cache_key() or 'all'})"
+
+    @classmethod
+    def from_config(cls) -> "WorkspaceSelector":
+        return cls(
+            include=conf.TF_WORKSPACE_INCLUDE,
+            exclude=conf.TF_WORKSPACE_EXCLUDE,
+            tags=conf.TF_WORKSPACE_TAGS,
+            exclude_tags=conf.TF_WORKSPACE_EXCLUDE_TAGS,
+            search=conf.TF_WORKSPACE_SEARCH,
+        )
+
+    @property
+    def active(self) -> bool:
+        return any(
+            [self.include, self.exclude, self.tags, self.exclude_tags, self.search]
+        )
+
+    def params(self) -> Dict[str, str]:
+        """ Server-side search filters for the workspace list endpoint """
+        params = {}
+        if self.search:
+            params["search[name]"] = self.search
+        if self.tags:
+            params["search[tags]"] = ",".join(self.tags)
+        if self.exclude_tags:
+            params["search[exclude-tags]"] = ",".join(self.exclude_tags)
+        return params
+
+    def cache_key(self) -> str:
+        parts = [
+            ("include", self.include),
+            ("exclude", self.exclude),
+            ("tags", self.tags),
+            ("exclude_tags", self.exclude_tags),
+            ("search", [self.search] if self.search else []),
+        ]
+        return ";".join(f"{k}={','.join(v)}" for k, v in parts if v)
+
+    def matches(self, workspace: Workspace) -> bool:
+        name = workspace.workspace_name or ""
+        tags = set(workspace.tag_names or [])
+
+        if self.search and self.search.lower() not in name.lower():
+            return False
+        if self.tags and not tags.issuperset(self.tags):
+            return False
+        if self.exclude_tags and tags.intersection(self.exclude_tags):
+            return False
+        if self._include and not any(p.fullmatch(name) for p in self._include):
+            return False
+        if any(p.fullmatch(name) for p in self._exclude):
+            return False
+        return True
+
+    def select(self, workspaces: Iterable[Workspace]) -> List[Workspace]:
+        return [x for x in workspaces if self.matches(x)]
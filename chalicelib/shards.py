@@ -0,0 +1,282 @@
+""" Fan variable writes out to parallel workers.
+
+    The coordinator (rotate_keys) creates the key, discovers workspaces and
+    plans every write as usual. The planned writes are then split into shards
+    of SHARD_SIZE workspaces, and each shard is sent to a worker which writes it
+    and reports which variables succeeded. Workers never touch IAM.
+
+    Executors are pluggable and selected with SHARD_EXECUTOR:
+        process: a local process pool (SHARD_WORKERS processes), for testing
+        lambda: synchronous invocations of the worker Lambda function
+                (SHARD_FUNCTION_NAME), SHARD_WORKERS at a time
+
+    Workers share the TFC token's rate limit, so each one is given an equal
+    part of TF_RATE_LIMIT. Shards carry the new credentials, so the Lambda
+    backend relies on the invocation payload staying inside the account.
+"""
+
+import json
+import logging
+import multiprocessing
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import config as conf
+from util.iterables import chunks
+from util.timing import Deadline
+
+logger = logging.getLogger(__name__)
+
+
+def make_shards(
+    tfvars: Iterable[Tuple[str, object]], size: int, rate_limit: float = None
+) -> List[Dict]:
+    """ Split (workspace_name, TFVar) writes into shards of at most `size`
+        workspaces. A workspace's writes always land in the same shard. """
+    by_workspace: Dict[str, List[Dict]] = defaultdict(list)
+    for workspace_name, var in tfvars:
+        by_workspace[workspace_name].append(var.to_dict())
+
+    return [
+        {
+            "shard_id": number,
+            "rate_limit": rate_limit,
+            "writes": {name: by_workspace[name] for name in names},
+        }
+        for number, names in enumerate(chunks(sorted(by_workspace), max(size, 1)))
+    ]
+
+
+def run_shard(shard: Dict) -> Dict:
+    """ Worker: write a shard's variables and report the outcome of each.
+
+        Returns:
+            Dict -- shard_id, plus succeeded (workspace -> keys) and
+                    failed (workspace -> [[key, error]])
+    """
+    import terraform
+
+    if shard.get("rate_limit"):
+        bucket = terraform.bucket()
+        bucket.rate = bucket.max_rate = bucket.capacity = shard["rate_limit"]
+        bucket.tokens = min(bucket.tokens, bucket.capacity)
+
+    tfvars = [
+        (workspace_name, terraform.TFVar.from_dict(data))
+        for workspace_name, writes in shard["writes"].items()
+        for data in writes
+    ]
+    results = terraform.run(terraform.write_variables(tfvars))
+    logger.info(f"(shard {shard['shard_id']}) {results}")
+
+    return {
+        "shard_id": shard["shard_id"],
+        "succeeded": {
+            name: [var.key for var in variables]
+            for name, variables in results.succeeded.items()
+        },
+        "failed": {
+            name: [[var.key, str(e)] for var, e in failures]
+            for name, failures in results.failed.items()
+        },
+    }
+
+
+class ShardExecutor(ABC):
+    """ Runs shards on workers: `run` is submitted to the executor's `pool()`,
+        at most max_workers shards at a time. A shard that could not be run at
+        all is reported as an exception instead of a result. """
+
+    max_workers: int = 1
+
+    @abstractmethod
+    def pool(self) -> Executor:
+        ...
+
+    @abstractmethod
+    def run(self, shard: Dict) -> object:
+        ...
+
+
+class ProcessExecutor(ShardExecutor):
+    def __init__(self, max_workers: int, start_method: str = None):
+        self.max_workers = max_workers
+        self.start_method = start_method
+
+    def __repr__(self):
+        return f"ProcessExecutor({self.max_workers} workers)"
+
+    def pool(self) -> Executor:
+        context = multiprocessing.get_context(self.start_method)
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+
+    def run(self, shard: Dict) -> object:
+        return run_shard(shard)
+
+
+class LambdaExecutor(ShardExecutor):
+    def __init__(self, function_name: str, max_workers: int):
+        self.function_name = function_name
+        self.max_workers = max_workers
+        self.client = None
+
+    def __repr__(self):
+        return f"LambdaExecutor({self.function_name}, {self.max_workers} workers)"
+
+    def connect(self):
+        """ Invocations wait for the worker to finish, which may take up to the
+            worker's timeout, and must not be retried once sent """
+        import boto3
+        from botocore.config import Config
+        from tracing import TracedClient
+
+        if self.client is None:
+            self.client = TracedClient(
+                boto3.client(
+                    "lambda",
+                    config=Config(read_timeout=900, retries={"max_attempts": 0}),
+                ),
+                prefix="lambda",
+            )
+        return self.client
+
+    def pool(self) -> Executor:
+        self.connect()
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def run(self, shard: Dict) -> object:
+        try:
+            response = self.client.invoke(
+                FunctionName=self.function_name,
+                InvocationType="RequestResponse",
+                Payload=json.dumps(shard).encode("utf-8"),
+            )
+            payload = json.loads(response["Payload"].read() or b"null")
+            if response.get("FunctionError"):
+                message = payload.get("errorMessage") if payload else None
+                return RuntimeError(f"{response['FunctionError']}: {message}")
+            return payload
+        except Exception as e:
+            return e
+
+
+EXECUTORS: Dict[str, Callable[[], ShardExecutor]] = {
+    "process": lambda: ProcessExecutor(conf.SHARD_WORKERS),
+    "lambda": lambda: LambdaExecutor(conf.SHARD_FUNCTION_NAME, conf.SHARD_WORKERS),
+}
+
+
+def register_executor(name: str, factory: Callable[[], ShardExecutor]):
+    """ Make an executor available as SHARD_EXECUTOR=<name> """
+    EXECUTORS[name] = factory
+
+
+def get_executor(name: str = None) -> ShardExecutor:
+    name = name or conf.SHARD_EXECUTOR
+    try:
+        return EXECUTORS[name]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown shard executor: {name}. Available options: {', '.join(EXECUTORS)}"
+        )
+
+
+def collect_shard(shard: Dict, outcome: object, variables: Dict):
+    """ WriteResults of a shard, from the worker's report (or the exception
+        raised instead) """
+    from terraform import WriteResults
+
+    results = WriteResults()
+    if not isinstance(outcome, dict):
+        error = RuntimeError(f"shard {shard['shard_id']} failed: {outcome}")
+        for name, writes in shard["writes"].items():
+            for data in writes:
+                results.failed[name].append((variables[(name, data["key"])], error))
+        return results
+
+    for name, keys in outcome.get("succeeded", {}).items():
+        results.succeeded[name].extend(variables[(name, key)] for key in keys)
+    for name, failures in outcome.get("failed", {}).items():
+        for key, message in failures:
+            results.failed[name].append((variables[(name, key)], Exception(message)))
+    return results
+
+
+def write_sharded(
+    workspaces: List,
+    tfvars: List[Tuple[str, object]],
+    journal,
+    deadline: Deadline = None,
+    executor: ShardExecutor = None,
+):
+    """ Coordinator: write variables through SHARD_SIZE workspace shards run in
+        parallel, recording each shard's workspaces in the journal as soon as
+        the shard finishes, once all of a workspace's variables are written.
+
+        Like write_journaled (see terraform.write_chunks), a shard is only
+        dispatched if the slowest shard so far would finish before the
+        deadline, and the coordinator stops waiting for running shards once the
+        deadline is reached. Their workspaces are left pending for the next
+        invocation.
+
+        Returns:
+            Tuple[WriteResults, bool] -- results, and whether every shard finished
+    """
+    from terraform import write_chunks
+
+    executor = executor or get_executor()
+    shards = make_shards(
+        tfvars,
+        conf.SHARD_SIZE,
+        rate_limit=conf.TF_RATE_LIMIT / max(executor.max_workers, 1),
+    )
+    logger.info(
+        f"({journal.iam_username}) dispatching {len(tfvars)} writes in {len(shards)} shards to {executor}"  # noqa
+    )
+
+    # workspaces without writes already hold the current values
+    planned = {name for name, _ in tfvars}
+    journal.complete(
+        x.workspace_name for x in workspaces if x.workspace_name not in planned
+    )
+
+    variables = {(name, var.key): var for name, var in tfvars}
+    by_names = {tuple(x["writes"]): x for x in shards}
+    pool = executor.pool()
+
+    def write(names: List[str]) -> Future:
+        shard = by_names[tuple(names)]
+        collected: Future = Future()
+
+        def collect(future: Future):
+            outcome = future.exception() or future.result()
+            if not isinstance(outcome, dict):
+                logger.error(
+                    f"({journal.iam_username}) shard {shard['shard_id']} failed -- {outcome}"  # noqa
+                )
+            collected.set_result(collect_shard(shard, outcome, variables))
+
+        pool.submit(executor.run, shard).add_done_callback(collect)
+        return collected
+
+    finished = False
+    try:
+        results, finished = write_chunks(
+            [list(x["writes"]) for x in shards],
+            write,
+            journal,
+            deadline,
+            max_workers=executor.max_workers,
+        )
+    finally:
+        # shards still running are abandoned: their workers finish on their own
+        pool.shutdown(wait=finished)
+
+    return results, finished
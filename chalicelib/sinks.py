@@ -0,0 +1,289 @@
+""" Deliver the rotated key to destinations other than Terraform Cloud.
+
+    Terraform Cloud remains the primary destination (journaled, see
+    terraform.rotate_keys). Every sink listed in CREDENTIAL_SINKS receives the
+    same key in the same invocation, concurrently with the Terraform Cloud
+    writes, and the previous key is only deleted once every sink has applied
+    and verified it.
+
+    A sink implements three steps:
+        plan: the changes that would bring the destination up to date
+        apply: make those changes
+        verify: read the destination back to confirm it holds the new key
+
+    Each sink runs its blocking calls on the default thread pool, at most
+    `concurrency` at a time. Sinks must be idempotent: a resumed rotation
+    delivers to them again. Other sinks are added with register_sink().
+
+    Built in:
+        ssm: SecureString parameters under SINK_SSM_PATH
+        dotenv: KEY=value lines in the file at SINK_DOTENV_PATH
+"""
+
+import asyncio
+import json
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import IO, Callable, Dict, List, Optional
+
+import config as conf
+from changeset import Action
+
+logger = logging.getLogger(__name__)
+
+
+class CredentialSink(ABC):
+    """ Destination for rotated credentials """
+
+    name: str = ""
+    concurrency: int = 1
+
+    def __init__(self):
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.name})"
+
+    async def call(self, func: Callable, *args):
+        """ Run a blocking call on the thread pool, within the sink's concurrency
+            limit """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    @abstractmethod
+    async def plan(self, credentials: Dict[str, str]) -> List[Dict]:
+        """ Changes needed, one per credential: key, action and target. Never
+            includes values. """
+
+    @abstractmethod
+    async def apply(self, credentials: Dict[str, str], changes: List[Dict]):
+        ...
+
+    @abstractmethod
+    async def verify(self, credentials: Dict[str, str]) -> bool:
+        ...
+
+    def diff(
+        self,
+        credentials: Dict[str, str],
+        existing: Dict[str, str],
+        target: Callable[[str], str],
+    ) -> List[Dict]:
+        """ Changes bringing existing values (by key) to the credentials """
+        changes = []
+        for key, value in credentials.items():
+            if key not in existing:
+                action = Action.CREATE
+            elif existing[key] != value:
+                action = Action.UPDATE
+            else:
+                action = Action.NOOP
+            changes.append(
+                {
+                    "sink": self.name,
+                    "key": key,
+                    "action": action.value,
+                    "target": target(key),
+                }
+            )
+        return changes
+
+
+class SSMSink(CredentialSink):
+    """ One parameter per credential under `path`. Sensitive credentials are
+        SecureStrings. The path must not be one loaded by ssm.load(). """
+
+    name = "ssm"
+
+    def __init__(self, path: str, kms_key_id: str = None, concurrency: int = 4):
+        super().__init__()
+        self.path = path.rstrip("/")
+        self.kms_key_id = kms_key_id
+        self.concurrency = concurrency
+
+    def __repr__(self):
+        return f"SSMSink({self.path})"
+
+    def parameter_name(self, key: str) -> str:
+        return f"{self.path}/{key}"
+
+    def fetch(self, keys: List[str]) -> Dict[str, str]:
+        """ Current values by credential key """
+        from key_rotation import client
+
+        response = client("ssm").get_parameters(
+            Names=[self.parameter_name(x) for x in keys], WithDecryption=True
+        )
+        return {
+            x["Name"].rsplit("/", 1)[-1]: x["Value"]
+            for x in response.get("Parameters", [])
+        }
+
+    def put(self, key: str, value: str):
+        from key_rotation import client
+        from terraform import NON_SENSITIVE_KEYS
+
+        secure = key not in NON_SENSITIVE_KEYS
+        params = {
+            "Name": self.parameter_name(key),
+            "Value": value,
+            "Type": "SecureString" if secure else "String",
+            "Overwrite": True,
+        }
+        if secure and self.kms_key_id:
+            params["KeyId"] = self.kms_key_id
+        client("ssm").put_parameter(**params)
+
+    async def plan(self, credentials: Dict[str, str]) -> List[Dict]:
+        existing = await self.call(self.fetch, list(credentials))
+        return self.diff(credentials, existing, self.parameter_name)
+
+    async def apply(self, credentials: Dict[str, str], changes: List[Dict]):
+        await asyncio.gather(
+            *[
+                self.call(self.put, x["key"], credentials[x["key"]])
+                for x in changes
+                if x["action"] != Action.NOOP.value
+            ]
+        )
+
+    async def verify(self, credentials: Dict[str, str]) -> bool:
+        return await self.call(self.fetch, list(credentials)) == credentials
+
+
+class DotenvSink(CredentialSink):
+    """ KEY=value lines in a local file, e.g. for a process sharing the
+        filesystem. Lines for other keys are kept. Written atomically and
+        readable only by the owner. """
+
+    name = "dotenv"
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    def __repr__(self):
+        return f"DotenvSink({self.path})"
+
+    def read(self) -> Dict[str, str]:
+        if not os.path.exists(self.path):
+            return {}
+        values = {}
+        with open(self.path) as f:
+            for line in f:
+                key, sep, value = line.strip().partition("=")
+                if sep and not key.startswith("#"):
+                    values[key.strip()] = value.strip()
+        return values
+
+    def write(self, values: Dict[str, str]):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        fd = os.open(f"{self.path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.writelines(f"{k}={v}\n" for k, v in values.items())
+        os.replace(f"{self.path}.tmp", self.path)
+
+    async def plan(self, credentials: Dict[str, str]) -> List[Dict]:
+        existing = await self.call(self.read)
+        return self.diff(credentials, existing, lambda key: self.path)
+
+    async def apply(self, credentials: Dict[str, str], changes: List[Dict]):
+        if any(x["action"] != Action.NOOP.value for x in changes):
+            existing = await self.call(self.read)
+            await self.call(self.write, {**existing, **credentials})
+
+    async def verify(self, credentials: Dict[str, str]) -> bool:
+        existing = await self.call(self.read)
+        return all(existing.get(k) == v for k, v in credentials.items())
+
+
+SINKS: Dict[str, Callable[[], CredentialSink]] = {
+    "ssm": lambda: SSMSink(
+        conf.SINK_SSM_PATH, conf.SINK_SSM_KMS_KEY_ID, conf.SINK_SSM_CONCURRENCY
+    ),
+    "dotenv": lambda: DotenvSink(conf.SINK_DOTENV_PATH),
+}
+
+
+def register_sink(name: str, factory: Callable[[], CredentialSink]):
+    """ Make a sink available as CREDENTIAL_SINKS=<name> """
+    SINKS[name] = factory
+
+
+def get_sinks(names: List[str] = None) -> List[CredentialSink]:
+    """ The configured sinks (default: CREDENTIAL_SINKS) """
+    names = list(conf.CREDENTIAL_SINKS if names is None else names)
+    unknown = [x for x in names if x not in SINKS]
+    if unknown:
+        raise ValueError(
+            f"Unknown credential sinks: {', '.join(unknown)}. Available options: {', '.join(SINKS)}"  # noqa
+        )
+    return [SINKS[x]() for x in names]
+
+
+class SinkResult:
+    __slots__ = ("sink", "changes", "verified", "error")
+
+    def __init__(self, sink: CredentialSink):
+        self.sink = sink
+        self.changes: List[Dict] = []
+        self.verified = False
+        self.error: Optional[Exception] = None
+
+    def __repr__(self):
+        return f"{self.sink}: {'ok' if self.ok else f'failed ({self.error})'}"
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.verified
+
+    def to_dict(self) -> Dict:
+        return {
+            "sink": self.sink.name,
+            "ok": self.ok,
+            "changes": sum(x["action"] != Action.NOOP.value for x in self.changes),
+            "error": str(self.error) if self.error else None,
+        }
+
+
+async def plan(sinks: List[CredentialSink], credentials: Dict[str, str]) -> List[Dict]:
+    """ Changes planned by every sink """
+    plans = await asyncio.gather(*[x.plan(credentials) for x in sinks])
+    return [change for changes in plans for change in changes]
+
+
+async def deliver(
+    sinks: List[CredentialSink], credentials: Dict[str, str], iam_username: str
+) -> List[SinkResult]:
+    """ Plan, apply and verify the credentials on every sink concurrently. A
+        failing sink does not stop the others. """
+
+    async def run_sink(sink: CredentialSink) -> SinkResult:
+        result = SinkResult(sink)
+        try:
+            result.changes = await sink.plan(credentials)
+            await sink.apply(credentials, result.changes)
+            result.verified = await sink.verify(credentials)
+            if result.verified:
+                logger.info(f"({iam_username}) delivered credentials to {sink}")
+            else:
+                logger.error(f"({iam_username}) {sink} does not hold the new key")
+        except Exception as e:
+            logger.exception(f"({iam_username}) failed to deliver to {sink} -- {e}")
+            result.error = e
+        return result
+
+    return list(await asyncio.gather(*[run_sink(x) for x in sinks]))
+
+
+def write_ndjson(changes: List[Dict], stream: IO[str]) -> int:
+    """ Stream planned sink changes as newline delimited JSON, like
+        Changeset.write_ndjson """
+    for change in changes:
+        stream.write(json.dumps(change) + "\n")
+    return len(changes)
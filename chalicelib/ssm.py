@@ -1,49 +1,132 @@
+import functools
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+from typing import Dict, List, Optional, Tuple
 
-import boto3
-
-ssm = boto3.client("ssm")
+from tracing import span, traced
 
 logging.basicConfig(level=20)
 
 logger = logging.getLogger("ssm")
 logger.setLevel(20)
 
+""" Largest page size accepted by GetParametersByPath """
+MAX_RESULTS: int = 10
 
-def ssm_load_config(ssm_parameter_path: str):
-    """ Load variables at the specified path from the SSM Parameter Store """
+""" Decrypted parameters by path: (expires_at, {name: value}) """
+_cache: Dict[str, Tuple[float, Dict[str, str]]] = {}
+
+""" Duration of the most recent call to load(), in seconds """
+last_load_time: Optional[float] = None
+
+
+@functools.lru_cache(maxsize=None)
+def client():
+    """ SSM client, created on first use """
+    import boto3
+
+    return boto3.client("ssm")
+
+
+@traced("ssm.get_parameters_by_path")
+def fetch_parameters(ssm_parameter_path: str) -> Dict[str, str]:
+    """ Fetch and decrypt every parameter at the specified path, following
+        pagination until all pages have been read """
+    paginator = client().get_paginator("get_parameters_by_path")
+    pages = paginator.paginate(
+        Path=ssm_parameter_path,
+        Recursive=False,
+        WithDecryption=True,
+        PaginationConfig={"PageSize": MAX_RESULTS},
+    )
+
+    params: Dict[str, str] = {}
+    for page in pages:
+        for param in page.get("Parameters", []):
+            name = (
+                param["Name"].replace(ssm_parameter_path, "").replace("/", "").upper()
+            )
+            params[name] = param["Value"]
+    return params
+
+
+def get_parameters(ssm_parameter_path: str, ttl: float = 0) -> Dict[str, str]:
+    """ Parameters at the specified path, reusing values fetched less than ttl
+        seconds ago. Errors are logged and result in no parameters. """
     logger.info(f"(SSM) pulling configuration from {ssm_parameter_path}")
     try:
-        # Get all parameters for this app
-        param_details = ssm.get_parameters_by_path(
-            Path=ssm_parameter_path, Recursive=False, WithDecryption=True
-        )
-
-        # Loop through the returned parameters and populate the ConfigParser
-        loaded = []
-        if "Parameters" in param_details and len(param_details.get("Parameters")) > 0:
-            for param in param_details.get("Parameters"):
-                name = (
-                    param["Name"]
-                    .replace(ssm_parameter_path, "")
-                    .replace("/", "")
-                    .upper()
-                )
-                value = param["Value"]
-                os.environ[name] = value
-                loaded.append(name)
-        logger.info(f"(SSM) loaded {len(loaded)} variables: {loaded}")
+        expires, params = _cache.get(ssm_parameter_path, (0.0, {}))
+        if time.time() >= expires:
+            params = fetch_parameters(ssm_parameter_path)
+            _cache[ssm_parameter_path] = (time.time() + ttl, params)
+        else:
+            logger.info(f"(SSM) using cached configuration for {ssm_parameter_path}")
+        return params
 
     except Exception as e:
         logger.exception(f"Encountered an error loading config from SSM -- {e}")
+        return {}
+
+
+def apply(params: Dict[str, str]) -> List[str]:
+    """ Export parameters to the environment """
+    for name, value in params.items():
+        os.environ[name] = value
+    loaded = list(params)
+    logger.info(f"(SSM) loaded {len(loaded)} variables: {loaded}")
+    return loaded
+
+
+def ssm_load_config(ssm_parameter_path: str, ttl: float = 0) -> List[str]:
+    """ Load variables at the specified path from the SSM Parameter Store """
+    return apply(get_parameters(ssm_parameter_path, ttl=ttl))
+
+
+def paths() -> List[str]:
+    """ Parameter paths to load: /APP_NAME, plus any listed in SSM_EXTRA_PATHS
+        (comma separated, e.g. "/datadog") """
+    try:
+        app_name = os.environ["APP_NAME"]
+    except KeyError as ke:
+        logger.error("APP_NAME not found in environment")
+        raise ke
+
+    extra = [x.strip() for x in os.getenv("SSM_EXTRA_PATHS", "").split(",")]
+    return ["/" + app_name] + [x for x in extra if x]
+
+
+def load(force: bool = False, ttl: float = None) -> Dict[str, List[str]]:
+    """ Load the parameters of every configured path concurrently. Parameters are
+        cached in memory for SSM_CACHE_TTL seconds (default: 300), so warm
+        invocations don't go back to SSM unless force=True.
+
+        Returns:
+            Dict[str, List[str]] -- names of the variables loaded from each path
+    """
+    global last_load_time
 
+    ttl = float(os.getenv("SSM_CACHE_TTL", 300)) if ttl is None else ttl
+    if force:
+        _cache.clear()
 
-try:
-    app_name = os.environ["APP_NAME"]
-except KeyError as ke:
-    logger.error("APP_NAME not found in environment")
-    raise ke
+    ts = timer()
+    targets = paths()
+    client()  # creating clients is not thread-safe
+    with span("ssm.load"):
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            fetched = list(executor.map(lambda p: get_parameters(p, ttl=ttl), targets))
 
+    # the app's own path is applied last, so it takes precedence over shared paths
+    loaded = {
+        path: apply(params) for path, params in reversed(list(zip(targets, fetched)))
+    }
+    last_load_time = round(timer() - ts, 3)
 
-ssm_load_config("/" + app_name)
+    logger.info(
+        f"(SSM) loaded {sum(len(x) for x in loaded.values())} variables from {len(targets)} paths in {last_load_time}s",  # noqa
+        extra={"exc_time": last_load_time, "ssm_paths": targets},
+    )
+    return loaded
@@ -1,24 +1,75 @@
+import asyncio
+import functools
+import json
 import logging
+import os
+import sys
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from datetime import datetime, timedelta, timezone
 from enum import Enum
-from typing import Dict, Optional, Union
+from timeit import default_timer as timer
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Collection,
+    Coroutine,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
+import cache
 import config as conf
 import httpx
-import pandas as pd
-from key_rotation import RotationManager
+import jsonapi
+import readiness
+import sinks
+import ssm
+from catalog import Catalog, format_timestamp, parse_timestamp
+from changeset import Changeset, diff
+from journal import RotationJournal, get_store
+from key_rotation import CREDENTIAL_DESCRIPTIONS, RotationManager
+from models import Variable, VariableIndex, Workspace
+from ratelimit import RateLimitedClient, TokenBucket
+from selection import WorkspaceSelector
+from tracing import traced, tracer
+from util.iterables import chunks
+from util.timing import Deadline, PhaseTimer
 
 logger = logging.getLogger(__name__)
 
 
-BASE_URL = httpx.URL("https://app.terraform.io/api/v2/")
+BASE_URL = httpx.URL(conf.TF_API_URL.rstrip("/") + "/")
 
-WORKSPACE_URL = BASE_URL.join(f"organizations/{conf.TF_ORG_NAME}/workspaces")
 VARS_URL = BASE_URL.join("vars/")
 
-HEADERS = {
-    "Authorization": f"Bearer {conf.TF_TOKEN}",
-    "Content-Type": "application/vnd.api+json",
-}
+""" Credentials that are written as non-sensitive variables """
+NON_SENSITIVE_KEYS = ("AWS_IAM_ROLE", "LAST_ROTATED")
+
+
+@functools.lru_cache(maxsize=None)
+def workspace_url() -> httpx.URL:
+    return BASE_URL.join(f"organizations/{conf.TF_ORG_NAME}/workspaces")
+
+
+@functools.lru_cache(maxsize=None)
+def headers() -> Dict[str, str]:
+    return {
+        "Authorization": f"Bearer {conf.TF_TOKEN}",
+        "Content-Type": "application/vnd.api+json",
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def bucket() -> TokenBucket:
+    """ Shared by every request to the TFC API, which limits requests per token """
+    return TokenBucket(rate=conf.TF_RATE_LIMIT)
 
 
 class VarCategory(str, Enum):
@@ -31,76 +82,337 @@ class EntityType(str, Enum):
     WS = "workspaces"
 
 
-def get_workspaces() -> pd.DataFrame:
-    logger.debug(f"({conf.TF_ORG_NAME}) fetching workspaces: {WORKSPACE_URL}")
-    response = httpx.get(WORKSPACE_URL, headers=HEADERS)
-    workspaces = pd.DataFrame(response.json()["data"])  # type: ignore
-    attrs = pd.DataFrame(workspaces.attributes.values.tolist())
-    workspaces = (
-        workspaces.loc[:, ["id"]]
-        .join(
-            attrs.loc[
-                :,
-                [
-                    "name",
-                    "auto-apply",
-                    "vcs-repo-identifier",
-                    "working-directory",
-                    "allow-destroy-plan",
-                    "terraform-version",
-                    "locked",
-                    "latest-change-at",
-                    "created-at",
-                ],
-            ]
+""" ASGI app that requests are sent to instead of the network, e.g. a local
+    stand-in for the TFC API (see benchmarks/fake_tfc.py) """
+asgi_app: Optional[Callable] = None
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_pid: Optional[int] = None
+
+
+def event_loop() -> asyncio.AbstractEventLoop:
+    """ Event loop kept for the life of the process (and so across warm
+        invocations), which the shared client's connections are bound to """
+    global _loop, _loop_pid
+    if _loop is None or _loop.is_closed() or _loop_pid != os.getpid():
+        _loop = asyncio.new_event_loop()
+        _loop_pid = os.getpid()
+    return _loop
+
+
+def run(coro: Coroutine):
+    """ Run a coroutine to completion from synchronous code """
+    return event_loop().run_until_complete(coro)
+
+
+_client: Optional[RateLimitedClient] = None
+_client_key: Optional[Tuple] = None
+
+
+def async_client() -> RateLimitedClient:
+    """ Client shared by every request to the TFC API, so connections (and their
+        TLS sessions) are pooled and kept alive between calls and warm
+        invocations. Replaced when used from another event loop or process, or
+        when asgi_app changes. Leaving `async with` does not close it. """
+    global _client, _client_key
+    key = (id(asyncio.get_running_loop()), os.getpid(), asgi_app)
+    if _client is None or _client_key != key:
+        _client = RateLimitedClient(
+            httpx.AsyncClient(
+                headers=headers(),
+                http2=conf.TF_HTTP2,
+                pool_limits=httpx.PoolLimits(
+                    soft_limit=conf.TF_KEEPALIVE_CONNECTIONS,
+                    hard_limit=conf.TF_MAX_CONNECTIONS,
+                ),
+                timeout=httpx.Timeout(
+                    conf.TF_TIMEOUT, connect_timeout=conf.TF_CONNECT_TIMEOUT
+                ),
+                app=asgi_app,
+            ),
+            bucket=bucket(),
+            max_retries=conf.TF_MAX_RETRIES,
+            shared=True,
+        )
+        _client_key = key
+    return _client
+
+
+def close_client():
+    """ Close the shared client's connections """
+    global _client, _client_key
+    if _client is not None and _loop is not None and not _loop.is_closed():
+        run(_client.aclose())
+    _client = _client_key = None
+
+
+async def fetch_collection(
+    url: httpx.URL, params: Dict = None, parse: Callable[[Dict], Any] = None
+) -> List[Any]:
+    """ Fetch all pages of a Terraform Cloud collection endpoint, parsing each
+        record as its page arrives (see jsonapi.fetch_all) """
+    async with async_client() as client:
+        return await jsonapi.fetch_all(
+            client,
+            url,
+            params=params,
+            page_size=conf.TF_PAGE_SIZE,
+            concurrency=conf.TF_MAX_CONCURRENCY,
+            parse=parse,
         )
-        .rename(columns={"id": "workspace_id", "name": "workspace_name"})
-        .set_index("workspace_id")
+
+
+def get_workspaces(selector: WorkspaceSelector = None) -> List[Workspace]:
+    """ Workspaces in the organization, limited to those matched by selector """
+    selector = selector or WorkspaceSelector()
+
+    def fetch() -> List[Workspace]:
+        catalog = get_catalog()
+        if catalog is not None:
+            return selector.select(catalog.workspaces())
+        return selector.select(fetch_workspaces(params=selector.params()))
+
+    return cache.cached(f"{conf.TF_ORG_NAME}/workspaces/{selector.cache_key()}", fetch)
+
+
+def get_variables(
+    category: Optional[VarCategory] = None,
+    workspaces: List[Workspace] = None,
+    selector: WorkspaceSelector = None,
+) -> VariableIndex:
+    """ Variables in the organization. If workspaces are given, only the variables
+        of those workspaces are fetched; selector must then be the selector they
+        were chosen with, as it scopes the cache entry.
+
+        Env variables come from the catalog when it is enabled, which only holds
+        the credential variables. """
+
+    def fetch() -> VariableIndex:
+        catalog = get_catalog() if category == VarCategory.ENV else None
+        if catalog is not None:
+            return catalog.variables(
+                [x.workspace_id for x in workspaces] if workspaces is not None else None
+            )
+        return fetch_variables(category=category, workspaces=workspaces)
+
+    return cache.cached(
+        variables_cache_key(category, selector if workspaces is not None else None),
+        fetch,
     )
-    logger.debug(f"({conf.TF_ORG_NAME}) found {workspaces.shape[0]} workspaces")
+
+
+def variables_cache_key(
+    category: Optional[VarCategory] = None, selector: WorkspaceSelector = None
+) -> str:
+    scope = selector.cache_key() if selector else ""
+    return f"{conf.TF_ORG_NAME}/variables/{category.value if category else 'all'}/{scope}"  # noqa
+
+
+def invalidate_variables(selector: WorkspaceSelector = None):
+    for category in (None, *VarCategory):
+        cache.invalidate(variables_cache_key(category))
+        if selector:
+            cache.invalidate(variables_cache_key(category, selector))
+
+
+def fetch_workspaces(params: Dict = None) -> List[Workspace]:
+    url = workspace_url()
+    logger.debug(f"({conf.TF_ORG_NAME}) fetching workspaces: {url}")
+    workspaces = run(fetch_collection(url, params=params, parse=Workspace.from_record))
+    logger.debug(f"({conf.TF_ORG_NAME}) found {len(workspaces)} workspaces")
     return workspaces
 
 
-def get_variables() -> pd.DataFrame:
-    logger.debug(f"({conf.TF_ORG_NAME}) fetching variables: {VARS_URL}")
-    response = httpx.get(VARS_URL, headers=HEADERS)
-    variables = pd.DataFrame(response.json()["data"])  # type: ignore
-    attrs = pd.DataFrame(variables.attributes.values.tolist())
-    relationships = pd.DataFrame(
-        [x["configurable"]["data"] for x in variables.relationships.values.tolist()]
-    )
+async def fetch_workspace_variables(
+    workspaces: List[Workspace], parse: Callable[[Dict], Any] = None
+) -> List[Any]:
+    """ Fetch the variables of each workspace concurrently """
+    semaphore = asyncio.Semaphore(max(conf.TF_MAX_CONCURRENCY, 1))
 
-    variables = (
-        variables.loc[:, ["id"]]
-        .join(relationships.id.rename("workspace_id"))
-        .join(attrs)
-    )
+    async def fetch(client: RateLimitedClient, workspace: Workspace) -> List[Dict]:
+        url = BASE_URL.join(f"workspaces/{workspace.workspace_id}/vars")
+        async with semaphore:
+            return await jsonapi.fetch_all(
+                client, url, page_size=conf.TF_PAGE_SIZE, concurrency=1, parse=parse
+            )
 
-    variables = (
-        variables.set_index("workspace_id")
-        .join(get_workspaces().loc[:, ["workspace_name"]])
-        .rename(columns={"id": "variable_id"})
-        .reset_index()
-        .set_index(["workspace_name", "key"])
-        .loc[
-            :,
-            [
-                "value",
-                "sensitive",
-                "category",
-                "hcl",
-                "workspace_id",
-                "variable_id",
-                "created-at",
-                "description",
-            ],
-        ]
-    )
-    logger.debug(f"({conf.TF_ORG_NAME}) found {variables.shape[0]} variables")
+    async with async_client() as client:
+        pages = await asyncio.gather(*[fetch(client, x) for x in workspaces])
+
+    return [record for page in pages for record in page]
+
+
+def fetch_variables(
+    category: Optional[VarCategory] = None, workspaces: List[Workspace] = None
+) -> VariableIndex:
+    """ Variables are parsed into compact records page by page, and those outside
+        category are dropped before the next page is read, so memory grows with
+        the matching variables rather than with the raw responses. """
+    wanted = category.value if category else None
+
+    def parse(record: Dict) -> Optional[Variable]:
+        if wanted and (record.get("attributes") or {}).get("category") != wanted:
+            return None
+        return Variable.from_record(record)
+
+    if workspaces is not None:
+        logger.debug(
+            f"({conf.TF_ORG_NAME}) fetching variables for {len(workspaces)} workspaces"
+        )
+        data = run(fetch_workspace_variables(workspaces, parse=parse))
+    else:
+        logger.debug(f"({conf.TF_ORG_NAME}) fetching variables: {VARS_URL}")
+        data = run(
+            fetch_collection(
+                VARS_URL,
+                params={"filter[organization][name]": conf.TF_ORG_NAME},
+                parse=parse,
+            )
+        )
+
+    variables = VariableIndex(data, category=wanted)
+    logger.debug(f"({conf.TF_ORG_NAME}) found {len(variables)} variables")
     return variables
 
 
+async def fetch_changed_workspaces(
+    since: datetime,
+) -> Tuple[List[Workspace], Optional[int]]:
+    """ Workspaces whose latest-change-at is after `since`, newest first. Pages
+        are read in order of latest change and reading stops at the first older
+        workspace, so an unchanged organization costs a single request.
+
+        Returns:
+            Tuple[List[Workspace], Optional[int]] -- changed workspaces, and the
+                                                     total number of workspaces
+    """
+    changed: List[Workspace] = []
+    total = None
+    number = 1
+    async with async_client() as client:
+        while True:
+            document = await jsonapi.get_document(
+                client,
+                workspace_url(),
+                params=jsonapi.page_params(
+                    number, conf.TF_PAGE_SIZE, {"sort": "-latest-change-at"}
+                ),
+            )
+            total = jsonapi.total_count(document) if number == 1 else total
+            for workspace in map(Workspace.from_record, document.get("data") or []):
+                changed_at = parse_timestamp(workspace.latest_change_at)
+                if changed_at is not None and changed_at <= since:
+                    return changed, total
+                changed.append(workspace)
+
+            if number >= (jsonapi.total_pages(document) or 1):
+                return changed, total
+            number += 1
+
+
+def refresh_catalog(catalog: Catalog) -> Catalog:
+    """ Bring the catalog up to date: rebuilt from a full crawl when it is older
+        than CATALOG_MAX_AGE_HOURS, otherwise only workspaces changed since the
+        watermark are listed and only stale ones have their variables fetched.
+        Deleted workspaces are noticed by the total count changing. """
+    skew = timedelta(seconds=conf.CATALOG_CLOCK_SKEW)
+    started = datetime.now(timezone.utc) - skew
+    if catalog.needs_rebuild(timedelta(hours=conf.CATALOG_MAX_AGE_HOURS)):
+        workspaces = fetch_workspaces()
+        variables = fetch_variables(category=VarCategory.ENV)
+        catalog.rebuild(workspaces, variables, synced_at=started)
+        logger.info(f"({conf.TF_ORG_NAME}) rebuilt {catalog}")
+        return catalog
+
+    changed, total = run(fetch_changed_workspaces(catalog.watermark))
+    known = catalog.workspace_ids()
+    if total is not None and total != len(known | {x.workspace_id for x in changed}):
+        # workspaces were deleted: list them all to find out which
+        changed = fetch_workspaces()
+        catalog.remove_workspaces(known - {x.workspace_id for x in changed})
+    stale = {x.workspace_id: x for x in catalog.stale(changed) + catalog.unsynced()}
+    catalog.put_workspaces(changed)
+
+    if stale:
+        variables = fetch_variables(
+            category=VarCategory.ENV, workspaces=list(stale.values())
+        )
+        catalog.put_variables(stale, variables, synced_at=started)
+    catalog.set_meta(watermark=format_timestamp(started))
+
+    logger.info(
+        f"({conf.TF_ORG_NAME}) refreshed {catalog}: {len(changed)} workspaces changed, variables of {len(stale)} fetched"  # noqa
+    )
+    return catalog
+
+
+def get_catalog() -> Optional[Catalog]:
+    """ The persistent catalog, refreshed at most once per invocation, or None if
+        disabled (CATALOG_PATH is empty) """
+    if not conf.CATALOG_PATH:
+        return None
+
+    key = f"{conf.TF_ORG_NAME}/catalog"
+    catalog = cache.invocation.get(key)
+    if catalog is None:
+        catalog = Catalog(conf.CATALOG_PATH, conf.TF_ORG_NAME, CREDENTIAL_DESCRIPTIONS)
+        try:
+            refresh_catalog(catalog)
+        except Exception:
+            catalog.close()
+            raise
+        cache.invocation.set(key, catalog)
+    return catalog
+
+
+def close_catalog():
+    """ Close the catalog opened by this invocation, if any """
+    key = f"{conf.TF_ORG_NAME}/catalog"
+    catalog = cache.invocation.get(key)
+    if catalog is not None:
+        catalog.close()
+        cache.invocation.invalidate(key)
+
+
+def record_writes(
+    results: "WriteResults",
+    tfvars: List[Tuple[str, "TFVar"]],
+    selector: WorkspaceSelector = None,
+):
+    """ Keep discovery state consistent with the writes just made """
+    created = any(var.workspace_id for _, var in tfvars)
+    if created or results.failure_count:
+        # new variable ids were assigned, or cached ids may be stale
+        invalidate_variables(selector)
+
+    catalog = cache.invocation.get(f"{conf.TF_ORG_NAME}/catalog")
+    if catalog is not None:
+        catalog.record_writes(results, synced_at=datetime.now(timezone.utc))
+
+
+def record_deletes(variables: List[Variable]):
+    """ Drop deleted variables from the caches and the catalog """
+    if not variables:
+        return
+    invalidate_variables()
+    catalog = cache.invocation.get(f"{conf.TF_ORG_NAME}/catalog")
+    if catalog is not None:
+        catalog.remove_variables(variables, synced_at=datetime.now(timezone.utc))
+
+
 class TFVar:
+    __slots__ = (
+        "key",
+        "value",
+        "description",
+        "category",
+        "hcl",
+        "sensitive",
+        "_workspace_id",
+        "_variable_id",
+    )
+
     def __init__(
         self,
         key: str,
@@ -119,6 +431,9 @@ class TFVar:
         self.hcl = hcl
         self.sensitive = sensitive
 
+        # an empty id is no id, so every branch on the id agrees
+        variable_id = variable_id or None
+        workspace_id = workspace_id or None
         id_count = sum([variable_id is not None, workspace_id is not None])
 
         if id_count > 1:
@@ -150,6 +465,11 @@ class TFVar:
     def variable_id(self):
         return self._variable_id
 
+    @property
+    def is_update(self) -> bool:
+        """ Whether this updates an existing variable rather than creating one """
+        return self._variable_id is not None
+
     @staticmethod
     def validate_id(value: Optional[str], type: EntityType) -> Optional[str]:
         if value:
@@ -159,6 +479,23 @@ class TFVar:
                 assert value.startswith("var-")
         return value
 
+    def to_dict(self) -> Dict:
+        """ Constructor arguments, e.g. to hand the write to another process """
+        return {
+            "key": self.key,
+            "value": self.value,
+            "category": self.category.value,
+            "hcl": self.hcl,
+            "sensitive": self.sensitive,
+            "description": self.description,
+            "variable_id": self.variable_id,
+            "workspace_id": self.workspace_id,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "TFVar":
+        return cls(**data)
+
     def payload(self) -> Dict[str, Union[Dict, str]]:
         attributes: Dict = {
             "key": self.key,
@@ -169,7 +506,7 @@ class TFVar:
             "sensitive": self.sensitive,
         }
 
-        if self.variable_id:
+        if self.is_update:
             return {
                 "data": {
                     "id": self.variable_id,
@@ -194,106 +531,650 @@ class TFVar:
                 }
             }
 
+    def shape(self) -> Tuple:
+        """ Everything in the payload except the id and the value """
+        return (
+            self.is_update,
+            self.key,
+            self.category.value,
+            self.hcl,
+            self.sensitive,
+            self.description,
+        )
+
+    def body(self) -> bytes:
+        """ Serialized payload(), rendered from the template for its shape """
+        return payload_template(self).render(self.id, self.value)
+
     @property
     def url(self) -> httpx.URL:
-        if self.variable_id:
+        if self.is_update:
             return VARS_URL.join(self.variable_id)
         else:
             return VARS_URL
 
-    def send(self):
+    def send(self) -> Optional[httpx.Response]:
+        async def send():
+            async with async_client() as client:
+                return await self.send_async(client)
+
         try:
-            if self.variable_id:
-                response = httpx.patch(self.url, json=self.payload(), headers=HEADERS)
-            else:
-                response = httpx.post(self.url, json=self.payload(), headers=HEADERS)
-            response.raise_for_status()
+            return run(send())
         except httpx.HTTPError as e:
             logger.error(
-                f"({conf.TF_IAM_USERNAME}) Error rotating credential: {self.id}/{self.key} -- {e}"
-            )  # noqa
+                f"({conf.TF_IAM_USERNAME}) Error rotating credential: {self.id}/{self.key} -- {e}"  # noqa
+            )
+            return getattr(e, "response", None)
 
+    async def send_async(self, client: RateLimitedClient) -> httpx.Response:
+        method = "PATCH" if self.is_update else "POST"
+        response = await client.request(method, self.url, data=self.body())
+        response.raise_for_status()
         return response
 
 
-def rotate_keys():
-    variables = get_variables()
-    workspaces = get_workspaces()
-    envs = None
+class PayloadTemplate:
+    """ A variable payload serialized once, with placeholders for the id (the
+        variable id for updates, the workspace id for creates) and the value """
+
+    __slots__ = ("parts", "id_first")
+
+    ID = "\x00id\x00"
+    VALUE = "\x00value\x00"
+
+    def __init__(self, payload: Dict):
+        data = payload["data"]
+        data["attributes"]["value"] = self.VALUE
+        if "id" in data:
+            data["id"] = self.ID
+        else:
+            data["relationships"]["workspace"]["data"]["id"] = self.ID
+
+        text = json.dumps(payload)
+        id_marker, value_marker = json.dumps(self.ID), json.dumps(self.VALUE)
+        self.id_first = text.index(id_marker) < text.index(value_marker)
+        first, second = (
+            (id_marker, value_marker) if self.id_first else (value_marker, id_marker)
+        )
+        prefix, rest = text.split(first)
+        middle, suffix = rest.split(second)
+        self.parts = (prefix, middle, suffix)
+
+    def __repr__(self):
+        return f"PayloadTemplate({''.join(self.parts)})"
+
+    def render(self, id: str, value: Optional[str]) -> bytes:
+        prefix, middle, suffix = self.parts
+        first, second = (id, value) if self.id_first else (value, id)
+        return (
+            prefix + json.dumps(first) + middle + json.dumps(second) + suffix
+        ).encode("utf-8")
+
+
+@functools.lru_cache(maxsize=256)
+def shape_template(shape: Tuple) -> PayloadTemplate:
+    """ Payload template for a TFVar.shape(). Bounded, as shapes include the
+        description, which callers may vary freely. """
+    is_update, key, category, hcl, sensitive, description = shape
+    var = TFVar(
+        key=key,
+        value="",
+        category=category,
+        hcl=hcl,
+        sensitive=sensitive,
+        description=description,
+        variable_id="var-template" if is_update else None,
+        workspace_id=None if is_update else "ws-template",
+    )
+    return PayloadTemplate(var.payload())
+
+
+def payload_template(var: TFVar) -> PayloadTemplate:
+    return shape_template(var.shape())
+
+
+class WriteBatch:
+    """ Variable writes held as parallel arrays. Writes that share a shape (key,
+        category, flags and description) share one PayloadTemplate, so each
+        request body is rendered from ids and values only. """
+
+    __slots__ = ("workspace_names", "vars", "templates")
+
+    def __init__(self, tfvars: Iterable[Tuple[str, TFVar]] = ()):
+        self.workspace_names: List[str] = []
+        self.vars: List[TFVar] = []
+        self.templates: List[PayloadTemplate] = []
+        for workspace_name, var in tfvars:
+            self.add(workspace_name, var)
+
+    def __repr__(self):
+        return f"WriteBatch({len(self)} writes, {len(set(map(id, self.templates)))} shapes)"  # noqa
+
+    def __len__(self) -> int:
+        return len(self.vars)
+
+    def __iter__(self) -> Iterator[Tuple[str, TFVar]]:
+        return zip(self.workspace_names, self.vars)
+
+    def add(self, workspace_name: str, var: TFVar):
+        self.workspace_names.append(workspace_name)
+        self.vars.append(var)
+        self.templates.append(payload_template(var))
+
+    def body(self, index: int) -> bytes:
+        var = self.vars[index]
+        return self.templates[index].render(var.id, var.value)
+
+    def request(self, index: int) -> Tuple[str, str, bytes]:
+        """ (method, url, body) of a write. The url is built by concatenation, as
+            httpx.URL.join costs more than rendering the body. """
+        var = self.vars[index]
+        if var.is_update:
+            return "PATCH", f"{VARS_URL}{var.variable_id}", self.body(index)
+        return "POST", str(VARS_URL), self.body(index)
+
+
+class WriteResults:
+    """ Aggregate outcome of a batch of variable writes, grouped by workspace """
+
+    def __init__(self):
+        self.succeeded: Dict[str, List[TFVar]] = defaultdict(list)
+        self.failed: Dict[str, List[Tuple[TFVar, Exception]]] = defaultdict(list)
+
+    def __repr__(self):
+        return f"WriteResults(succeeded={self.success_count}, failed={self.failure_count})"  # noqa
+
+    @property
+    def success_count(self) -> int:
+        return sum(len(x) for x in self.succeeded.values())
+
+    @property
+    def failure_count(self) -> int:
+        return sum(len(x) for x in self.failed.values())
+
+    @property
+    def succeeded_workspaces(self) -> List[str]:
+        """ Workspaces in which every variable was written successfully """
+        return sorted(x for x in self.succeeded if x not in self.failed)
+
+    @property
+    def failed_workspaces(self) -> List[str]:
+        return sorted(self.failed)
+
+    def merge(self, other: "WriteResults"):
+        for name, variables in other.succeeded.items():
+            self.succeeded[name].extend(variables)
+        for name, failures in other.failed.items():
+            self.failed[name].extend(failures)
+
+    def to_dict(self) -> Dict[str, Union[int, List[str]]]:
+        return {
+            "variables_succeeded": self.success_count,
+            "variables_failed": self.failure_count,
+            "workspaces_succeeded": self.succeeded_workspaces,
+            "workspaces_failed": self.failed_workspaces,
+        }
+
+
+async def write_variables(
+    tfvars: Union[WriteBatch, Iterable[Tuple[str, TFVar]]], concurrency: int = None
+) -> WriteResults:
+    """ Send variable writes concurrently over a shared client, keeping at most
+        `concurrency` requests in flight.
+
+        Arguments:
+            tfvars {Iterable[Tuple[str, TFVar]]} -- a WriteBatch, or
+                (workspace_name, variable) pairs
+
+        Keyword Arguments:
+            concurrency {int} -- max in-flight requests (default: TF_WRITE_CONCURRENCY)
+
+        Returns:
+            WriteResults
+    """
+    results = WriteResults()
+    semaphore = asyncio.Semaphore(max(concurrency or conf.TF_WRITE_CONCURRENCY, 1))
+
+    batch = tfvars if isinstance(tfvars, WriteBatch) else WriteBatch(tfvars)
+
+    async def write(client: RateLimitedClient, index: int):
+        workspace_name, var = batch.workspace_names[index], batch.vars[index]
+        async with semaphore:
+            try:
+                method, url, body = batch.request(index)
+                response = await client.request(method, url, data=body)
+                response.raise_for_status()
+                results.succeeded[workspace_name].append(var)
+            except httpx.HTTPError as e:
+                logger.error(
+                    f"({conf.TF_IAM_USERNAME}) Error rotating credential: {var.id}/{var.key} -- {e}"  # noqa
+                )
+                results.failed[workspace_name].append((var, e))
+
+    async with async_client() as client:
+        await asyncio.gather(*[write(client, i) for i in range(len(batch))])
+
+    return results
+
+
+@traced("terraform.plan_changes")
+def plan_changes(
+    workspaces: Iterable[Workspace],
+    variables: VariableIndex,
+    credentials: Dict[str, str],
+    descriptions: Dict[str, str],
+    stable_keys: Collection[str] = (),
+) -> Changeset:
+    """ Expand credentials over every workspace, updating env variables that
+        already exist and creating the rest. Each write is diffed against the
+        fetched variable and marked as a no-op if it would change nothing.
+    """
+    changeset = Changeset()
+    for workspace in sorted(workspaces, key=lambda x: x.workspace_name):
+        for key, description in descriptions.items():
+            existing = variables.get(workspace.workspace_id, key)
+            if existing is not None and existing.category != VarCategory.ENV.value:
+                existing = None
+
+            tfvar = TFVar(
+                key=key,
+                value=credentials[key],
+                category=VarCategory.ENV,
+                hcl=False,
+                sensitive=key not in NON_SENSITIVE_KEYS,
+                description=description,
+                variable_id=existing.variable_id if existing else None,
+                workspace_id=None if existing else workspace.workspace_id,
+            )
+            changeset.add(
+                workspace.workspace_name, diff(tfvar, existing, stable_keys), tfvar
+            )
+
+    return changeset
+
+
+def plan_writes(
+    workspaces: Iterable[Workspace],
+    variables: VariableIndex,
+    credentials: Dict[str, str],
+    descriptions: Dict[str, str],
+) -> List[Tuple[str, TFVar]]:
+    """ Every desired write, including those that would not change anything
+
+        Returns:
+            List[Tuple[str, TFVar]] -- (workspace_name, variable) pairs
+    """
+    changeset = plan_changes(workspaces, variables, credentials, descriptions)
+    return [(x.workspace_name, x.var) for x in changeset.changes]
+
+
+def completed(results: WriteResults) -> "Future[WriteResults]":
+    """ A future already holding results, for chunks written synchronously """
+    future: Future = Future()
+    future.set_result(results)
+    return future
+
+
+def write_chunks(
+    workspace_chunks: List[List[str]],
+    write: Callable[[List[str]], "Future[WriteResults]"],
+    journal: RotationJournal,
+    deadline: Deadline = None,
+    max_workers: int = 1,
+) -> Tuple[WriteResults, bool]:
+    """ Write chunks of workspaces, up to max_workers at a time, recording each
+        workspace of a chunk in the journal once the chunk is written and none
+        of the workspace's writes failed.
+
+        write starts writing a chunk and returns a future of its results (see
+        completed() for chunks written synchronously). Before each chunk, its
+        duration is estimated from the slowest chunk so far; if it would not
+        finish before the deadline, no more chunks are started, and chunks still
+        running are no longer waited for once the deadline is reached. Their
+        workspaces are left pending for the next invocation.
+
+        Returns:
+            Tuple[WriteResults, bool] -- results, and whether every chunk finished
+    """
+    results = WriteResults()
+    queue = list(reversed(workspace_chunks))
+    running: Dict[Future, Tuple[List[str], float]] = {}
+    seconds_per_workspace = 0.0
+    finished = True
+    while queue or running:
+        while queue and len(running) < max(max_workers, 1):
+            estimate = seconds_per_workspace * len(queue[-1])
+            if deadline is not None and not deadline.allows(estimate):
+                logger.warning(
+                    f"({journal.iam_username}) {deadline.remaining():.1f}s left, expected {estimate:.1f}s for the next {len(queue[-1])} workspaces: stopping with {sum(len(x) for x in queue)} workspaces pending"  # noqa
+                )
+                queue.clear()
+                finished = False
+                break
+            chunk = queue.pop()
+            started = timer()
+            running[write(chunk)] = (chunk, started)
+
+        if not running:
+            break
+
+        remaining = deadline.remaining() if deadline is not None else None
+        timeout = max(remaining, 0.0) if remaining is not None else None
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            logger.warning(
+                f"({journal.iam_username}) deadline reached: no longer waiting for {sum(len(x) for x, _ in running.values())} workspaces"  # noqa
+            )
+            return results, False
+
+        for future in done:
+            chunk, started = running.pop(future)
+            seconds_per_workspace = max(
+                seconds_per_workspace, (timer() - started) / len(chunk)
+            )
+            chunk_results = future.result()
+            results.merge(chunk_results)
+            journal.complete(x for x in chunk if x not in chunk_results.failed)
+
+    return results, finished
 
-    with RotationManager(conf.TF_IAM_USERNAME) as rm:
 
-        credentials = rm.new
-        var_levels = rm.descriptions
+def write_journaled(
+    workspaces: List[Workspace],
+    tfvars: List[Tuple[str, TFVar]],
+    journal: RotationJournal,
+    deadline: Deadline = None,
+) -> Tuple[WriteResults, bool]:
+    """ Write variables ROTATION_CHUNK_SIZE workspaces at a time, journaling
+        each workspace once all of its variables are written and stopping before
+        the deadline (see write_chunks).
 
-        workspaces = (
-            workspaces.reset_index().set_index("workspace_name").loc[:, "workspace_id"]
+        Returns:
+            Tuple[WriteResults, bool] -- results, and whether every chunk was sent
+    """
+    by_workspace: Dict[str, List[Tuple[str, TFVar]]] = defaultdict(list)
+    for workspace_name, var in tfvars:
+        by_workspace[workspace_name].append((workspace_name, var))
+
+    # workspaces without writes already hold the current values
+    journal.complete(
+        x.workspace_name for x in workspaces if x.workspace_name not in by_workspace
+    )
+
+    def write(chunk: List[str]) -> "Future[WriteResults]":
+        return completed(
+            run(write_variables([x for name in chunk for x in by_workspace[name]]))
         )
 
-        envs = variables.loc[variables.category == VarCategory.ENV.value].drop(
-            columns=["created-at"]
+    return write_chunks(
+        list(chunks(sorted(by_workspace), max(conf.ROTATION_CHUNK_SIZE, 1))),
+        write,
+        journal,
+        deadline,
+    )
+
+
+def rotate_keys(
+    dry_run: bool = None, output: IO[str] = None, deadline: Deadline = None
+) -> WriteResults:
+    """ Rotate the IAM user's access key and write the new credentials to the
+        selected workspaces.
+
+        Progress is journaled (see journal.py). A run that stops before the
+        deadline, or in which some writes fail, keeps the previous key; the next
+        run resumes with the key already created and only writes the workspaces
+        that are not complete yet. The previous key is only deleted once the new
+        key authenticates, which is checked while the variables are written
+        (see readiness.py).
+
+        In dry run mode nothing is created or written: the planned changes are
+        streamed to output (default: stdout) as newline delimited JSON, one line
+        per variable, followed by a summary line with the duration of each phase.
+    """
+    dry_run = conf.DRY_RUN if dry_run is None else dry_run
+    timings = PhaseTimer()
+    if ssm.last_load_time is not None:
+        timings.record("ssm_load", ssm.last_load_time)
+
+    close_catalog()  # left open by an earlier run in this process
+    cache.begin_invocation()
+    rm = RotationManager(conf.TF_IAM_USERNAME)
+    max_age = timedelta(hours=conf.KEY_MAX_AGE_HOURS)
+
+    journal = RotationJournal.load(
+        None if dry_run else get_store(), conf.TF_IAM_USERNAME
+    )
+    resuming = journal.started
+    if resuming:
+        if rm.resume(journal.credentials, journal.previous_key_id):
+            logger.info(
+                f"({conf.TF_IAM_USERNAME}) resuming rotation to {journal.key_id}: {len(journal.completed)} workspaces already complete"  # noqa
+            )
+        else:
+            logger.warning(
+                f"({conf.TF_IAM_USERNAME}) discarding journal: key {journal.key_id} no longer exists"  # noqa
+            )
+            journal.finish()
+            resuming = False
+
+    if not dry_run and not resuming and not rm.needs_rotation(max_age):
+        logger.info(f"({conf.TF_IAM_USERNAME}) key is still fresh, skipping rotation")
+        return WriteResults()
+
+    selector = WorkspaceSelector.from_config()
+    delivery_sinks = sinks.get_sinks()
+    with timings.phase("workspace_fetch"):
+        workspaces = get_workspaces(selector)
+
+    with timings.phase("variable_fetch"):
+        variables = get_variables(
+            category=VarCategory.ENV,
+            workspaces=workspaces if selector.active else None,
+            selector=selector,
         )
 
-        # expanded_index = envs.index.set_levels(levels=list(var_levels.keys()), level="key")
-        expanded_index = pd.MultiIndex.from_product(
-            [workspaces.index, list(var_levels.keys())], names=["workspace_name", "key"]
+    logger.info(
+        f"({conf.TF_IAM_USERNAME}) selected {len(workspaces)} workspaces: {selector}"
+    )
+
+    if dry_run:
+        if conf.TF_VARSET_NAME:
+            import varsets
+
+            with timings.phase("varset_fetch"):
+                varset = run(varsets.fetch_varset(conf.TF_VARSET_NAME))
+            with timings.phase("reshape"):
+                changeset = varsets.plan(
+                    varset,
+                    workspaces,
+                    variables,
+                    rm.preview_credentials(),
+                    rm.descriptions,
+                )
+        else:
+            with timings.phase("reshape"):
+                changeset = plan_changes(
+                    workspaces,
+                    variables,
+                    rm.preview_credentials(),
+                    rm.descriptions,
+                    stable_keys=conf.TF_STABLE_KEYS,
+                )
+
+        with timings.phase("sink_plan"):
+            sink_changes = run(sinks.plan(delivery_sinks, rm.preview_credentials()))
+
+        output = output or sys.stdout
+        changeset.write_ndjson(output)
+        sinks.write_ndjson(sink_changes, output)
+        summary = {
+            "summary": changeset.counts(),
+            "sinks": [x.name for x in delivery_sinks],
+            "workspaces": len(workspaces),
+            "needs_rotation": rm.needs_rotation(max_age),
+            "phases": timings.to_dict(),
+        }
+        output.write(json.dumps(summary) + "\n")
+        output.flush()
+        logger.info(f"({conf.TF_IAM_USERNAME}) dry run planned {changeset}")
+        return WriteResults()
+
+    if not resuming:
+        # no journal: a second key is left over from an earlier rotation
+        rm.create_new_credentials(replace_active=True)
+        journal.begin(rm.new, rm.previous_key_id)
+
+    # check the new key and deliver it to the other sinks while the variables
+    # are written (on the shared loop)
+    ready = event_loop().create_task(
+        readiness.probe(rm.new, conf.TF_IAM_USERNAME, deadline=deadline)
+    )
+    delivery = event_loop().create_task(
+        sinks.deliver(delivery_sinks, rm.new, conf.TF_IAM_USERNAME)
+    )
+    try:
+        return _deliver(
+            rm,
+            journal,
+            workspaces,
+            variables,
+            selector,
+            timings,
+            deadline,
+            ready=ready,
+            delivery=delivery,
         )
+    finally:
+        background = [x for x in (ready, delivery) if not x.done()]
+        for task in background:
+            task.cancel()
+        if background:
+            run(asyncio.wait(background))
 
-        envs = envs.reindex(index=expanded_index)
 
-        creds = (
-            pd.DataFrame(data=credentials, index=envs.index.levels[0])
-            .reset_index()
-            .melt(id_vars="workspace_name", var_name="key")
-            .set_index(["workspace_name", "key"])
-            .sort_index()
+def _write_workspaces(
+    rm: RotationManager,
+    journal: RotationJournal,
+    pending: List[Workspace],
+    variables: VariableIndex,
+    selector: WorkspaceSelector,
+    timings: PhaseTimer,
+    deadline: Deadline,
+) -> Tuple[WriteResults, bool]:
+    """ Write the new credentials into each pending workspace """
+    with timings.phase("reshape"):
+        changeset = plan_changes(
+            pending,
+            variables,
+            rm.new,
+            rm.descriptions,
+            stable_keys=conf.TF_STABLE_KEYS,
         )
+    logger.info(f"({conf.TF_IAM_USERNAME}) planned {changeset}")
 
-        envs = creds.combine_first(envs)
+    tfvars = changeset.writes()
+    sharded = conf.SHARD_SIZE and len(pending) > conf.SHARD_SIZE
+    with timings.phase("write"):
+        if sharded:
+            import shards
 
-        df = workspaces.reindex(expanded_index).to_frame().reset_index(level=1)
-        df["workspace_id"] = workspaces
-        df = df.set_index("key", append=True)
-        df
+            results, finished = shards.write_sharded(pending, tfvars, journal, deadline)
+        else:
+            results, finished = write_journaled(pending, tfvars, journal, deadline)
 
-        envs["workspace_id"] = df
-        envs = envs.reset_index(level=1, drop=False).set_index(
-            "key", append=True, drop=False
+    record_writes(results, tfvars, selector)
+
+    for workspace_name in results.succeeded_workspaces:
+        logger.info(
+            f"({conf.TF_IAM_USERNAME}) successfully rotated keys for workspace: {workspace_name}"  # noqa
         )
-        envs.description = envs.key.replace(var_levels)
-        envs.value = envs.key.replace(credentials)
-        envs = envs.drop(columns=["key"])
-
-        envs["category"] = VarCategory.ENV.value
-        envs["hcl"] = False
-        envs["sensitive"] = True
-        envs.loc[pd.IndexSlice[:, "AWS_IAM_ROLE"], "sensitive"] = False
-        envs.loc[pd.IndexSlice[:, "LAST_ROTATED"], "sensitive"] = False
-        envs.loc[envs.variable_id.notnull(), "workspace_id"] = None
-        envs.loc[envs.variable_id.isna(), "variable_id"] = None
-
-        missing_ids = envs.loc[envs.variable_id.isna() & envs.workspace_id.isna(), :]
-        if missing_ids.shape[0] > 0:
-            missing_records = (
-                missing_ids.head()
-                .reset_index()
-                .loc[:, ["workspace_name", "key"]]
-                .to_dict(orient="records")
+    return results, finished
+
+
+def _deliver(
+    rm: RotationManager,
+    journal: RotationJournal,
+    workspaces: List[Workspace],
+    variables: VariableIndex,
+    selector: WorkspaceSelector,
+    timings: PhaseTimer,
+    deadline: Deadline,
+    ready: asyncio.Task,
+    delivery: asyncio.Task,
+) -> WriteResults:
+    """ Write the new credentials to the workspaces the journal has not completed
+        (into each workspace, or through the variable set when TF_VARSET_NAME is
+        set), then delete the previous key once every write succeeded, every
+        sink holds the new key and the new key is valid """
+    pending = [x for x in workspaces if x.workspace_name not in journal.completed]
+    if conf.TF_VARSET_NAME:
+        import varsets
+
+        with timings.phase("write"):
+            results, finished = varsets.deliver(
+                pending, variables, rm.new, rm.descriptions, journal, deadline
             )
-            for missing in missing_records:
-                workspace_name = missing["workspace_name"]
-                key = missing["key"]
-                logger.warning(
-                    f"({workspace_name}) {key} is missing both variable_id and workspace_id"
-                )
+    else:
+        results, finished = _write_workspaces(
+            rm, journal, pending, variables, selector, timings, deadline
+        )
 
-        envs = envs.loc[envs.variable_id.notnull() | envs.workspace_id.notnull(), :]
+    for workspace_name in results.failed_workspaces:
+        logger.error(
+            f"({conf.TF_IAM_USERNAME}) failed to rotate keys for workspace: {workspace_name}"  # noqa
+        )
 
-        for workspace_name, df in envs.groupby(level=0):
-            records = df.reset_index(level=1).to_dict(orient="records")
-            tfvars = [TFVar(**r) for r in records]
-            for var in tfvars:
-                var.send()
-            logger.info(
-                f"({conf.TF_IAM_USERNAME}) successfully rotated keys for workspace: {workspace_name}"  # noqa
+    remaining = len(workspaces) - len(journal.completed)
+    if finished and not results.failure_count:
+        with timings.phase("sinks"):
+            undelivered = [x for x in run(delivery) if not x.ok]
+        with timings.phase("readiness"):
+            valid = run(ready)
+        if valid and not undelivered:
+            rm.delete_previous_key()
+            journal.finish()
+            logger.info(f"({conf.TF_IAM_USERNAME}) rotated access keys")
+        elif not valid:
+            finished = False
+            logger.error(
+                f"({conf.TF_IAM_USERNAME}) new key {rm.next_key_id} is not valid yet, previous key retained until the rotation is resumed"  # noqa
             )
+        else:
+            finished = False
+            logger.error(
+                f"({conf.TF_IAM_USERNAME}) delivery failed: {undelivered}, previous key retained until the rotation is resumed"  # noqa
+            )
+    elif results.failure_count:
+        logger.error(
+            f"({conf.TF_IAM_USERNAME}) {remaining} workspaces incomplete, previous key retained until the rotation is resumed"  # noqa
+        )
+    else:
+        logger.warning(
+            f"({conf.TF_IAM_USERNAME}) stopped before the deadline with {remaining} workspaces pending, previous key retained until the rotation is resumed"  # noqa
+        )
+
+    logger.info(
+        f"({conf.TF_IAM_USERNAME}) rotation {'complete' if finished else 'paused'}: {results} ({timings})",  # noqa
+        extra={**results.to_dict(), "phases": timings.to_dict()},
+    )
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import loggers
+
+    parser = argparse.ArgumentParser(description="Rotate Terraform Cloud credentials")
+    parser.add_argument(
+        "--plan", action="store_true", help="print the planned changes as NDJSON"
+    )
+    args = parser.parse_args()
+
+    loggers.config()
+    try:
+        rotate_keys(dry_run=args.plan or None)
+    finally:
+        close_catalog()
+        close_client()
+        tracer.report()
@@ -0,0 +1,144 @@
+""" Span based latency instrumentation for sync and async code.
+
+    Spans are timed with a monotonic clock and aggregated per name, so that
+    latency percentiles for each endpoint or operation can be reported once at
+    the end of an invocation.
+
+    Example:
+        with span("iam.create_access_key"):
+            ...
+
+        @traced("terraform.plan_changes")
+        def plan_changes(...):
+            ...
+
+        tracer.report()  # one log record per span name, then reset
+"""
+
+import asyncio
+import functools
+import logging
+import math
+import re
+from collections import defaultdict
+from contextlib import contextmanager
+from timeit import default_timer as timer
+from typing import Any, Callable, Dict, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+""" Path segments that identify a single resource, e.g. ws-5dDeCEnpgTvLLC2m """
+ID_PATTERN = re.compile(r"/[a-z]+-(?=[A-Za-z0-9]*\d)[A-Za-z0-9]+(?=/|$)")
+
+
+def percentile(values: List[float], p: float) -> float:
+    """ Nearest-rank percentile of a sorted list """
+    if not values:
+        return 0.0
+    rank = max(math.ceil(p / 100 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def endpoint_name(method: str, path: str) -> str:
+    """ Span name for an HTTP request with resource ids masked, so that requests
+        to the same endpoint are aggregated together """
+    return f"{method.upper()} {ID_PATTERN.sub('/:id', path)}"
+
+
+class Tracer:
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def __repr__(self):
+        return f"Tracer({len(self.durations)} spans)"
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """ Time the enclosed block. Safe to use inside coroutines, as the block
+            itself may await. """
+        ts = timer()
+        try:
+            yield
+        except BaseException:
+            self.errors[name] += 1
+            raise
+        finally:
+            self.durations[name].append(timer() - ts)
+
+    def traced(self, name: str = None) -> Callable:
+        """ Decorate a function or coroutine function so each call is a span """
+
+        def deco(func: Callable) -> Callable:
+            span_name = name or f"{func.__module__}.{func.__qualname__}"
+
+            if asyncio.iscoroutinefunction(func):
+
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs) -> Any:
+                    with self.span(span_name):
+                        return await func(*args, **kwargs)
+
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs) -> Any:
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return deco
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """ Latency distribution per span name, in milliseconds """
+        result = {}
+        for name, durations in sorted(self.durations.items()):
+            values = sorted(durations)
+            result[name] = {
+                "count": len(values),
+                "errors": self.errors.get(name, 0),
+                "total_ms": round(sum(values) * 1000, 2),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2),
+            }
+        return result
+
+    def reset(self):
+        self.durations.clear()
+        self.errors.clear()
+
+    def report(self, reset: bool = True) -> Dict[str, Dict[str, float]]:
+        """ Log one record per span name with its latency distribution as extra
+            fields, which the JSON formatter includes in its output """
+        summary = self.summary()
+        for name, stats in summary.items():
+            logger.info(
+                f"(trace) {name}: n={stats['count']} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms",  # noqa
+                extra={"span": name, **stats},
+            )
+        if reset:
+            self.reset()
+        return summary
+
+
+class TracedClient:
+    """ Proxy for a boto3 client that records a span for every API call """
+
+    def __init__(self, client, prefix: str, tracer: Tracer = None):
+        self._client = client
+        self._prefix = prefix
+        self._tracer = tracer or globals()["tracer"]
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._client, name)
+        if not callable(attr) or name.startswith(("get_paginator", "get_waiter")):
+            return attr
+        return self._tracer.traced(f"{self._prefix}.{name}")(attr)
+
+
+tracer = Tracer()
+span = tracer.span
+traced = tracer.traced
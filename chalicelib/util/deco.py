@@ -1,3 +1,4 @@
+import asyncio
 import functools
 import logging
 from timeit import default_timer as timer
@@ -26,24 +27,46 @@ def ambiguous(decorator):
 
 
 @ambiguous
-def log_execution_time() -> Callable:
+def log_execution_time(name: str = None) -> Callable:
+    """ Log the execution time of a function or coroutine function. Exceptions
+        are logged with the elapsed time and re-raised. """
+
     def deco(func) -> Callable:
-        @functools.wraps(func)
-        async def wrapper(*args, **kwargs) -> Any:
-            name = kwargs.pop("name", None)
-            try:
+        label = name or func.__name__
+
+        def log(ts: float, error: Exception = None):
+            exc_time = round(timer() - ts, 3)
+            extra = {"exc_time": exc_time, "func_name": label}
+            if error is None:
+                logger.info(f"{label} executed in {exc_time}s", extra=extra)
+            else:
+                logger.info(f"{label} failed after {exc_time}s: {error}", extra=extra)
+
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs) -> Any:
                 ts = timer()
-                result = await func(*args, **kwargs)
-                te = timer()
-                exc_time = round(te - ts, 3)
-
-                logger.info(
-                    f"{name or func.__name__} executed in {exc_time}s",
-                    extra={"exc_time": exc_time, "name": name or func.__name__},
-                )
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception as e:
+                    log(ts, e)
+                    raise
+                log(ts)
                 return result
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs) -> Any:
+            ts = timer()
+            try:
+                result = func(*args, **kwargs)
             except Exception as e:
-                logger.debug(f"{func} failed: {e}")
+                log(ts, e)
+                raise
+            log(ts)
+            return result
 
         return wrapper
 
@@ -2,7 +2,17 @@ import functools
 import hashlib
 import itertools
 from collections import OrderedDict
-from typing import Any, Dict, Generator, Iterable, List, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 
 def ensure_list(value: Any) -> List[Any]:
@@ -34,6 +44,35 @@ def chunks(iterable: Iterable, n: int = 1000, cls=list) -> Generator:
         yield cls(itertools.chain((first_el,), chunk_it))
 
 
+@functools.lru_cache(maxsize=1024)
+def compile_query(path: str, sep: str = ".") -> Callable[[Any], Any]:
+    """ Parse a query path once into an accessor that can be applied to any number
+        of records. Parsed paths are cached, so calling this repeatedly with the
+        same path is cheap. See query() for the lookup rules.
+
+        Example:
+            workspace_id = compile_query("relationships.workspace.data.id")
+            workspace_id(record) => "ws-123"
+    """
+    steps: List[Tuple[str, Optional[int]]] = []
+    for e in path.split(sep):
+        try:
+            steps.append((e, int(e)))
+        except ValueError:
+            # a list where a mapping is expected yields its last item
+            steps.append((e, -1))
+
+    def accessor(data: Any) -> Any:
+        for key, index in steps:
+            if type(data) is dict or isinstance(data, dict):
+                data = data.get(key, {})
+            elif isinstance(data, list) and data:
+                data = data[index]
+        return data if data else None
+
+    return accessor
+
+
 def query(path: str, data: dict, sep: str = "."):
     """ Query any combination of nested lists/dicts, returning the last valid value
         encountered in the query chain.
@@ -46,18 +85,17 @@ def query(path: str, data: dict, sep: str = "."):
             query(path="a.b", data=data) => {"c": 1}
 
          """
-    elements = path.split(sep)
-    for e in elements:
-        if issubclass(type(data), list) and len(data) > 0:
-            try:
-                data = data[int(e)]
-            except ValueError:
-                # handle cases where a list of items occurs where a mapping is expected
-                data = data[-1]
-        elif issubclass(type(data), dict):
-            data = data.get(e, {})
-
-    return data if data else None
+    return compile_query(path, sep)(data)
+
+
+def query_many(path: str, records: Iterable, sep: str = ".") -> List:
+    """ Apply one query to every record in a single pass
+
+        Example:
+            query_many("id", [{"id": 1}, {"id": 2}]) => [1, 2]
+    """
+    accessor = compile_query(path, sep)
+    return [accessor(x) for x in records]
 
 
 def query_factory(data: str, sep: str = "."):
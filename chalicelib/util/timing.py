@@ -0,0 +1,70 @@
+from contextlib import contextmanager
+from timeit import default_timer as timer
+from typing import Dict, Iterator, Optional
+
+
+class PhaseTimer:
+    """ Accumulates wall time per named phase of a run.
+
+        Example:
+            timings = PhaseTimer()
+            with timings.phase("fetch"):
+                ...
+            timings.to_dict() => {"fetch": 0.123}
+    """
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+
+    def __repr__(self):
+        return ", ".join(f"{k}={v}s" for k, v in self.phases.items())
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        ts = timer()
+        try:
+            yield
+        finally:
+            self.record(name, timer() - ts)
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = round(self.phases.get(name, 0.0) + seconds, 4)
+
+    def to_dict(self) -> Dict[str, float]:
+        return dict(self.phases)
+
+
+class Deadline:
+    """ Time left before a hard limit such as the Lambda timeout, less a safety
+        margin for wrapping up. A deadline without a limit never expires.
+
+        Example:
+            deadline = Deadline.from_context(context, margin=15)
+            if deadline.allows(estimated_seconds):
+                ...
+    """
+
+    def __init__(self, seconds: Optional[float] = None, margin: float = 0.0):
+        self.expires_at = timer() + seconds if seconds is not None else None
+        self.margin = margin
+
+    def __repr__(self):
+        remaining = self.remaining()
+        return f"Deadline({'none' if remaining is None else f'{remaining:.1f}s'})"
+
+    @classmethod
+    def from_context(cls, context, margin: float = 0.0) -> "Deadline":
+        """ Deadline of a Lambda invocation, from its context object """
+        remaining = getattr(context, "get_remaining_time_in_millis", None)
+        return cls(remaining() / 1000 if remaining else None, margin=margin)
+
+    def remaining(self) -> Optional[float]:
+        """ Seconds left before the margin is reached """
+        if self.expires_at is None:
+            return None
+        return self.expires_at - timer() - self.margin
+
+    def allows(self, seconds: float) -> bool:
+        """ Whether work expected to take this long can finish in time """
+        remaining = self.remaining()
+        return remaining is None or remaining >= seconds
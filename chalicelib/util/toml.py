@@ -1,11 +1,13 @@
+import functools
 import os
-from typing import Dict, Optional
-
-import tomlkit
+from typing import Any, Dict
 
 
+@functools.lru_cache(maxsize=None)
 def _get_project_meta(pyproj_path: str = "./pyproject.toml") -> Dict[str, str]:
     if os.path.exists(pyproj_path):
+        import tomlkit
+
         with open(pyproj_path, "r") as pyproject:
             file_contents = pyproject.read()
         return tomlkit.parse(file_contents)["tool"]["poetry"]
@@ -13,6 +15,12 @@ def _get_project_meta(pyproj_path: str = "./pyproject.toml") -> Dict[str, str]:
         return {}
 
 
-pkg_meta: Dict[str, str] = _get_project_meta()
-project: Optional[str] = pkg_meta.get("name")
-version: Optional[str] = pkg_meta.get("version")
+def __getattr__(name: str) -> Any:
+    """ pyproject.toml is only parsed once one of its values is requested """
+    if name == "pkg_meta":
+        return _get_project_meta()
+    elif name == "project":
+        return _get_project_meta().get("name")
+    elif name == "version":
+        return _get_project_meta().get("version")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,383 @@
+""" Deliver the credentials through one Terraform Cloud variable set
+    (TF_VARSET_NAME) instead of writing them into every workspace.
+
+    The variable set owns the credential keys and is attached to the selected
+    workspaces, so a rotation updates one variable per credential however many
+    workspaces there are. Workspace variables take precedence over those of a
+    variable set, so per-workspace copies of the credential keys (e.g. written
+    before the set was introduced) would shadow it: once the set holding the
+    new key is attached to a workspace, its copies are deleted.
+
+    Steps, each of them idempotent so an interrupted run is resumed by
+    repeating them:
+        1. find the set by name, or create it
+        2. update (or create) its credential variables
+        3. attach it to the selected workspaces it is not attached to yet
+        4. delete the credential variables of the attached workspaces
+
+    A workspace is complete (and journaled) once it is attached and has no
+    credential variables of its own. Workspaces that are no longer selected are
+    not detached.
+"""
+
+import asyncio
+import json
+import logging
+from concurrent.futures import Future
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import httpx
+
+import config as conf
+import terraform
+from changeset import Action, diff
+from journal import RotationJournal
+from models import Variable, VariableIndex, VariableSet, Workspace
+from util.iterables import chunks
+from util.timing import Deadline
+
+logger = logging.getLogger(__name__)
+
+
+def varsets_url() -> httpx.URL:
+    return terraform.BASE_URL.join(f"organizations/{conf.TF_ORG_NAME}/varsets")
+
+
+def varset_url(varset_id: str, path: str = "") -> httpx.URL:
+    return terraform.BASE_URL.join(f"varsets/{varset_id}/{path}".rstrip("/"))
+
+
+async def send(client, method: str, url: httpx.URL, payload: Dict = None) -> Dict:
+    response = await client.request(
+        method, url, data=json.dumps(payload) if payload is not None else None
+    )
+    response.raise_for_status()
+    return response.json() if response.content else {}
+
+
+async def fetch_varset(name: str) -> Optional[VariableSet]:
+    """ The organization's variable set with the given name, with its variables """
+    varsets = await terraform.fetch_collection(
+        varsets_url(), parse=VariableSet.from_record
+    )
+    varset = next((x for x in varsets if x.name == name), None)
+    if varset is None:
+        return None
+
+    variables = await terraform.fetch_collection(
+        varset_url(varset.varset_id, "relationships/vars"), parse=Variable.from_record
+    )
+    varset.variables = {x.key: x for x in variables}
+    return varset
+
+
+async def create_varset(name: str, description: str) -> VariableSet:
+    payload = {
+        "data": {
+            "type": "varsets",
+            "attributes": {"name": name, "description": description, "global": False},
+        }
+    }
+    async with terraform.async_client() as client:
+        document = await send(client, "POST", varsets_url(), payload)
+    logger.info(f"({conf.TF_IAM_USERNAME}) created variable set {name}")
+    return VariableSet.from_record(document["data"])
+
+
+def desired_variables(
+    credentials: Dict[str, str], descriptions: Dict[str, str]
+) -> List[Variable]:
+    return [
+        Variable(
+            variable_id=None,
+            workspace_id=None,
+            key=key,
+            value=credentials[key],
+            category=terraform.VarCategory.ENV.value,
+            hcl=False,
+            sensitive=key not in terraform.NON_SENSITIVE_KEYS,
+            description=description,
+        )
+        for key, description in descriptions.items()
+    ]
+
+
+class VarsetPlan:
+    """ Changes bringing the variable set and the selected workspaces up to date """
+
+    def __init__(self, name: str, varset: Optional[VariableSet]):
+        self.name = name
+        self.varset = varset
+        self.writes: List[Tuple[Action, Variable]] = []
+        self.attach: List[Workspace] = []
+        self.shadowing: Dict[str, List[Variable]] = {}
+
+    def __repr__(self):
+        counts = ", ".join(f"{k}={v}" for k, v in self.counts().items())
+        return f"VarsetPlan({self.name}: {counts})"
+
+    def counts(self) -> Dict[str, int]:
+        counts = {action.value: 0 for action in Action}
+        for action, _ in self.writes:
+            counts[action.value] += 1
+        counts["attach"] = len(self.attach)
+        counts["delete"] = sum(len(x) for x in self.shadowing.values())
+        return counts
+
+    def to_dicts(self) -> List[Dict]:
+        """ Description of every change. Never includes values. """
+        changes = []
+        if self.varset is None:
+            changes.append({"varset": self.name, "action": Action.CREATE.value})
+        changes.extend(
+            {"varset": self.name, "action": action.value, "key": var.key}
+            for action, var in self.writes
+        )
+        changes.extend(
+            {
+                "varset": self.name,
+                "action": "attach",
+                "workspace_name": x.workspace_name,
+                "workspace_id": x.workspace_id,
+            }
+            for x in self.attach
+        )
+        changes.extend(
+            {
+                "varset": self.name,
+                "action": "delete",
+                "workspace_name": workspace_name,
+                "key": var.key,
+                "variable_id": var.variable_id,
+            }
+            for workspace_name, variables in self.shadowing.items()
+            for var in variables
+        )
+        return changes
+
+    def write_ndjson(self, stream) -> int:
+        changes = self.to_dicts()
+        for change in changes:
+            stream.write(json.dumps(change) + "\n")
+        return len(changes)
+
+
+def plan(
+    varset: Optional[VariableSet],
+    workspaces: Iterable[Workspace],
+    variables: VariableIndex,
+    credentials: Dict[str, str],
+    descriptions: Dict[str, str],
+    name: str = None,
+) -> VarsetPlan:
+    """ Diff the set's variables against the credentials, and list the selected
+        workspaces it is not attached to and their shadowing variables """
+    result = VarsetPlan(name or conf.TF_VARSET_NAME, varset)
+    existing = varset.variables if varset else {}
+    for desired in desired_variables(credentials, descriptions):
+        current = existing.get(desired.key)
+        action = diff(desired, current, conf.TF_STABLE_KEYS)
+        if current is not None:
+            desired.variable_id = current.variable_id
+        result.writes.append((action, desired))
+
+    attached = varset.workspace_ids if varset else set()
+    for workspace in sorted(workspaces, key=lambda x: x.workspace_name):
+        if not (varset and varset.is_global) and workspace.workspace_id not in attached:
+            result.attach.append(workspace)
+        shadowing = [
+            var
+            for var in (variables.get(workspace.workspace_id, x) for x in descriptions)
+            if var is not None
+        ]
+        if shadowing:
+            result.shadowing[workspace.workspace_name] = shadowing
+    return result
+
+
+async def write_variables(
+    varset: VariableSet, writes: List[Tuple[Action, Variable]]
+) -> terraform.WriteResults:
+    """ Update the set's variables, reported under the set's name """
+    results = terraform.WriteResults()
+
+    async def write(client, var: Variable):
+        attributes = {
+            "key": var.key,
+            "value": var.value,
+            "category": var.category,
+            "hcl": var.hcl,
+            "sensitive": var.sensitive,
+            "description": var.description,
+        }
+        try:
+            if var.variable_id:
+                payload = {
+                    "data": {
+                        "type": "vars",
+                        "id": var.variable_id,
+                        "attributes": attributes,
+                    }
+                }
+                url = varset_url(
+                    varset.varset_id, f"relationships/vars/{var.variable_id}"
+                )
+                await send(client, "PATCH", url, payload)
+            else:
+                payload = {"data": {"type": "vars", "attributes": attributes}}
+                url = varset_url(varset.varset_id, "relationships/vars")
+                document = await send(client, "POST", url, payload)
+                var.variable_id = document["data"]["id"]
+            results.succeeded[varset.name].append(var)
+        except httpx.HTTPError as e:
+            logger.error(
+                f"({conf.TF_IAM_USERNAME}) Error rotating credential: {varset.name}/{var.key} -- {e}"  # noqa
+            )
+            results.failed[varset.name].append((var, e))
+
+    async with terraform.async_client() as client:
+        await asyncio.gather(
+            *[write(client, var) for action, var in writes if action != Action.NOOP]
+        )
+    return results
+
+
+async def attach(
+    varset: VariableSet, workspaces: List[Workspace]
+) -> Tuple[List[Workspace], Dict[str, Exception]]:
+    """ Attach the set to workspaces, TF_PAGE_SIZE per request
+
+        Returns:
+            Tuple[List[Workspace], Dict[str, Exception]] -- workspaces attached,
+                                                             errors by workspace name
+    """
+    attached: List[Workspace] = []
+    errors: Dict[str, Exception] = {}
+    url = varset_url(varset.varset_id, "relationships/workspaces")
+    async with terraform.async_client() as client:
+        for chunk in chunks(workspaces, max(conf.TF_PAGE_SIZE, 1)):
+            payload = {
+                "data": [{"type": "workspaces", "id": x.workspace_id} for x in chunk]
+            }
+            try:
+                await send(client, "POST", url, payload)
+                attached.extend(chunk)
+                varset.workspace_ids.update(x.workspace_id for x in chunk)
+            except httpx.HTTPError as e:
+                logger.error(
+                    f"({conf.TF_IAM_USERNAME}) failed to attach {varset.name} to {len(chunk)} workspaces -- {e}"  # noqa
+                )
+                errors.update({x.workspace_name: e for x in chunk})
+    return attached, errors
+
+
+async def delete_variables(
+    shadowing: Dict[str, List[Variable]]
+) -> terraform.WriteResults:
+    """ Delete per-workspace variables, at most TF_WRITE_CONCURRENCY at a time """
+    results = terraform.WriteResults()
+    semaphore = asyncio.Semaphore(max(conf.TF_WRITE_CONCURRENCY, 1))
+
+    async def delete(client, workspace_name: str, var: Variable):
+        async with semaphore:
+            try:
+                response = await client.request(
+                    "DELETE", f"{terraform.VARS_URL}{var.variable_id}"
+                )
+                if response.status_code != 404:  # already gone
+                    response.raise_for_status()
+                results.succeeded[workspace_name].append(var)
+            except httpx.HTTPError as e:
+                logger.error(
+                    f"({conf.TF_IAM_USERNAME}) Error deleting shadowing variable: {var.variable_id}/{var.key} -- {e}"  # noqa
+                )
+                results.failed[workspace_name].append((var, e))
+
+    async with terraform.async_client() as client:
+        await asyncio.gather(
+            *[
+                delete(client, name, var)
+                for name, variables in shadowing.items()
+                for var in variables
+            ]
+        )
+    return results
+
+
+def deliver(
+    workspaces: List[Workspace],
+    variables: VariableIndex,
+    credentials: Dict[str, str],
+    descriptions: Dict[str, str],
+    journal: RotationJournal,
+    deadline: Deadline = None,
+) -> Tuple[terraform.WriteResults, bool]:
+    """ Write the credentials to the variable set, attach it to the workspaces and
+        delete their shadowing variables, ROTATION_CHUNK_SIZE workspaces at a
+        time, journaling each workspace once it is complete.
+
+        The set's writes are reported under its name, failed attachments as a
+        failure of each credential key in the workspace, and deletions under the
+        workspace.
+
+        Returns:
+            Tuple[terraform.WriteResults, bool] -- results, and whether every
+                                                   workspace was handled (never
+                                                   if the set's writes failed)
+    """
+    name = conf.TF_VARSET_NAME
+    varset = terraform.run(fetch_varset(name))
+    if varset is None:
+        varset = terraform.run(
+            create_varset(name, f"AWS credentials of {conf.TF_IAM_USERNAME}")
+        )
+
+    changes = plan(varset, workspaces, variables, credentials, descriptions)
+    logger.info(f"({conf.TF_IAM_USERNAME}) planned {changes}")
+
+    results = terraform.run(write_variables(varset, changes.writes))
+    if results.failure_count:
+        # workspaces must not be switched over to a set without the new key
+        return results, False
+
+    to_attach = {x.workspace_name for x in changes.attach}
+    by_name = {x.workspace_name: x for x in workspaces}
+
+    def switch_over(chunk: List[str]) -> "Future[terraform.WriteResults]":
+        """ Attach the set to the chunk's workspaces, then delete their copies """
+        attached, errors = terraform.run(
+            attach(varset, [by_name[x] for x in chunk if x in to_attach])
+        )
+        chunk_results = terraform.WriteResults()
+        for workspace_name, error in errors.items():
+            for _, var in changes.writes:
+                chunk_results.failed[workspace_name].append((var, error))
+
+        # only once a workspace reads the set can its own copies be deleted
+        shadowing = {
+            x: changes.shadowing[x]
+            for x in chunk
+            if x in changes.shadowing and x not in errors
+        }
+        deleted = terraform.run(delete_variables(shadowing))
+        terraform.record_deletes([var for x in deleted.succeeded.values() for var in x])
+        chunk_results.merge(deleted)
+
+        if attached:
+            logger.info(
+                f"({conf.TF_IAM_USERNAME}) attached {varset.name} to {len(attached)} workspaces"  # noqa
+            )
+        if deleted.success_count:
+            logger.info(
+                f"({conf.TF_IAM_USERNAME}) deleted {deleted.success_count} shadowing variables from {len(deleted.succeeded)} workspaces"  # noqa
+            )
+        return terraform.completed(chunk_results)
+
+    chunk_results, finished = terraform.write_chunks(
+        list(chunks(sorted(by_name), max(conf.ROTATION_CHUNK_SIZE, 1))),
+        switch_over,
+        journal,
+        deadline,
+    )
+    results.merge(chunk_results)
+    return results, finished
@@ -57,6 +57,16 @@ policy = {
                 "arn:aws:ssm:*:*:parameter/datadog/*",
             ],
         },
+        {
+            "Effect": "Allow",
+            "Action": ["ssm:PutParameter"],
+            "Resource": [f"arn:aws:ssm:*:*:parameter/{project}/credentials/*"],
+        },
+        {
+            "Effect": "Allow",
+            "Action": ["ssm:PutParameter", "ssm:DeleteParameter"],
+            "Resource": [f"arn:aws:ssm:*:*:parameter/{project}/journal/*"],
+        },
         {
             "Effect": "Allow",
             "Action": [
@@ -64,6 +74,8 @@ policy = {
                 "kms:ListAliases",
                 "kms:Describe*",
                 "kms:Decrypt",
+                "kms:Encrypt",
+                "kms:GenerateDataKey",
             ],
             "Resource": f"arn:aws:kms:us-east-1:{account_id}:key/{ssm_kms_key}",
         },
@@ -76,6 +88,11 @@ policy = {
             ],
             "Resource": "arn:aws:logs:*:*:*",
         },
+        {
+            "Effect": "Allow",
+            "Action": ["lambda:InvokeFunction"],
+            "Resource": f"arn:aws:lambda:*:{account_id}:function:{project}-*-terraform-cloud-worker",  # noqa
+        },
         {
             "Effect": "Allow",
             "Action": [
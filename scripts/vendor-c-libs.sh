@@ -1,6 +0,0 @@
-# https://medium.com/@qtangs/creating-new-aws-lambda-layer-for-python-pandas-library-348b126e9f3e
-export PKG_DIR=vendor
-rm -rf ${PKG_DIR} && mkdir -p ${PKG_DIR}
-
-docker run --rm -v $(pwd):/foo -w /foo lambci/lambda:build-python3.8 \
-    pip install -r vendor-requirements.txt --no-deps -t ${PKG_DIR}
@@ -0,0 +1,114 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# settings are read when config is first imported
+os.environ.update(
+    {
+        "APP_NAME": "key-rotation",
+        "TF_TOKEN": "test",
+        "TF_ORG_NAME": "test",
+        "TF_IAM_USERNAME": "test",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "TESTING": "true",
+        "LOG_LEVEL": "30",
+        "JOURNAL_STORE": "memory",
+        "CATALOG_PATH": "",
+        "SSM_CACHE_TTL": "0",
+        "TF_RATE_LIMIT": "1000",
+    }
+)
+
+sys.path.insert(0, str(ROOT / "chalicelib"))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+from util.timing import Deadline  # noqa: E402 (needs chalicelib on the path)
+
+""" IAM user rotated by terraform.rotate_keys (TF_IAM_USERNAME) """
+USER = os.environ["TF_IAM_USERNAME"]
+
+
+class Countdown(Deadline):
+    """ Deadline allowing the first `chunks` chunks to be written """
+
+    def __init__(self, chunks: int):
+        super().__init__(60)
+        self.chunks = chunks
+
+    def allows(self, seconds: float) -> bool:
+        self.chunks -= 1
+        return self.chunks >= 0
+
+
+def key_ids(aws: dict, user: str = USER) -> list:
+    """ The user's access key ids, oldest first """
+    return [x["AccessKeyId"] for x in aws["iam"].keys[user]]
+
+
+def effective_key_ids(org) -> set:
+    """ Access key ids the organization's workspaces would run with """
+    return {
+        org.effective_variables(x["id"])["AWS_ACCESS_KEY_ID"]["attributes"]["value"]
+        for x in org.workspaces
+    }
+
+
+def saved_journal(user: str = USER):
+    import journal
+
+    return journal.RotationJournal.load(journal.get_store(), user)
+
+
+@pytest.fixture
+def aws(monkeypatch) -> dict:
+    """ IAM, STS and SSM stubs (see benchmarks/fake_aws.py), by service """
+    import fake_aws
+    import key_rotation
+    import ssm
+
+    # restored once the test is done
+    monkeypatch.setattr(key_rotation, "client", key_rotation.client)
+    monkeypatch.setattr(
+        key_rotation, "credentials_client", key_rotation.credentials_client
+    )
+    monkeypatch.setattr(ssm, "client", ssm.client)
+    return fake_aws.install()
+
+
+@pytest.fixture
+def org(request, monkeypatch):
+    """ A fake Terraform Cloud organization of 10 workspaces (or as many as the
+        test parametrizes indirectly), half of them already holding
+        credentials, served in-process """
+    import fake_tfc
+    import terraform
+
+    org = fake_tfc.FakeOrganization.generate(
+        os.environ["TF_ORG_NAME"], workspaces=getattr(request, "param", 10), seeded=0.5,
+    )
+    app = fake_tfc.create_app(org)
+    monkeypatch.setattr(terraform, "asgi_app", app)
+    org.stats = app.stats
+    return org
+
+
+@pytest.fixture
+def journaled(monkeypatch, aws) -> dict:
+    """ AWS stubs, with journals kept in (fake) SSM and variables written two
+        workspaces at a time, so deadline stops leave work to resume """
+    import config as conf
+
+    monkeypatch.setattr(conf, "JOURNAL_STORE", "ssm")
+    monkeypatch.setattr(conf, "ROTATION_CHUNK_SIZE", 2)
+    return aws
+
+
+@pytest.fixture
+def rotation(journaled, org) -> dict:
+    """ AWS stubs for a journaled rotation of USER, who holds one key """
+    journaled["iam"].seed(USER)
+    return journaled
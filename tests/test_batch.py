@@ -0,0 +1,89 @@
+import asyncio
+import io
+import json
+
+import batch
+import config as conf
+import pytest
+import terraform
+from conftest import Countdown, effective_key_ids, key_ids, saved_journal
+
+
+def test_dry_run_plans_without_touching_keys(aws, org):
+    for user in ("even-user", "odd-user"):
+        aws["iam"].seed(user)
+    selectors = batch.user_selectors(
+        {"even-user": {"tags": ["even"]}, "odd-user": {"tags": ["odd"]}}
+    )
+    keys = {k: list(v) for k, v in aws["iam"].keys.items()}
+    output = io.StringIO()
+
+    assert batch.rotate_users(selectors, dry_run=True, output=output) == {}
+
+    assert aws["iam"].keys == keys
+    assert not aws["iam"].calls["create_access_key"]
+    assert not aws["iam"].calls["delete_access_key"]
+    assert org.stats["requests"] == sum(
+        v for k, v in org.stats.items() if k.startswith("list_")
+    )
+
+    *changes, summary = [json.loads(x) for x in output.getvalue().splitlines()]
+    assert {x["iam_username"] for x in changes} == {"even-user", "odd-user"}
+    assert summary["users"]["even-user"]["workspaces"] == 5
+    assert summary["users"]["odd-user"]["needs_rotation"]
+
+
+@pytest.fixture
+def users(journaled, org):
+    for user in ("even-user", "odd-user"):
+        journaled["iam"].seed(user)
+    return batch.user_selectors(
+        {"even-user": {"tags": ["even"]}, "odd-user": {"tags": ["odd"]}}
+    )
+
+
+@pytest.mark.parametrize("setting", batch.UNSUPPORTED)
+def test_unsupported_settings_fail_before_any_key_is_created(
+    monkeypatch, users, aws, setting
+):
+    monkeypatch.setattr(conf, setting, "set")
+
+    with pytest.raises(ValueError, match=setting):
+        batch.rotate_users(users, dry_run=False)
+
+    assert not aws["iam"].calls["create_access_key"]
+
+
+def test_deadline_stop_is_resumed_by_the_next_run(users, aws, org):
+    previous = {user: key_ids(aws, user) for user in users}
+
+    batch.rotate_users(users, dry_run=False, deadline=Countdown(chunks=2))
+
+    assert aws["iam"].calls["create_access_key"] == 2
+    for user in users:
+        assert set(previous[user]) <= set(key_ids(aws, user))
+        assert saved_journal(user).started
+    new = {user: saved_journal(user).key_id for user in users}
+
+    results = batch.rotate_users(users, dry_run=False)
+
+    assert aws["iam"].calls["create_access_key"] == 2
+    for user in users:
+        assert key_ids(aws, user) == [new[user]]
+        assert not results[user].failure_count
+        assert not saved_journal(user).started
+    assert effective_key_ids(org) == set(new.values())
+
+
+def test_failed_writes_cancel_the_probes(monkeypatch, users, aws):
+    def fail(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(terraform, "write_journaled", fail)
+
+    with pytest.raises(RuntimeError):
+        batch.rotate_users(users, dry_run=False)
+
+    assert not [x for x in asyncio.all_tasks(terraform.event_loop()) if not x.done()]
+    for user in users:
+        assert len(aws["iam"].keys[user]) == 2
@@ -0,0 +1,75 @@
+import sqlite3
+
+import cache
+import config as conf
+import pytest
+import terraform
+from terraform import VarCategory
+
+
+@pytest.fixture
+def catalog_path(monkeypatch, tmp_path, org):
+    path = str(tmp_path / "catalog.sqlite3")
+    monkeypatch.setattr(conf, "CATALOG_PATH", path)
+    yield path
+    terraform.close_catalog()
+
+
+def refresh():
+    """ The catalog as the next invocation sees it """
+    terraform.close_catalog()
+    cache.begin_invocation()
+    return terraform.get_catalog()
+
+
+def credential_values(variables):
+    return {
+        (x.workspace_id, x.key, x.value)
+        for x in variables
+        if x.key in terraform.CREDENTIAL_DESCRIPTIONS
+    }
+
+
+def test_unchanged_organization_costs_one_request(catalog_path, org):
+    catalog = refresh()
+    assert catalog.count() == len(org.workspaces)
+    requests = org.stats["requests"]
+
+    refresh()
+
+    assert org.stats["requests"] == requests + 1
+    assert not org.stats["list_workspace_variables 200"]
+
+
+def test_rotation_keeps_the_catalog_in_sync(catalog_path, aws, org):
+    aws["iam"].seed(conf.TF_IAM_USERNAME)
+    refresh()
+    terraform.rotate_keys(dry_run=False)
+
+    catalog = refresh()
+
+    assert credential_values(catalog.variables()) == credential_values(
+        terraform.fetch_variables(category=VarCategory.ENV)
+    )
+
+
+def test_deleted_workspaces_are_dropped(catalog_path, org):
+    refresh()
+    deleted = org.workspaces.pop()
+
+    catalog = refresh()
+
+    assert catalog.count() == len(org.workspaces)
+    assert deleted["id"] not in catalog.workspace_ids()
+    assert not catalog.variables([deleted["id"]])
+
+
+def test_rotation_closes_the_previous_invocations_catalog(catalog_path, aws, org):
+    aws["iam"].seed(conf.TF_IAM_USERNAME)
+    catalog = refresh()
+
+    terraform.rotate_keys(dry_run=False)
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        catalog.count()
+    assert terraform.get_catalog() is not catalog
@@ -0,0 +1,18 @@
+import config as conf
+
+
+def test_reload_reads_changed_settings(monkeypatch):
+    token = str(conf.TF_TOKEN)
+    monkeypatch.setenv("TF_TOKEN", "rotated")
+    monkeypatch.setenv("TF_PAGE_SIZE", "20")
+    try:
+        changed = conf.reload()
+
+        assert str(conf.TF_TOKEN) == "rotated" and conf.TF_PAGE_SIZE == 20
+        assert "TF_TOKEN" in changed and "TF_PAGE_SIZE" in changed
+    finally:
+        monkeypatch.undo()
+        conf.reload()
+
+    assert str(conf.TF_TOKEN) == token
+    assert conf.reload() == []
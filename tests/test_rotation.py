@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta, timezone
+
+import config as conf
+import key_rotation
+import pytest
+import terraform
+from conftest import USER, Countdown, effective_key_ids, key_ids, saved_journal
+
+
+def test_deadline_stop_keeps_the_previous_key(rotation, org):
+    (previous,) = key_ids(rotation)
+
+    results = terraform.rotate_keys(dry_run=False, deadline=Countdown(chunks=2))
+
+    assert results.succeeded_workspaces
+    assert len(results.succeeded_workspaces) < len(org.workspaces)
+    assert previous in key_ids(rotation)
+    progress = saved_journal()
+    assert progress.started and progress.previous_key_id == previous
+    assert set(results.succeeded_workspaces) <= progress.completed
+
+
+def test_resume_reuses_the_key_and_writes_the_rest(rotation, org):
+    (previous,) = key_ids(rotation)
+    terraform.rotate_keys(dry_run=False, deadline=Countdown(chunks=2))
+    new = saved_journal().key_id
+    completed = saved_journal().completed
+
+    results = terraform.rotate_keys(dry_run=False)
+
+    assert rotation["iam"].calls["create_access_key"] == 1
+    assert key_ids(rotation) == [new]
+    assert effective_key_ids(org) == {new}
+    assert not set(results.succeeded_workspaces) & completed
+    assert not saved_journal().started
+
+
+def test_two_active_keys_without_a_journal_are_migrated(rotation, org):
+    (stale,) = key_ids(rotation)
+    rotation["iam"].keys[USER][0]["CreateDate"] -= timedelta(days=30)
+    terraform.rotate_keys(dry_run=False)
+    (current,) = key_ids(rotation)
+    # as left by releases whose rotations never deleted the previous key
+    rotation["iam"].keys[USER].insert(
+        0,
+        {
+            "UserName": USER,
+            "AccessKeyId": stale,
+            "Status": "Active",
+            "CreateDate": datetime.now(timezone.utc) - timedelta(days=30),
+        },
+    )
+    for key in rotation["iam"].keys[USER]:
+        key["CreateDate"] -= timedelta(days=20)
+
+    results = terraform.rotate_keys(dry_run=False)
+
+    assert not results.failure_count
+    assert rotation["iam"].calls["update_access_key"] == 1
+    (new,) = key_ids(rotation)
+    assert new not in (stale, current)
+    assert effective_key_ids(org) == {new}
+
+
+def test_active_key_is_only_replaced_when_asked(rotation):
+    rotation["iam"].seed(USER, age=timedelta(days=30))
+    rotation["iam"].create_access_key(UserName=USER)
+    (oldest, current) = key_ids(rotation)
+
+    with pytest.raises(ValueError, match="may still be in use"):
+        key_rotation.RotationManager(USER).create_new_credentials()
+
+    assert key_ids(rotation) == [oldest, current]
+    assert not rotation["iam"].calls["update_access_key"]
+
+
+def test_inactive_key_is_deleted_to_make_room(rotation, org):
+    (previous,) = key_ids(rotation)
+    rotation["iam"].seed(USER, age=timedelta(days=30))
+    rotation["iam"].keys[USER][0]["Status"] = "Inactive"
+    rotation["iam"].keys[USER].append(
+        {
+            "UserName": USER,
+            "AccessKeyId": previous,
+            "Status": "Active",
+            "CreateDate": datetime.now(timezone.utc) - timedelta(days=20),
+        }
+    )
+
+    terraform.rotate_keys(dry_run=False)
+
+    assert rotation["iam"].calls["create_access_key"] == 2
+    assert previous not in key_ids(rotation)
+    assert len(effective_key_ids(org)) == 1
+
+
+@pytest.mark.parametrize("org", [1000], indirect=True)
+def test_resume_of_a_journal_split_across_parameters(monkeypatch, rotation, org):
+    monkeypatch.setattr(conf, "ROTATION_CHUNK_SIZE", 100)
+    terraform.rotate_keys(dry_run=False, deadline=Countdown(chunks=6))
+    completed = saved_journal().completed
+    assert len(completed) == 600
+    parts = [
+        x for x in rotation["ssm"].parameters if x.startswith(conf.JOURNAL_SSM_PATH)
+    ]
+    assert len(parts) > 1
+    assert all(len(rotation["ssm"].parameters[x]) <= 8192 for x in parts)
+
+    results = terraform.rotate_keys(dry_run=False)
+
+    assert not set(results.succeeded_workspaces) & completed
+    assert len(results.succeeded_workspaces) == 400
+    assert not saved_journal().started
+    assert not [
+        x for x in rotation["ssm"].parameters if x.startswith(conf.JOURNAL_SSM_PATH)
+    ]
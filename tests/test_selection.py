@@ -0,0 +1,21 @@
+import pytest
+from models import Workspace
+from selection import WorkspaceSelector
+
+NAMES = ["prod", "production-old", "staging-prod", "dev"]
+
+
+def selected(**kwargs):
+    workspaces = [Workspace(f"ws-{i}", name) for i, name in enumerate(NAMES)]
+    return [x.workspace_name for x in WorkspaceSelector(**kwargs).select(workspaces)]
+
+
+@pytest.mark.parametrize("pattern", ["prod", "re:prod"])
+def test_patterns_match_the_whole_name(pattern):
+    assert selected(include=[pattern]) == ["prod"]
+    assert selected(exclude=[pattern]) == ["production-old", "staging-prod", "dev"]
+
+
+@pytest.mark.parametrize("pattern", ["prod*", "re:prod.*"])
+def test_prefixes_need_a_wildcard(pattern):
+    assert selected(include=[pattern]) == ["prod", "production-old"]
@@ -0,0 +1,104 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config as conf
+import pytest
+import shards
+from journal import MemoryStore, RotationJournal
+from terraform import TFVar, VarCategory
+from util.timing import Deadline
+
+
+class Workspace:
+    def __init__(self, workspace_name: str):
+        self.workspace_name = workspace_name
+
+
+class ThreadExecutor(shards.ShardExecutor):
+    """ Runs shards in threads, taking `durations[shard_id]` seconds each """
+
+    def __init__(self, max_workers: int, durations=None, failing=()):
+        self.max_workers = max_workers
+        self.durations = durations or {}
+        self.failing = failing
+        self.started = []
+
+    def pool(self):
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def run(self, shard):
+        self.started.append(shard["shard_id"])
+        time.sleep(self.durations.get(shard["shard_id"], 0.0))
+        if shard["shard_id"] in self.failing:
+            raise RuntimeError("boom")
+        return {
+            "shard_id": shard["shard_id"],
+            "succeeded": {
+                name: [x["key"] for x in writes]
+                for name, writes in shard["writes"].items()
+            },
+            "failed": {},
+        }
+
+
+def tfvar(number: int) -> TFVar:
+    return TFVar(
+        key="AWS_ACCESS_KEY_ID",
+        value="AKIA",
+        category=VarCategory.ENV,
+        hcl=False,
+        sensitive=True,
+        description="",
+        variable_id=f"var-{number}",
+    )
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    monkeypatch.setattr(conf, "SHARD_SIZE", 2)
+    workspaces = [Workspace(f"ws-{i}") for i in range(6)]
+    tfvars = [(x.workspace_name, tfvar(i)) for i, x in enumerate(workspaces)]
+    return workspaces, tfvars
+
+
+def test_journals_each_finished_shard(writes):
+    workspaces, tfvars = writes
+    journal = RotationJournal(MemoryStore(), "test")
+    executor = ThreadExecutor(2, failing={1})
+
+    results, finished = shards.write_sharded(
+        workspaces, tfvars, journal, None, executor
+    )
+
+    assert finished
+    assert sorted(journal.completed) == ["ws-0", "ws-1", "ws-4", "ws-5"]
+    assert sorted(results.failed_workspaces) == ["ws-2", "ws-3"]
+
+
+def test_stops_dispatching_before_the_deadline(writes):
+    workspaces, tfvars = writes
+    journal = RotationJournal(MemoryStore(), "test")
+    executor = ThreadExecutor(1, durations={0: 0.2})
+
+    results, finished = shards.write_sharded(
+        workspaces, tfvars, journal, Deadline(0.3), executor
+    )
+
+    assert not finished
+    assert executor.started == [0]
+    assert sorted(journal.completed) == ["ws-0", "ws-1"]
+
+
+def test_stops_waiting_at_the_deadline(writes):
+    workspaces, tfvars = writes
+    journal = RotationJournal(MemoryStore(), "test")
+    executor = ThreadExecutor(3, durations={0: 0.1, 1: 1.0, 2: 1.0})
+
+    ts = time.monotonic()
+    results, finished = shards.write_sharded(
+        workspaces, tfvars, journal, Deadline(0.3), executor
+    )
+
+    assert not finished
+    assert time.monotonic() - ts < 0.9
+    assert sorted(journal.completed) == ["ws-0", "ws-1"]
@@ -0,0 +1,70 @@
+import config as conf
+import journal
+import pytest
+import terraform
+import varsets
+from conftest import USER, Countdown, effective_key_ids, key_ids, saved_journal
+
+
+@pytest.fixture
+def varset(monkeypatch, rotation):
+    monkeypatch.setattr(conf, "TF_VARSET_NAME", "credentials")
+    return rotation
+
+
+def credential_variables(org):
+    return [
+        x
+        for x in org.variables.values()
+        if x["attributes"]["key"] in terraform.CREDENTIAL_DESCRIPTIONS
+    ]
+
+
+def test_set_replaces_the_workspace_variables(varset, org):
+    results = terraform.rotate_keys(dry_run=False)
+
+    assert not results.failure_count
+    (new,) = key_ids(varset)
+    assert effective_key_ids(org) == {new}
+    (created,) = org.varsets.values()
+    assert created["workspaces"] == {x["id"] for x in org.workspaces}
+    assert not credential_variables(org)
+
+
+def test_deadline_stop_is_resumed(varset, org):
+    (previous,) = key_ids(varset)
+
+    terraform.rotate_keys(dry_run=False, deadline=Countdown(chunks=2))
+
+    progress = saved_journal()
+    assert progress.started and len(progress.completed) == 4
+    assert previous in key_ids(varset)
+
+    terraform.rotate_keys(dry_run=False)
+
+    assert key_ids(varset) == [progress.key_id]
+    assert effective_key_ids(org) == {progress.key_id}
+    assert len(org.varsets) == 1
+
+
+def test_failed_set_writes_leave_the_workspaces_alone(monkeypatch, varset, org):
+    async def fail(varset, writes):
+        results = terraform.WriteResults()
+        for _, var in writes:
+            results.failed[varset.name].append((var, Exception("boom")))
+        return results
+
+    monkeypatch.setattr(varsets, "write_variables", fail)
+    progress = journal.RotationJournal(None, USER)
+
+    results, finished = varsets.deliver(
+        terraform.get_workspaces(),
+        terraform.get_variables(category=terraform.VarCategory.ENV),
+        {key: "new" for key in terraform.CREDENTIAL_DESCRIPTIONS},
+        terraform.CREDENTIAL_DESCRIPTIONS,
+        progress,
+    )
+
+    assert results.failure_count and not finished
+    assert not progress.completed
+    assert not any(x["workspaces"] for x in org.varsets.values())